@@ -0,0 +1,1420 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import json
+import time
+import mmap
+import fcntl
+import shutil
+import bisect
+import logging
+import tempfile
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict, OrderedDict
+
+import numpy as np
+
+
+CACHE_FORMATS = ('tsv', 'binary')
+
+BINARY_MAGIC = b'GTDBANI\x01'
+
+# producer of values in caches that predate recording of producers
+LEGACY_PRODUCER = ''
+
+# number of genome pairs processed at a time when streaming binary caches
+CHUNK_SIZE = 1000000
+
+
+def round_ani(ani):
+    """Round ANI to the precision reported by FastANI."""
+
+    return round(float(ani), 4)
+
+
+def round_af(af):
+    """Round AF to the precision written to the TSV cache."""
+
+    return round(float(af), 6)
+
+
+def cache_file_format(cache_file):
+    """Determine format of an existing ANI cache file.
+
+    Returns
+    -------
+    str
+        Either 'binary' or 'tsv'.
+    """
+
+    with open(cache_file, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            return 'binary'
+
+    return 'tsv'
+
+
+def parse_tsv_record(line, producers):
+    """Parse record from an ANI cache or journal in TSV format.
+
+    Each line gives the query and reference genome, ANI, AF, and optionally
+    the producer of the values.
+
+    Parameters
+    ----------
+    line : str
+        Line to parse.
+    producers : dict
+        Previously parsed producers, used to share producer strings between records.
+
+    Returns
+    -------
+    (qid, rid, ANI, AF, producer), or None for an incomplete record
+    """
+
+    line_split = line.rstrip('\n').split('\t')
+    if not line.endswith('\n') or len(line_split) not in [4, 5]:
+        return None
+
+    try:
+        ani = float(line_split[2])
+        af = float(line_split[3])
+    except ValueError:
+        return None
+
+    producer = LEGACY_PRODUCER
+    if len(line_split) == 5:
+        producer = producers.setdefault(line_split[4], line_split[4])
+
+    return line_split[0], line_split[1], ani, af, producer
+
+
+def read_tsv_records(tsv_file):
+    """Read records from an ANI cache or journal in TSV format.
+
+    Incomplete records, e.g. due to a crash while a journal
+    was being written, are ignored.
+
+    Yields
+    ------
+    (qid, rid, ANI, AF, producer)
+    """
+
+    producers = {}
+    with open(tsv_file) as f:
+        for line in f:
+            record = parse_tsv_record(line, producers)
+            if record is not None:
+                yield record
+
+
+def format_tsv_record(qid, rid, ani, af, producer):
+    """Format record for an ANI cache or journal in TSV format."""
+
+    if producer == LEGACY_PRODUCER:
+        return '%s\t%s\t%f\t%f\n' % (qid, rid, ani, af)
+
+    return '%s\t%s\t%f\t%f\t%s\n' % (qid, rid, ani, af, producer)
+
+
+def write_tsv_cache(cache_file, records):
+    """Write ANI cache in TSV format.
+
+    The cache is written to a temporary file which then replaces
+    any existing cache so an interrupted write cannot corrupt it.
+    An index of the records for each query genome is written
+    alongside the cache. The index is put in place before the cache
+    and identifies the file it describes, so it is ignored by
+    readers until the cache is replaced.
+
+    Parameters
+    ----------
+    cache_file : str
+        Cache file to write.
+    records : iterable
+        Tuples of the form (qid, rid, ANI, AF, producer).
+
+    Returns
+    -------
+    int
+        Number of genome pairs written to file.
+    """
+
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    index = TSVIndex()
+    with open(tmp_file, 'wb') as fout:
+        for record in records:
+            line = format_tsv_record(*record).encode('utf-8')
+            index.add(record[0], fout.tell(), len(line))
+            fout.write(line)
+
+    index.write(cache_file, os.stat(tmp_file))
+    os.replace(tmp_file, cache_file)
+
+    return index.num_records
+
+
+def append_journal(journal_file, records):
+    """Append records to an ANI cache journal.
+
+    Returns
+    -------
+    int
+        Number of records appended to journal.
+    """
+
+    # terminate any incomplete record so it can not corrupt the first appended record
+    torn_record = False
+    if os.path.exists(journal_file) and os.path.getsize(journal_file) > 0:
+        with open(journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            torn_record = f.read(1) != b'\n'
+
+    num_records = 0
+    with open(journal_file, 'a') as fout:
+        if torn_record:
+            fout.write('\n')
+
+        for record in records:
+            fout.write(format_tsv_record(*record))
+            num_records += 1
+
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    return num_records
+
+
+class TSVIndex(object):
+    """Location of the records for each query genome in an ANI cache in TSV format.
+
+    The index is stored alongside the cache and is only used if the size,
+    modification time and inode of the cache match those recorded in the index.
+    """
+
+    def __init__(self):
+        """Initialization."""
+
+        self.ranges = {}
+        self.num_records = 0
+        self.last_qid = None
+
+    def add(self, qid, offset, length):
+        """Add record to index."""
+
+        if qid == self.last_qid:
+            self.ranges[qid][-1][1] = offset + length
+        else:
+            self.ranges.setdefault(qid, []).append([offset, offset + length])
+            self.last_qid = qid
+
+        self.num_records += 1
+
+    @staticmethod
+    def index_file(cache_file):
+        """Get path to index of ANI cache."""
+
+        return f'{cache_file}.index'
+
+    def write(self, cache_file, stat):
+        """Write index for ANI cache.
+
+        Parameters
+        ----------
+        cache_file : str
+            ANI cache the index is stored alongside.
+        stat : os.stat_result
+            Status of the file containing the indexed records, which
+            is the cache file once any pending replacement is complete.
+        """
+
+        index_file = TSVIndex.index_file(cache_file)
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as fout:
+            fout.write(f'#{stat.st_size}\t{stat.st_mtime_ns}\t{stat.st_ino}\t{self.num_records}\n')
+            for qid, ranges in self.ranges.items():
+                range_str = ','.join(f'{start}:{end}' for start, end in ranges)
+                fout.write(f'{qid}\t{range_str}\n')
+
+        os.replace(tmp_file, index_file)
+
+    @staticmethod
+    def read(cache_file, stat):
+        """Read index for ANI cache, or return None if there is no valid index.
+
+        Parameters
+        ----------
+        cache_file : str
+            ANI cache the index is stored alongside.
+        stat : os.stat_result
+            Status of the cache file being read, which must match the file described by the index.
+        """
+
+        index_file = TSVIndex.index_file(cache_file)
+        if not os.path.exists(index_file):
+            return None
+
+        index = TSVIndex()
+        try:
+            with open(index_file) as f:
+                size, mtime_ns, inode, num_records = f.readline()[1:].split('\t')
+                if (int(size) != stat.st_size 
+                        or int(mtime_ns) != stat.st_mtime_ns 
+                        or int(inode) != stat.st_ino):
+                    return None
+
+                index.num_records = int(num_records)
+                for line in f:
+                    qid, range_str = line.rstrip('\n').split('\t')
+                    index.ranges[qid] = [[int(v) for v in r.split(':')] for r in range_str.split(',')]
+        except ValueError:
+            # incomplete or malformed index
+            return None
+
+        return index
+
+    @staticmethod
+    def build(f):
+        """Build index by scanning ANI cache opened in binary mode."""
+
+        index = TSVIndex()
+        offset = 0
+        f.seek(0)
+        for line in f:
+            tab_pos = line.find(b'\t')
+            if tab_pos != -1 and line.endswith(b'\n'):
+                index.add(line[0:tab_pos].decode('utf-8'), offset, len(line))
+            offset += len(line)
+
+        return index
+
+
+class TSVANIStore(object):
+    """ANI cache in TSV format read on demand.
+
+    An index giving the location of the records for each query genome
+    is used so only the rows of the cache which are accessed are read
+    and parsed.
+    """
+
+    # number of parsed rows to retain
+    max_loaded_rows = 1000
+
+    def __init__(self, cache_file):
+        """Initialization."""
+
+        self.cache_file = cache_file
+
+        # keep cache open so it can be read consistently
+        # even if it is replaced by another process
+        self.f = open(cache_file, 'rb')
+
+        # index must describe the opened file, not a cache which has since replaced it
+        stat = os.fstat(self.f.fileno())
+        self.index = TSVIndex.read(cache_file, stat)
+        if self.index is None:
+            self.index = TSVIndex.build(self.f)
+            try:
+                self.index.write(cache_file, stat)
+            except OSError:
+                pass
+
+        self.num_pairs = self.index.num_records
+        self.producers = {}
+        self.loaded_rows = OrderedDict()
+
+    def __len__(self):
+        """Number of genome pairs in cache."""
+
+        return self.num_pairs
+
+    def _load_row(self, qid):
+        """Read and parse records for query genome, retaining recently used rows."""
+
+        row = self.loaded_rows.get(qid)
+        if row is not None:
+            self.loaded_rows.move_to_end(qid)
+            return row
+
+        row = {}
+        for start, end in self.index.ranges.get(qid, []):
+            self.f.seek(start)
+            for line in self.f.read(end - start).decode('utf-8').splitlines(keepends=True):
+                record = parse_tsv_record(line, self.producers)
+                if record is not None:
+                    row[record[1]] = record[2:]
+
+        self.loaded_rows[qid] = row
+        if len(self.loaded_rows) > self.max_loaded_rows:
+            self.loaded_rows.popitem(last=False)
+
+        return row
+
+    def get(self, qid, rid):
+        """Get (ANI, AF, producer) for a genome pair, or None if the pair is not in the cache."""
+
+        if qid not in self.index.ranges:
+            return None
+
+        return self._load_row(qid).get(rid)
+
+    def row(self, qid):
+        """Get (ANI, AF, producer) between query genome and all reference genomes in cache."""
+
+        return dict(self._load_row(qid))
+
+    def query_gids(self):
+        """Get genome IDs with at least one pair where they are the query genome."""
+
+        return list(self.index.ranges)
+
+    def records(self):
+        """Iterate over all pairs as (qid, rid, ANI, AF, producer)."""
+
+        for qid in self.index.ranges:
+            for rid, (ani, af, producer) in self._load_row(qid).items():
+                yield qid, rid, ani, af, producer
+
+    def producer_counts(self):
+        """Get number of values from each producer."""
+
+        counts = defaultdict(int)
+        for record in self.records():
+            counts[record[4]] += 1
+
+        return counts
+
+    def close(self):
+        """Close cache."""
+
+        self.f.close()
+
+
+class BinaryCacheWriter(object):
+    """Stream sorted genome pairs into a binary ANI cache.
+
+    A binary cache consists of:
+     - a magic string and the length of a JSON header
+     - a JSON header describing the location of each section
+       and the table of producers of cached values
+     - the sorted table of interned genome IDs
+     - sorted uint64 pair keys, (query index << 32) | reference index
+     - float32 ANI and AF values in the same order as the keys
+     - uint16 index of the producer of each pair
+
+    Pairs must be added in increasing key order, i.e. sorted by query
+    and then reference genome ID.
+    """
+
+    def __init__(self, cache_file, gids, producers):
+        """Initialization.
+
+        Parameters
+        ----------
+        cache_file : str
+            Cache file to write.
+        gids : list
+            Sorted list of all genome IDs in the cache.
+        producers : list
+            Producers of cached values.
+        """
+
+        self.cache_file = cache_file
+        self.gids = gids
+        self.producers = producers
+
+        out_dir = os.path.dirname(os.path.abspath(cache_file))
+        self.tmp_dir = tempfile.mkdtemp(prefix='.ani_cache_', dir=out_dir)
+        self.section_files = {}
+        for section in ['keys', 'ani', 'af', 'producer']:
+            self.section_files[section] = open(os.path.join(self.tmp_dir, section), 'wb')
+
+        self.num_pairs = 0
+        self.last_key = -1
+
+    def add_chunk(self, keys, anis, afs, producers):
+        """Add sorted chunk of genome pairs."""
+
+        if len(keys) == 0:
+            return
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        assert int(keys[0]) > self.last_key
+        self.last_key = int(keys[-1])
+
+        self.section_files['keys'].write(keys.tobytes())
+        self.section_files['ani'].write(np.asarray(anis, dtype=np.float32).tobytes())
+        self.section_files['af'].write(np.asarray(afs, dtype=np.float32).tobytes())
+        self.section_files['producer'].write(np.asarray(producers, dtype=np.uint16).tobytes())
+        self.num_pairs += len(keys)
+
+    def close(self):
+        """Assemble binary cache file."""
+
+        for f in self.section_files.values():
+            f.close()
+
+        gid_bytes = [gid.encode('utf-8') for gid in self.gids]
+        gid_offsets = np.zeros(len(gid_bytes) + 1, dtype=np.uint64)
+        gid_offsets[1:] = np.cumsum([len(b) for b in gid_bytes], dtype=np.uint64)
+
+        section_sizes = [('gid_offsets', gid_offsets.nbytes),
+                            ('gid_bytes', int(gid_offsets[-1])),
+                            ('keys', 8 * self.num_pairs),
+                            ('ani', 4 * self.num_pairs),
+                            ('af', 4 * self.num_pairs),
+                            ('producer', 2 * self.num_pairs)]
+
+        header = {'version': 2,
+                    'num_genomes': len(self.gids),
+                    'num_pairs': self.num_pairs,
+                    'created': time.time(),
+                    'producers': self.producers,
+                    'sections': {}}
+
+        # header size depends on section offsets so iterate until stable
+        header_len = 0
+        while True:
+            offset = _align(len(BINARY_MAGIC) + 8 + header_len)
+            for section, size in section_sizes:
+                header['sections'][section] = [offset, size]
+                offset = _align(offset + size)
+
+            header_bytes = json.dumps(header).encode('utf-8')
+            if len(header_bytes) == header_len:
+                break
+            header_len = len(header_bytes)
+
+        tmp_file = os.path.join(self.tmp_dir, 'cache')
+        with open(tmp_file, 'wb') as fout:
+            fout.write(BINARY_MAGIC)
+            fout.write(np.uint64(header_len).tobytes())
+            fout.write(header_bytes)
+
+            for section, _size in section_sizes:
+                fout.write(b'\0' * (header['sections'][section][0] - fout.tell()))
+                if section == 'gid_offsets':
+                    fout.write(gid_offsets.tobytes())
+                elif section == 'gid_bytes':
+                    for b in gid_bytes:
+                        fout.write(b)
+                else:
+                    with open(os.path.join(self.tmp_dir, section), 'rb') as f:
+                        shutil.copyfileobj(f, fout, 16*1024*1024)
+
+        os.replace(tmp_file, self.cache_file)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        """Discard partially written cache."""
+
+        for f in self.section_files.values():
+            f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def _align(offset, alignment=8):
+    """Round offset up to the next multiple of alignment."""
+
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class _GenomeTable(object):
+    """Sorted table of genome IDs stored in a memory-mapped binary cache."""
+
+    def __init__(self, offsets, gid_bytes):
+        """Initialization."""
+
+        self.offsets = offsets
+        self.gid_bytes = gid_bytes
+
+    def __len__(self):
+        """Number of genomes in table."""
+
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        """Get genome ID at specified index."""
+
+        start = int(self.offsets[idx])
+        end = int(self.offsets[idx + 1])
+        return bytes(self.gid_bytes[start:end]).decode('utf-8')
+
+    def index(self, gid):
+        """Get index of genome ID, or None if it is not in the table."""
+
+        idx = bisect.bisect_left(self, gid)
+        if idx < len(self) and self[idx] == gid:
+            return idx
+
+        return None
+
+
+class BinaryANIStore(object):
+    """Read-only, memory-mapped ANI cache in binary format.
+
+    Genome IDs are interned in a sorted table and pairs are identified by sorted
+    uint64 keys, so the values for a genome pair or all pairs with a given query
+    genome are found by binary search without reading the full cache.
+    """
+
+    def __init__(self, cache_file):
+        """Initialization."""
+
+        self.cache_file = cache_file
+
+        with open(cache_file, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[0:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError(f'Invalid binary ANI cache: {cache_file}')
+
+        header_len = int(np.frombuffer(self.mm, dtype=np.uint64, count=1, offset=len(BINARY_MAGIC))[0])
+        header_start = len(BINARY_MAGIC) + 8
+        self.header = json.loads(self.mm[header_start:header_start + header_len].decode('utf-8'))
+
+        self.num_genomes = self.header['num_genomes']
+        self.num_pairs = self.header['num_pairs']
+
+        self.genome_table = _GenomeTable(self._section('gid_offsets', np.uint64),
+                                            memoryview(self.mm)[slice(*self._section_range('gid_bytes'))])
+        self.keys = self._section('keys', np.uint64)
+        self.ani = self._section('ani', np.float32)
+        self.af = self._section('af', np.float32)
+
+        if 'producer' in self.header['sections']:
+            self.producers = self.header['producers']
+            self.producer = self._section('producer', np.uint16)
+        else:
+            self.producers = [LEGACY_PRODUCER]
+            self.producer = np.zeros(self.num_pairs, dtype=np.uint16)
+
+    def _section_range(self, section):
+        """Get start and end offset of section."""
+
+        offset, size = self.header['sections'][section]
+        return offset, offset + size
+
+    def _section(self, section, dtype):
+        """Get memory-mapped array for section."""
+
+        offset, size = self.header['sections'][section]
+        return np.frombuffer(self.mm,
+                                dtype=dtype,
+                                count=size // np.dtype(dtype).itemsize,
+                                offset=offset)
+
+    def __len__(self):
+        """Number of genome pairs in cache."""
+
+        return self.num_pairs
+
+    def gids(self):
+        """Get sorted list of all genome IDs in cache."""
+
+        return [self.genome_table[idx] for idx in range(self.num_genomes)]
+
+    def get(self, qid, rid):
+        """Get (ANI, AF, producer) for a genome pair, or None if the pair is not in the cache."""
+
+        qidx = self.genome_table.index(qid)
+        if qidx is None:
+            return None
+
+        ridx = self.genome_table.index(rid)
+        if ridx is None:
+            return None
+
+        key = np.uint64((qidx << 32) | ridx)
+        idx = int(np.searchsorted(self.keys, key))
+        if idx < self.num_pairs and self.keys[idx] == key:
+            return (round_ani(self.ani[idx]),
+                    round_af(self.af[idx]),
+                    self.producers[self.producer[idx]])
+
+        return None
+
+    def _query_range(self, qidx):
+        """Get range of pairs with specified query genome index."""
+
+        start = int(np.searchsorted(self.keys, np.uint64(qidx << 32)))
+        end = int(np.searchsorted(self.keys, np.uint64((qidx + 1) << 32)))
+
+        return start, end
+
+    def row(self, qid):
+        """Get (ANI, AF, producer) between query genome and all reference genomes in cache.
+
+        Returns
+        -------
+        dict : d[rid] -> (ANI, AF, producer)
+        """
+
+        qidx = self.genome_table.index(qid)
+        if qidx is None:
+            return {}
+
+        start, end = self._query_range(qidx)
+        ridxs = self.keys[start:end] & np.uint64(0xFFFFFFFF)
+        anis = np.round(self.ani[start:end].astype(np.float64), 4)
+        afs = np.round(self.af[start:end].astype(np.float64), 6)
+        pidxs = self.producer[start:end]
+
+        return {self.genome_table[int(ridx)]: (float(ani), float(af), self.producers[pidx])
+                    for ridx, ani, af, pidx in zip(ridxs, anis, afs, pidxs)}
+
+    def query_gids(self):
+        """Get genome IDs with at least one pair where they are the query genome."""
+
+        qidxs = np.unique(self.keys >> np.uint64(32))
+        return [self.genome_table[int(qidx)] for qidx in qidxs]
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """Iterate over sorted pairs as (keys, ANI, AF, producer index) arrays.
+
+        Keys are relative to the genome table of this cache and producer
+        indices relative to the producer table of this cache.
+        """
+
+        for start in range(0, self.num_pairs, chunk_size):
+            end = min(start + chunk_size, self.num_pairs)
+            yield (np.array(self.keys[start:end]),
+                    np.array(self.ani[start:end]),
+                    np.array(self.af[start:end]),
+                    np.array(self.producer[start:end]))
+
+    def producer_counts(self):
+        """Get number of values from each producer."""
+
+        counts = np.zeros(len(self.producers), dtype=np.int64)
+        for start in range(0, self.num_pairs, CHUNK_SIZE):
+            counts += np.bincount(self.producer[start:start + CHUNK_SIZE],
+                                    minlength=len(self.producers))
+
+        return {producer: int(count) for producer, count in zip(self.producers, counts) if count}
+
+    def num_paired_genomes(self):
+        """Get number of genomes in at least one pair."""
+
+        present = np.zeros(self.num_genomes, dtype=bool)
+        for start in range(0, self.num_pairs, CHUNK_SIZE):
+            keys = self.keys[start:start + CHUNK_SIZE]
+            present[(keys >> np.uint64(32)).astype(np.int64)] = True
+            present[(keys & np.uint64(0xFFFFFFFF)).astype(np.int64)] = True
+
+        return int(present.sum())
+
+    def records(self):
+        """Iterate over all pairs as (qid, rid, ANI, AF, producer) sorted by query and reference ID."""
+
+        for keys, anis, afs, pidxs in self.chunks():
+            qidxs = keys >> np.uint64(32)
+            ridxs = keys & np.uint64(0xFFFFFFFF)
+            anis = np.round(anis.astype(np.float64), 4)
+            afs = np.round(afs.astype(np.float64), 6)
+            for qidx, ridx, ani, af, pidx in zip(qidxs, ridxs, anis, afs, pidxs):
+                yield (self.genome_table[int(qidx)],
+                        self.genome_table[int(ridx)],
+                        float(ani),
+                        float(af),
+                        self.producers[pidx])
+
+    def close(self):
+        """Release memory map."""
+
+        self.genome_table = None
+        self.keys = self.ani = self.af = self.producer = None
+        try:
+            self.mm.close()
+        except BufferError:
+            # arrays referencing the map are still alive and
+            # the map will be released once they are collected
+            pass
+
+
+def open_store(cache_file):
+    """Open ANI cache in either TSV or binary format."""
+
+    if cache_file_format(cache_file) == 'binary':
+        return BinaryANIStore(cache_file)
+
+    return TSVANIStore(cache_file)
+
+
+def remap_keys(keys, index_map):
+    """Convert pair keys to a new genome table.
+
+    Parameters
+    ----------
+    keys : np.array
+        Pair keys relative to original genome table.
+    index_map : np.array
+        Index in the new genome table of each genome in the original table.
+    """
+
+    qidxs = index_map[(keys >> np.uint64(32)).astype(np.int64)]
+    ridxs = index_map[(keys & np.uint64(0xFFFFFFFF)).astype(np.int64)]
+
+    return (qidxs << np.uint64(32)) | ridxs
+
+
+def merge_sorted_chunks(sources):
+    """Merge streams of sorted (keys, ANI, AF, producer index) chunks.
+
+    All sources must use the same genome and producer tables. If a pair
+    occurs in multiple sources, the value from the last source is retained.
+    Only a single chunk from each source is held in memory at a time.
+
+    Parameters
+    ----------
+    sources : list
+        Iterators over sorted chunks without duplicate keys.
+
+    Yields
+    ------
+    (keys, ANI, AF, producer index)
+        Sorted chunk of merged pairs.
+    """
+
+    iters = [iter(s) for s in sources]
+    buffers = [None] * len(iters)
+
+    while True:
+        # make sure each source has pairs buffered
+        for idx, it in enumerate(iters):
+            if it is None:
+                continue
+            while buffers[idx] is None or len(buffers[idx][0]) == 0:
+                chunk = next(it, None)
+                if chunk is None:
+                    iters[idx] = None
+                    buffers[idx] = None
+                    break
+                buffers[idx] = tuple(np.asarray(a) for a in chunk)
+
+        active = [idx for idx, b in enumerate(buffers) if b is not None]
+        if not active:
+            break
+
+        # all pairs up to the smallest final key across buffers can be emitted
+        bound = min(buffers[idx][0][-1] for idx in active)
+
+        arrays = [[] for _ in range(4)]
+        priority = []
+        for idx in active:
+            split = int(np.searchsorted(buffers[idx][0], bound, side='right'))
+            for array, values in zip(arrays, buffers[idx]):
+                array.append(values[:split])
+            priority.append(np.full(split, idx, dtype=np.int32))
+            buffers[idx] = tuple(values[split:] for values in buffers[idx])
+
+        keys, anis, afs, pidxs = [np.concatenate(array) for array in arrays]
+        priority = np.concatenate(priority)
+
+        # sort by key and then source, retaining the last source for duplicates
+        order = np.lexsort((priority, keys))
+        keys = keys[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[:-1] = keys[:-1] != keys[1:]
+
+        yield keys[keep], anis[order][keep], afs[order][keep], pidxs[order][keep]
+
+
+def _sort_chunk(keys, anis, afs, pidxs):
+    """Sort chunk by key, retaining the last occurrence of duplicate keys."""
+
+    keys = np.asarray(keys, dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    keep = np.ones(len(keys), dtype=bool)
+    keep[:-1] = keys[:-1] != keys[1:]
+    order = order[keep]
+
+    return (keys[keep],
+            np.asarray(anis, dtype=np.float32)[order],
+            np.asarray(afs, dtype=np.float32)[order],
+            np.asarray(pidxs, dtype=np.uint16)[order])
+
+
+class _SortedRuns(object):
+    """External sort of records into sorted runs stored on disk."""
+
+    def __init__(self, tmp_dir, chunk_size=CHUNK_SIZE):
+        """Initialization."""
+
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.runs = []
+
+    def add_records(self, records, gid_index, producer_index):
+        """Add (qid, rid, ANI, AF, producer) records, which may be in any order."""
+
+        keys, anis, afs, pidxs = [], [], [], []
+        for qid, rid, ani, af, producer in records:
+            keys.append((gid_index[qid] << 32) | gid_index[rid])
+            anis.append(ani)
+            afs.append(af)
+            pidxs.append(producer_index[producer])
+
+            if len(keys) == self.chunk_size:
+                self._write_run(keys, anis, afs, pidxs)
+                keys, anis, afs, pidxs = [], [], [], []
+
+        if keys:
+            self._write_run(keys, anis, afs, pidxs)
+
+    def _write_run(self, keys, anis, afs, pidxs):
+        """Write sorted run to disk."""
+
+        run_prefix = os.path.join(self.tmp_dir, f'run_{id(self)}_{len(self.runs)}')
+        run_files = []
+        for name, values in zip(['keys', 'ani', 'af', 'producer'],
+                                _sort_chunk(keys, anis, afs, pidxs)):
+            run_file = f'{run_prefix}.{name}.npy'
+            np.save(run_file, values)
+            run_files.append(run_file)
+
+        self.runs.append(run_files)
+
+    def _read_run(self, run_files, read_size):
+        """Iterate over chunks of sorted run."""
+
+        arrays = [np.load(run_file, mmap_mode='r') for run_file in run_files]
+        for start in range(0, len(arrays[0]), read_size):
+            yield tuple(np.array(a[start:start + read_size]) for a in arrays)
+
+    def chunks(self):
+        """Iterate over merged chunks of all runs, later runs taking precedence."""
+
+        if not self.runs:
+            return iter([])
+
+        read_size = max(self.chunk_size // len(self.runs), 10000)
+        return merge_sorted_chunks([self._read_run(run_files, read_size)
+                                    for run_files in self.runs])
+
+
+def _remapped_chunks(store, index_map, producer_map):
+    """Iterate over chunks of binary cache relative to new genome and producer tables."""
+
+    for keys, anis, afs, pidxs in store.chunks():
+        yield remap_keys(keys, index_map), anis, afs, producer_map[pidxs]
+
+
+def write_binary_cache(cache_file, sources, keep_producer=None, keep_gids=None, require_both=False):
+    """Write binary ANI cache by merging ANI caches and records.
+
+    Each source must be either a BinaryANIStore or a function returning an
+    iterator over (qid, rid, ANI, AF, producer) records. Functions are called
+    twice so they can be read in a streaming manner. If a genome pair is
+    present in multiple sources, the value from the last source is retained.
+
+    Parameters
+    ----------
+    cache_file : str
+        Cache file to write.
+    sources : list
+        ANI caches or record iterators to merge.
+    keep_producer : function
+        Function indicating if values from a producer should be written.
+    keep_gids : set
+        Only write pairs where the query or reference genome is in this set.
+    require_both : bool
+        Only write pairs where both genomes are in keep_gids.
+
+    Returns
+    -------
+    int
+        Number of genome pairs written to file.
+    """
+
+    # get genomes and producers across all sources
+    gids = set()
+    producers = set()
+    for source in sources:
+        if isinstance(source, BinaryANIStore):
+            gids.update(source.gids())
+            producers.update(source.producers)
+        else:
+            for qid, rid, _ani, _af, producer in source():
+                gids.add(qid)
+                gids.add(rid)
+                producers.add(producer)
+
+    gids = sorted(gids)
+    gid_index = {gid: idx for idx, gid in enumerate(gids)}
+    producers = sorted(producers)
+    producer_index = {producer: idx for idx, producer in enumerate(producers)}
+
+    writer = BinaryCacheWriter(cache_file, gids, producers)
+    try:
+        chunk_sources = []
+        for source in sources:
+            if isinstance(source, BinaryANIStore):
+                index_map = np.array([gid_index[gid] for gid in source.gids()], dtype=np.uint64)
+                producer_map = np.array([producer_index[p] for p in source.producers], dtype=np.uint16)
+                chunk_sources.append(_remapped_chunks(source, index_map, producer_map))
+            else:
+                runs = _SortedRuns(writer.tmp_dir)
+                runs.add_records(source(), gid_index, producer_index)
+                chunk_sources.append(runs.chunks())
+
+        keep_mask = None
+        if keep_producer:
+            keep_mask = np.array([keep_producer(p) for p in producers], dtype=bool)
+
+        gid_mask = None
+        if keep_gids is not None:
+            gid_mask = np.array([gid in keep_gids for gid in gids], dtype=bool)
+
+        for keys, anis, afs, pidxs in merge_sorted_chunks(chunk_sources):
+            keep = None
+            if keep_mask is not None:
+                keep = keep_mask[pidxs]
+
+            if gid_mask is not None:
+                in_q = gid_mask[(keys >> np.uint64(32)).astype(np.int64)]
+                in_r = gid_mask[(keys & np.uint64(0xFFFFFFFF)).astype(np.int64)]
+                gid_keep = (in_q & in_r) if require_both else (in_q | in_r)
+                keep = gid_keep if keep is None else (keep & gid_keep)
+
+            if keep is not None:
+                keys, anis, afs, pidxs = keys[keep], anis[keep], afs[keep], pidxs[keep]
+            writer.add_chunk(keys, anis, afs, pidxs)
+
+        writer.close()
+    except:
+        writer.abort()
+        raise
+
+    return writer.num_pairs
+
+
+class CacheLock(object):
+    """Advisory lock coordinating access to an ANI cache by multiple processes."""
+
+    def __init__(self, cache_file):
+        """Initialization."""
+
+        self.lock_file = f'{cache_file}.lock'
+
+    @contextmanager
+    def acquire(self, exclusive=True):
+        """Acquire exclusive lock for writing, or shared lock for reading."""
+
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class ANICache(object):
+    """Previously calculated ANI and AF values between genome pairs.
+
+    Values can be accessed as a dictionary of dictionaries, cache[qid][rid] -> (ANI, AF),
+    or for a specific genome pair with get(). New values must be recorded with add().
+
+    Each value is recorded along with its producer, which identifies the tool,
+    version and parameters used to calculate it. Only values from the producer
+    associated with the cache, or which predate recording of producers, are
+    returned. Values from other producers are retained on disk.
+
+    The cache can be persisted in a TSV format, which is indexed by query genome,
+    or a binary format which is memory-mapped. In both cases, values are only
+    read from disk as they are needed. Newly calculated values are appended to a journal
+    alongside the main cache file and are periodically compacted into the
+    main cache. The journal is read along with the main cache.
+
+    A cache can be shared by processes running at the same time. Shared caches
+    are locked while being read or written, and compaction merges the values
+    written to disk by all processes.
+    """
+
+    # minimum number of journal records before compacting the cache
+    journal_min_compact = 100000
+
+    # compact cache once the journal exceeds this fraction of the main cache
+    journal_compact_fraction = 0.25
+
+    # number of query genomes to retain compatible values for
+    max_loaded_rows = 1000
+
+    def __init__(self, cache_file, cache_format=None, producer=None, accept_legacy=True, shared=False):
+        """Initialization.
+
+        Parameters
+        ----------
+        cache_file : str
+            File with cached ANI values, or None to only cache values in memory.
+        cache_format : str
+            Format used to write cache, either 'tsv' or 'binary'. If not specified,
+            the format of the existing cache file is used, or TSV for a new cache.
+        producer : str
+            Producer of new values. If not specified, values from all producers
+            are returned and new values are recorded as legacy values.
+        accept_legacy : bool
+            Return values which predate recording of producers.
+        shared : bool
+            Cache may be written by other processes at the same time.
+        """
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.cache_file = cache_file
+        self.journal_file = f'{cache_file}.journal' if cache_file else None
+        self.cache_format = cache_format
+
+        self.producer = producer if producer else LEGACY_PRODUCER
+        self.accept_legacy = accept_legacy
+        self.compatible_producers = {}
+
+        self.base_store = None                      # main cache file
+        self.rows = OrderedDict()                   # compatible values for recently used query genomes
+        self.new_pairs = defaultdict(dict)          # values not yet in the main cache file
+        self.unflushed_pairs = defaultdict(dict)    # values not yet in the journal
+
+        self.main_size = 0
+        self.journal_size = 0
+        self.convert_format = False
+
+        self.lock = CacheLock(cache_file) if cache_file and shared else None
+
+        self.read()
+
+    def _locked(self, exclusive=True):
+        """Lock shared cache."""
+
+        if self.lock:
+            return self.lock.acquire(exclusive)
+
+        return nullcontext()
+
+    def compatible(self, producer):
+        """Check if values from producer are compatible with the producer of new values."""
+
+        is_compatible = self.compatible_producers.get(producer)
+        if is_compatible is None:
+            if self.producer == LEGACY_PRODUCER or producer == self.producer:
+                is_compatible = True
+            elif producer == LEGACY_PRODUCER:
+                is_compatible = self.accept_legacy
+            else:
+                is_compatible = False
+
+            self.compatible_producers[producer] = is_compatible
+
+        return is_compatible
+
+    def read(self):
+        """Read previously calculated ANI values."""
+
+        if not self.cache_file:
+            return
+
+        with self._locked(exclusive=False):
+            self._read()
+
+    def _read(self):
+        """Read main cache file and journal."""
+
+        if os.path.exists(self.cache_file):
+            file_format = cache_file_format(self.cache_file)
+            if self.cache_format is None:
+                self.cache_format = file_format
+            elif self.cache_format != file_format:
+                self.logger.info(f'ANI cache will be converted from {file_format} to {self.cache_format} format.')
+                self.convert_format = True
+
+            self.base_store = open_store(self.cache_file)
+            self.main_size = len(self.base_store)
+            self.logger.info(f'Read {file_format} ANI cache with {self.main_size:,} entries.')
+        elif not os.path.exists(self.journal_file):
+            self.logger.warning(f'ANI cache file does not exist: {self.cache_file}')
+
+        if os.path.exists(self.journal_file):
+            for qid, rid, ani, af, producer in read_tsv_records(self.journal_file):
+                self.new_pairs[qid][rid] = (ani, af, producer)
+                self.journal_size += 1
+
+            self.logger.info(f'Read ANI cache journal with {self.journal_size:,} entries.')
+
+    def _row(self, qid):
+        """Get compatible values for query genome, reading them from disk if necessary."""
+
+        row = self.rows.get(qid)
+        if row is not None:
+            self.rows.move_to_end(qid)
+            return row
+
+        values = {}
+        if self.base_store:
+            values = self.base_store.row(qid)
+        values.update(self.new_pairs.get(qid, {}))
+
+        row = {rid: (ani, af) for rid, (ani, af, producer) in values.items()
+                if self.compatible(producer)}
+
+        self.rows[qid] = row
+        if len(self.rows) > self.max_loaded_rows:
+            self.rows.popitem(last=False)
+
+        return row
+
+    def __contains__(self, qid):
+        """Check if cache contains any values for query genome."""
+
+        return len(self._row(qid)) > 0
+
+    def __getitem__(self, qid):
+        """Get dictionary of (ANI, AF) values for query genome."""
+
+        return self._row(qid)
+
+    def __iter__(self):
+        """Iterate over query genomes with values in cache."""
+
+        qids = set(qid for qid, row in self.rows.items() if row)
+        if self.base_store:
+            qids.update(self.base_store.query_gids())
+        qids.update(self.new_pairs)
+
+        for qid in qids:
+            yield qid
+
+    def get(self, qid, rid):
+        """Get ANI and AF between a pair of genomes, or None if the pair is not in the cache."""
+
+        row = self.rows.get(qid)
+        if row is not None:
+            return row.get(rid)
+
+        value = self.new_pairs.get(qid, {}).get(rid)
+        if value is None and self.base_store:
+            value = self.base_store.get(qid, rid)
+
+        if value is not None and self.compatible(value[2]):
+            return value[0:2]
+
+        return None
+
+    def add(self, qid, rid, ani, af):
+        """Add ANI and AF between a pair of genomes to the cache."""
+
+        if self.get(qid, rid) == (ani, af):
+            return
+
+        self.new_pairs[qid][rid] = (ani, af, self.producer)
+        self.unflushed_pairs[qid][rid] = (ani, af, self.producer)
+        if qid in self.rows:
+            self.rows[qid][rid] = (ani, af)
+
+    def _compaction_required(self):
+        """Check if journal should be compacted into the main cache."""
+
+        if self.convert_format:
+            return True
+
+        return self.journal_size > max(self.journal_min_compact,
+                                        self.journal_compact_fraction * self.main_size)
+
+    def flush(self, silence=False):
+        """Append values calculated since the last flush to the cache journal."""
+
+        if not self.cache_file or not self.unflushed_pairs:
+            return
+
+        with self._locked():
+            num_records = self._append_journal()
+
+        if not silence:
+            self.logger.info(f'Appended {num_records:,} entries to ANI cache journal.')
+
+    def _append_journal(self):
+        """Append unflushed values to journal."""
+
+        num_records = append_journal(self.journal_file, _dict_records(self.unflushed_pairs))
+        self.journal_size += num_records
+        self.unflushed_pairs = defaultdict(dict)
+
+        return num_records
+
+    def _reload(self):
+        """Reload main cache file and journal which may have been written by other processes."""
+
+        if self.base_store:
+            self.base_store.close()
+            self.base_store = None
+
+        self.new_pairs = defaultdict(dict)
+        self.main_size = 0
+        self.journal_size = 0
+        self._read()
+
+    def write(self, silence=False):
+        """Write values calculated since the last write to the cache journal.
+
+        The journal is compacted into the main cache once it becomes large.
+        """
+
+        if not self.cache_file:
+            return
+
+        self.flush(silence)
+
+        if self._compaction_required():
+            self.compact(silence)
+
+    def compact(self, silence=False, keep_producer=None):
+        """Rewrite main cache to include all values in the journal.
+
+        Parameters
+        ----------
+        silence : bool
+            Suppress logging.
+        keep_producer : function
+            Function indicating if values from a producer should be retained.
+        """
+
+        if not self.cache_file:
+            return
+
+        with self._locked():
+            if self.lock:
+                # merge values written by all processes
+                self._append_journal()
+                self._reload()
+            else:
+                # values are already in memory so do not need to be journaled
+                self.unflushed_pairs = defaultdict(dict)
+
+            cache_size = self._compact(keep_producer)
+
+        if not silence:
+            self.logger.info(f'Wrote ANI cache with {cache_size:,} entries.')
+
+    def _compact(self, keep_producer):
+        """Write main cache file with all values in the journal."""
+
+        if self.cache_format == 'binary':
+            sources = []
+            if isinstance(self.base_store, BinaryANIStore):
+                sources.append(self.base_store)
+            elif self.base_store:
+                sources.append(self.base_store.records)
+            sources.append(lambda: _dict_records(self.new_pairs))
+
+            cache_size = write_binary_cache(self.cache_file, sources, keep_producer)
+        else:
+            cache_size = write_tsv_cache(self.cache_file, self._merged_records(keep_producer))
+
+        # journal is only removed once the main cache is
+        # in place so no values are lost if interrupted
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+        if self.base_store:
+            self.base_store.close()
+        self.base_store = open_store(self.cache_file)
+
+        self.new_pairs = defaultdict(dict)
+        self.main_size = cache_size
+        self.journal_size = 0
+        self.convert_format = False
+        if keep_producer:
+            self.rows = OrderedDict()
+
+        return cache_size
+
+    def _merged_records(self, keep_producer=None):
+        """Iterate over records in main cache and journal."""
+
+        if self.base_store:
+            for record in self.base_store.records():
+                qid, rid = record[0:2]
+                if qid in self.new_pairs and rid in self.new_pairs[qid]:
+                    continue
+
+                if keep_producer is None or keep_producer(record[4]):
+                    yield record
+
+        for record in _dict_records(self.new_pairs):
+            if keep_producer is None or keep_producer(record[4]):
+                yield record
+
+
+
+def _dict_records(ani_af):
+    """Iterate over dictionary of (ANI, AF, producer) values as records."""
+
+    for qid, row in ani_af.items():
+        for rid, (ani, af, producer) in row.items():
+            yield qid, rid, ani, af, producer
+
+
+class KeyedANICache(object):
+    """View of an ANI cache keyed by genome ID when cache entries use different keys.
+
+    Supports the dictionary access used by symmetric_ani(), view[gid1][gid2] -> (ANI, AF).
+    """
+
+    def __init__(self, ani_cache, cache_key):
+        """Initialization.
+
+        Parameters
+        ----------
+        ani_cache : ANICache
+            Cache to view.
+        cache_key : function
+            Function giving the cache key of a genome ID.
+        """
+
+        self.ani_cache = ani_cache
+        self.cache_key = cache_key
+
+    def __contains__(self, gid):
+        """Check if cache contains any values for query genome."""
+
+        return self.cache_key(gid) in self.ani_cache
+
+    def __getitem__(self, gid):
+        """Get values for query genome keyed by reference genome ID."""
+
+        return _KeyedRow(self.ani_cache[self.cache_key(gid)], self.cache_key)
+
+
+class _KeyedRow(object):
+    """Values for a query genome keyed by reference genome ID."""
+
+    def __init__(self, row, cache_key):
+        """Initialization."""
+
+        self.row = row
+        self.cache_key = cache_key
+
+    def __contains__(self, gid):
+        """Check if row contains value for reference genome."""
+
+        return self.cache_key(gid) in self.row
+
+    def __getitem__(self, gid):
+        """Get (ANI, AF) for reference genome."""
+
+        return self.row[self.cache_key(gid)]
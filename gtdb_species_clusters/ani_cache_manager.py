@@ -0,0 +1,221 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import sys
+import time
+import logging
+from collections import defaultdict
+
+from gtdb_species_clusters.ani_engine import ani_engine_producer
+from gtdb_species_clusters.ani_cache import (ANICache,
+                                                BinaryANIStore,
+                                                CacheLock,
+                                                LEGACY_PRODUCER,
+                                                cache_file_format,
+                                                read_tsv_records,
+                                                write_binary_cache,
+                                                write_tsv_cache)
+
+
+class ANICacheManager(object):
+    """Inspect and maintain ANI cache files."""
+
+    def __init__(self):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+    def _sources(self, ani_cache_file):
+        """Get sources of values in ANI cache and its journal.
+
+        TSV files are streamed from disk rather than read into memory.
+        """
+
+        sources = []
+        if os.path.exists(ani_cache_file):
+            if cache_file_format(ani_cache_file) == 'binary':
+                sources.append(BinaryANIStore(ani_cache_file))
+            else:
+                sources.append(lambda: read_tsv_records(ani_cache_file))
+
+        journal_file = f'{ani_cache_file}.journal'
+        if os.path.exists(journal_file):
+            sources.append(lambda: read_tsv_records(journal_file))
+
+        return sources
+
+    def _write(self, output_file, sources, output_format, **kwargs):
+        """Write merged ANI values to cache in the specified format."""
+
+        if output_format == 'binary':
+            num_pairs = write_binary_cache(output_file, sources, **kwargs)
+        else:
+            # values are sorted and deduplicated in a binary
+            # cache and then streamed to the TSV file
+            tmp_file = f'{output_file}.binary.tmp'
+            write_binary_cache(tmp_file, sources, **kwargs)
+            store = BinaryANIStore(tmp_file)
+            num_pairs = write_tsv_cache(output_file, store.records())
+            store.close()
+            os.remove(tmp_file)
+
+        return num_pairs
+
+    def merge(self, ani_cache_files, output_file, output_format):
+        """Merge ANI caches, retaining values from later caches for duplicate genome pairs."""
+
+        sources = []
+        for ani_cache_file in ani_cache_files:
+            sources += self._sources(ani_cache_file)
+
+        self.logger.info(f'Merging {len(ani_cache_files):,} ANI caches.')
+        num_pairs = self._write(output_file, sources, output_format)
+        self.logger.info(f'Wrote {num_pairs:,} genome pairs to {output_file}.')
+
+    def compact(self, ani_cache_file, output_format):
+        """Compact ANI cache and its journal into a single cache file."""
+
+        journal_file = f'{ani_cache_file}.journal'
+        with CacheLock(ani_cache_file).acquire():
+            num_pairs = self._write(ani_cache_file, self._sources(ani_cache_file), output_format)
+
+            if os.path.exists(journal_file):
+                os.remove(journal_file)
+
+        self.logger.info(f'Compacted ANI cache to {num_pairs:,} genome pairs in {output_format} format.')
+
+    def subset(self, ani_cache_file, genome_id_file, output_file, require_both, output_format):
+        """Extract values for genome pairs involving the specified genomes."""
+
+        gids = set()
+        with open(genome_id_file) as f:
+            for line in f:
+                line_split = line.strip().split('\t')
+                if line_split[0]:
+                    gids.add(line_split[0])
+        self.logger.info(f'Read {len(gids):,} genome IDs.')
+
+        num_pairs = self._write(output_file,
+                                self._sources(ani_cache_file),
+                                output_format,
+                                keep_gids=gids,
+                                require_both=require_both)
+        self.logger.info(f'Wrote {num_pairs:,} genome pairs to {output_file}.')
+
+    def stats(self, ani_cache_file):
+        """Report statistics for ANI cache."""
+
+        file_format = cache_file_format(ani_cache_file)
+        file_size = os.path.getsize(ani_cache_file)
+
+        if file_format == 'binary':
+            store = BinaryANIStore(ani_cache_file)
+            num_pairs = len(store)
+            num_genomes = store.num_paired_genomes()
+            producer_counts = store.producer_counts()
+            created = store.header['created']
+            store.close()
+        else:
+            num_pairs = 0
+            gids = set()
+            producer_counts = defaultdict(int)
+            for qid, rid, _ani, _af, producer in read_tsv_records(ani_cache_file):
+                num_pairs += 1
+                gids.add(qid)
+                gids.add(rid)
+                producer_counts[producer] += 1
+            num_genomes = len(gids)
+            created = os.path.getmtime(ani_cache_file)
+
+        self.logger.info(f'ANI cache: {ani_cache_file}')
+        self.logger.info(f' - format: {file_format}')
+        self.logger.info(f' - file size: {file_size/1024**2:,.1f} MB')
+        self.logger.info(f' - genome pairs: {num_pairs:,}')
+        self.logger.info(f' - genomes: {num_genomes:,}')
+        self.logger.info(' - last written: {} ({:,.1f} days ago)'.format(
+                            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)),
+                            (time.time() - created) / (24*3600)))
+
+        journal_file = f'{ani_cache_file}.journal'
+        if os.path.exists(journal_file):
+            num_journal = sum(1 for _ in read_tsv_records(journal_file))
+            self.logger.info(f' - journal entries: {num_journal:,} ({os.path.getsize(journal_file)/1024**2:,.1f} MB)')
+
+        self.logger.info(' - values by producer:')
+        for producer, count in sorted(producer_counts.items()):
+            producer_str = producer if producer != LEGACY_PRODUCER else '<unrecorded>'
+            self.logger.info(f'   {producer_str}: {count:,}')
+
+    def upgrade(self, ani_cache_file, purge, purge_legacy, engine='fastani', producer=None):
+        """Report and purge cached values calculated with an incompatible version or parameters of the ANI engine.
+
+        Parameters
+        ----------
+        ani_cache_file : str
+            File with precomputed ANI and AF values.
+        purge : bool
+            Remove values from other producers.
+        purge_legacy : bool
+            Also remove values with no record of their producer.
+        engine : str
+            ANI engine whose values are considered current.
+        producer : str
+            Producer of values considered current, or None to determine this from the ANI engine.
+        """
+
+        if producer is None:
+            producer = ani_engine_producer(engine)
+            if producer is None:
+                self.logger.error('Unable to determine the version of the ANI engine. Specify the producer of current values with --producer.')
+                sys.exit(-1)
+
+        self.logger.info(f'Current producer of ANI values: {producer}')
+
+        # the cache is treated as shared so compaction holds the cache lock
+        ani_cache = ANICache(ani_cache_file,
+                                producer=producer,
+                                accept_legacy=not purge_legacy,
+                                shared=True)
+        if ani_cache.journal_size:
+            ani_cache.compact()
+
+        if not ani_cache.base_store:
+            self.logger.warning('ANI cache is empty.')
+            return
+
+        self.logger.info('Cached values by producer:')
+        num_stale = 0
+        for cur_producer, count in sorted(ani_cache.base_store.producer_counts().items()):
+            if cur_producer == producer:
+                status = 'current'
+            elif cur_producer == LEGACY_PRODUCER:
+                status = 'legacy, accepted' if ani_cache.compatible(cur_producer) else 'legacy, stale'
+            else:
+                status = 'stale'
+
+            if not ani_cache.compatible(cur_producer):
+                num_stale += count
+
+            producer_str = cur_producer if cur_producer != LEGACY_PRODUCER else '<unrecorded>'
+            self.logger.info(f' - {producer_str}: {count:,} ({status})')
+
+        if purge or purge_legacy:
+            self.logger.info(f'Purging {num_stale:,} stale values from ANI cache.')
+            ani_cache.compact(keep_producer=ani_cache.compatible)
+        elif num_stale:
+            self.logger.info(f'Identified {num_stale:,} stale values which will be ignored. Use --purge to remove these values.')
@@ -0,0 +1,1003 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import sys
+import json
+import math
+import time
+import heapq
+import queue
+import ntpath
+import logging
+import multiprocessing as mp
+from itertools import permutations, product
+from collections import defaultdict
+
+from gtdb_species_clusters.genome_utils import canonical_gid
+from gtdb_species_clusters.ani_cache import ANICache, KeyedANICache, round_ani, round_af
+from gtdb_species_clusters.genome_fingerprint import GenomeFingerprints
+from gtdb_species_clusters.ani_queue import ANITaskQueue
+from gtdb_species_clusters.type_genome_utils import symmetric_ani
+
+
+ANI_ENGINES = ('fastani', 'numpy')
+
+
+def create_ani_engine(ani_cache_file, cpus, engine='fastani', **engine_args):
+    """Create engine for calculating ANI between genomes.
+    
+    Parameters
+    ----------
+    ani_cache_file : str
+        File with precomputed ANI and AF values.
+    cpus : int
+        Number of CPUs to use.
+    engine : str
+        Name of ANI engine.
+    engine_args : dict
+        Options of the engine, as described by ANIEngine.
+    """
+    
+    return ani_engine_class(engine)(ani_cache_file, cpus, **engine_args)
+
+
+def ani_engine_class(engine='fastani'):
+    """Get class implementing an ANI engine.
+    
+    Parameters
+    ----------
+    engine : str
+        Name of ANI engine.
+    """
+    
+    if engine == 'fastani':
+        from gtdb_species_clusters.fastani import FastANI
+        return FastANI
+    elif engine == 'numpy':
+        from gtdb_species_clusters.kmer_ani import KmerANI
+        return KmerANI
+        
+    raise ValueError(f'Unknown ANI engine: {engine}')
+
+
+def ani_engine_producer(engine='fastani'):
+    """Get string identifying the producer of values calculated by an ANI engine.
+    
+    The engine is not created, so no worker processes are started.
+    
+    Parameters
+    ----------
+    engine : str
+        Name of ANI engine.
+        
+    Returns
+    -------
+    str
+        Producer of values, or None if the version of the engine cannot be determined.
+    """
+    
+    return ani_engine_class(engine).current_producer()
+
+
+class ANIEngine(object):
+    """Calculate average nucleotide identity between genomes using a precomputed cache where possible.
+    
+    Engines implement the calculation of ANI and AF between a batch of query
+    and reference genomes. All other functionality, including use of the ANI 
+    cache and scheduling of work, is shared by all engines.
+    
+    A pool of worker processes is started the first time ANI values need to be
+    calculated and is reused by all subsequent calls. The pool is stopped by 
+    close(), when used as a context manager, or when the object is destroyed.
+    """
+    
+    # calculated values are checkpointed to the ANI cache journal after 
+    # this many genome pairs or seconds so they survive a failed run
+    checkpoint_pairs = 10000
+    checkpoint_interval = 300
+    
+    # accept cached values that predate recording of the 
+    # tool version and parameters used to calculate them
+    accept_legacy_cache = True
+    
+    # CPU time to compare 1 Mbp of genomic sequence used to estimate
+    # the cost of calculations when no calibration is available
+    default_cpu_seconds_per_mbp = 0.15
+    
+    # minimum number of genome pairs required to calibrate the cost of calculations
+    min_calibration_pairs = 1000
+
+    def __init__(self, 
+                    ani_cache_file, 
+                    cpus,
+                    cache_format=None,
+                    fingerprint_keys=False,
+                    shared_cache=False,
+                    queue_dir=None,
+                    planner=None,
+                    staging=None):
+        """Initialization.
+        
+        Engines must set any attributes required to determine the
+        producer of ANI values before calling this method.
+        
+        Parameters
+        ----------
+        ani_cache_file : str
+            File with precomputed ANI and AF values.
+        cpus : int
+            Number of CPUs to use.
+        cache_format : str
+            Format used to write the ANI cache, or None to retain the format of the existing cache.
+        fingerprint_keys : boolean
+            Key cache entries by a fingerprint of the genomic file instead of the genome ID.
+        shared_cache : boolean
+            ANI cache may be written by other processes at the same time.
+        queue_dir : str
+            Shared directory used to distribute calculations to workers started 
+            with the ani_worker command, or None to calculate ANI locally.
+        planner : ANIPlanner
+            Planner recording genome pairs instead of calculating ANI during a dry run.
+        staging : GenomeStaging
+            Staging area for genomic files in local scratch space, or None to disable staging.
+        """
+        
+        # worker processes are started on first use and
+        # reused by all subsequent calculations
+        self._workers = []
+        self._task_queue = None
+        self._result_queue = None
+        
+        # batches submitted to workers which have not been collected, along
+        # with the genome pairs they contain so pairs are only submitted once
+        self._next_task_id = 0
+        self._inflight_batches = {}
+        self._inflight_pairs = {}
+        
+        # calculated values not yet checkpointed to the ANI cache journal
+        self._unflushed = 0
+        self._last_flush = time.time()
+        
+        self.cpus = cpus
+        
+        # maximum number of genomes to process against a 
+        # single query or reference genome in one batch
+        self.max_batch_size = 1000
+
+        self.logger = logging.getLogger('timestamp')
+        
+        self.cache_format = cache_format
+        self.shared_cache = shared_cache
+        self.queue_dir = queue_dir
+        self.planner = planner
+        
+        # genomic files are staged to local scratch space if enabled
+        self.staging = staging
+        
+        # tool, version and parameters used to calculate ANI values
+        self.producer = self._get_producer()
+        
+        # batches are processed by distributed workers if a task queue is specified
+        self.task_queue = None
+        if self.queue_dir:
+            self.task_queue = ANITaskQueue(self.queue_dir, self.producer)
+        
+        self.fingerprints = None
+        self._file_keys = {}
+        
+        self.ani_cache_file = ani_cache_file
+        self._read_cache()
+        
+        if fingerprint_keys:
+            fingerprint_file = f'{ani_cache_file}.fingerprints' if ani_cache_file else None
+            self.fingerprints = GenomeFingerprints(fingerprint_file)
+            
+        if self.planner:
+            self.planner.set_cost(*self._calibrated_cost())
+
+    def __del__(self):
+        """Destructor."""
+        
+        # engine is only partially initialized if creating it failed, 
+        # such as when a dependency of the engine is not available
+        if getattr(self, 'ani_cache', None) is None:
+            return
+            
+        self.close()
+        self.write_cache()
+
+    @classmethod
+    def current_producer(cls):
+        """Get string identifying the producer of new values without creating the engine, or None if it cannot be determined."""
+        
+        raise NotImplementedError
+
+    def _get_producer(self):
+        """Get string identifying the engine, version and parameters used to calculate ANI values."""
+        
+        raise NotImplementedError
+        
+    def _calculate_batch(self, q_files, r_files):
+        """Calculate ANI between all query and reference genomic files.
+        
+        Parameters
+        ----------
+        q_files : list
+            Path to genomic FASTA file of each query genome.
+        r_files : list
+            Path to genomic FASTA file of each reference genome.
+            
+        Returns
+        -------
+        array, array
+            ANI and AF between each query and reference genome, 
+            ordered by query and then reference genome.
+        """
+        
+        raise NotImplementedError
+
+    def _read_cache(self):
+        """Read previously calculated ANI values."""
+        
+        self.ani_cache = ANICache(self.ani_cache_file, 
+                                    self.cache_format,
+                                    self.producer,
+                                    self.accept_legacy_cache,
+                                    self.shared_cache)
+
+    def write_cache(self, silence=False):
+        """Write cache to file."""
+        
+        if self.planner:
+            # cache is left unchanged by a dry run
+            return
+            
+        self.ani_cache.write(silence)
+        
+        if self.fingerprints:
+            self.fingerprints.write()
+
+    def _calibration_file(self):
+        """Get file recording the measured cost of calculating ANI with each producer."""
+        
+        if not self.ani_cache_file:
+            return None
+            
+        return f'{self.ani_cache_file}.calibration'
+        
+    def _calibrated_cost(self):
+        """Get CPU time to compare 1 Mbp of genomic sequence, along with how it was determined."""
+        
+        calibration_file = self._calibration_file()
+        if calibration_file and os.path.exists(calibration_file):
+            with open(calibration_file) as f:
+                calibration = json.load(f)
+                
+            if self.producer in calibration:
+                cost = calibration[self.producer]
+                return (cost['cpu_seconds_per_mbp'], 
+                        'calibrated from {:,} genome pairs calculated by {}'.format(cost['pairs'], self.producer))
+                
+        return self.default_cpu_seconds_per_mbp, 'default cost, no calibration available'
+        
+    def _record_calibration(self, num_pairs, costs, num_workers, elapsed):
+        """Record measured cost of calculating ANI for planning future runs."""
+        
+        calibration_file = self._calibration_file()
+        if not calibration_file or num_pairs < self.min_calibration_pairs:
+            return
+            
+        calibration = {}
+        if os.path.exists(calibration_file):
+            with open(calibration_file) as f:
+                calibration = json.load(f)
+                
+        calibration[self.producer] = {'cpu_seconds_per_mbp': elapsed * num_workers / (sum(costs) / 1e6),
+                                        'pairs': num_pairs}
+        
+        tmp_file = f'{calibration_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(calibration, fout, indent=2)
+        os.replace(tmp_file, calibration_file)
+        
+    def set_genome_genera(self, genera):
+        """Set genus of genomes, used to summarize the planned workload of a dry run."""
+        
+        if self.planner:
+            self.planner.genera.update(genera)
+
+    def _get_genome_id(self, genome_path):
+        """Extract genome ID from path to genomic file."""
+        
+        genome_id = ntpath.basename(genome_path)
+        if genome_id.startswith('GCA_') or genome_id.startswith('GCF_'):
+            genome_id = '_'.join(genome_id.split('_')[0:2])
+            if genome_id.startswith('GCA_'):
+                genome_id = 'GB_' + genome_id
+            else:
+                genome_id = 'RS_' + genome_id
+        else:
+            genome_id = '_'.join(genome_id.split('_')[0:2])
+            
+        return canonical_gid(genome_id)
+
+    def cache_key(self, gid, genome_file):
+        """Get key of genome in ANI cache.
+        
+        This is the genome ID, or a fingerprint of the genomic 
+        file if the cache is keyed by genome fingerprints.
+        """
+        
+        if not self.fingerprints:
+            return gid
+            
+        key = self._file_keys.get(genome_file)
+        if key is None:
+            key = self.fingerprints.fingerprint(genome_file)
+            self._file_keys[genome_file] = key
+            
+        return key
+
+    def cache_view(self, genome_files):
+        """Get ANI cache indexed by genome ID, view[gid1][gid2] -> (ANI, AF)."""
+        
+        if not self.fingerprints:
+            return self.ani_cache
+            
+        return KeyedANICache(self.ani_cache, 
+                                lambda gid: self.cache_key(gid, genome_files[gid]))
+
+    def fastani(self, qid, rid, q_gf, r_gf):
+        """Calculate ANI between a pair of genomes."""
+
+        # check cache
+        cached = self.ani_cache.get(self.cache_key(qid, q_gf), 
+                                    self.cache_key(rid, r_gf))
+        if cached is not None:
+            return (qid, rid) + tuple(cached)
+            
+        if self.planner:
+            self.planner.add([(qid, rid)], 
+                                [(qid, rid)],
+                                self._genome_sizes([qid, rid], {qid: q_gf, rid: r_gf}, None))
+            return (qid, rid, 0.0, 0.0)
+            
+        if self.staging:
+            staged_files = self.staging.stage_files([q_gf, r_gf])
+            q_gf = staged_files[q_gf]
+            r_gf = staged_files[r_gf]
+            
+        anis, afs = self._calculate_batch([q_gf], [r_gf])
+
+        return (qid, rid, round_ani(anis[0]), round_af(afs[0]))
+
+    def fastani_batch(self, qids, rids, genome_files):
+        """Calculate ANI between all query and reference genomes as a single batch.
+        
+        Parameters
+        ----------
+        qids : list
+            Query genome IDs.
+        rids : list
+            Reference genome IDs.
+        genome_files : dict
+            Path to genomic FASTA file for each genome.
+            
+        Returns
+        -------
+        list
+            Tuple (qid, rid, ANI, AF) for each query and reference pair.
+        """
+        
+        anis, afs = self._calculate_batch([genome_files[qid] for qid in qids],
+                                            [genome_files[rid] for rid in rids])
+        
+        ani_af = []
+        for idx, (qid, rid) in enumerate(product(qids, rids)):
+            ani_af.append((qid, rid, round_ani(anis[idx]), round_af(afs[idx])))
+                
+        return ani_af
+
+    def _genome_sizes(self, gids, genome_files, genome_sizes):
+        """Get size of genomes used to estimate the cost of calculating ANI.
+        
+        The size of the genomic file is used for genomes without a specified size.
+        """
+        
+        sizes = {}
+        for gid in gids:
+            size = genome_sizes.get(gid) if genome_sizes else None
+            if not size:
+                try:
+                    size = os.path.getsize(genome_files[gid])
+                except OSError:
+                    size = 1
+            sizes[gid] = max(1, size)
+            
+        return sizes
+
+    @staticmethod
+    def _batch_cost(qids, rids, sizes):
+        """Estimated cost of calculating ANI between query and reference genomes.
+        
+        The cost of each genome pair is taken as the combined size of the genomes.
+        """
+        
+        return (len(rids) * sum(sizes[qid] for qid in qids) 
+                + len(qids) * sum(sizes[rid] for rid in rids))
+
+    @staticmethod
+    def _makespan(costs, cpus):
+        """Simulated time to process batches in the given order using a pool of workers.
+        
+        Batches are assigned to the first available worker and take time 
+        proportional to their estimated cost. This is a model of the schedule,
+        not a measurement, as each ordering would otherwise need to be run.
+        """
+        
+        workers = [0] * min(cpus, max(1, len(costs)))
+        for cost in costs:
+            heapq.heapreplace(workers, workers[0] + cost)
+            
+        return max(workers)
+
+    def _split_group(self, gids, other_gids, sizes, max_cost):
+        """Split genomes into batches with an estimated cost below the specified maximum."""
+        
+        other_size = sum(sizes[gid] for gid in other_gids)
+        
+        batches = []
+        cur_batch = []
+        cur_cost = 0
+        for gid in gids:
+            cost = len(other_gids) * sizes[gid] + other_size
+            if cur_batch and (cur_cost + cost > max_cost 
+                                or len(cur_batch) >= self.max_batch_size):
+                batches.append(cur_batch)
+                cur_batch = []
+                cur_cost = 0
+                
+            cur_batch.append(gid)
+            cur_cost += cost
+            
+        if cur_batch:
+            batches.append(cur_batch)
+            
+        return batches
+
+    def _group_pairs(self, gid_pairs, sizes):
+        """Group genome pairs into batches that can each be processed as a single batch.
+        
+        Pairs are greedily assigned to the genome involved in the largest number
+        of unassigned pairs, either as the query (one query vs. many references) or 
+        as the reference (many queries vs. one reference). Large groups are split
+        so there is sufficient work to keep all CPUs busy, with the size of each
+        batch determined by the estimated cost of the genome pairs it contains.
+        """
+
+        pairs_by_qid = defaultdict(set)
+        pairs_by_rid = defaultdict(set)
+        for qid, rid in gid_pairs:
+            pairs_by_qid[qid].add(rid)
+            pairs_by_rid[rid].add(qid)
+            
+        heap = [(-len(rids), 0, qid) for qid, rids in pairs_by_qid.items()]
+        heap += [(-len(qids), 1, rid) for rid, qids in pairs_by_rid.items()]
+        heapq.heapify(heap)
+        
+        groups = []
+        while heap:
+            neg_count, is_ref, gid = heapq.heappop(heap)
+            
+            if is_ref:
+                cur_count = len(pairs_by_rid[gid])
+            else:
+                cur_count = len(pairs_by_qid[gid])
+                
+            if cur_count == 0:
+                continue
+                
+            if cur_count != -neg_count:
+                # count is stale so reinsert with updated count
+                heapq.heappush(heap, (-cur_count, is_ref, gid))
+                continue
+                
+            if is_ref:
+                qids = sorted(pairs_by_rid.pop(gid))
+                for qid in qids:
+                    pairs_by_qid[qid].discard(gid)
+                groups.append((qids, [gid]))
+            else:
+                rids = sorted(pairs_by_qid.pop(gid))
+                for rid in rids:
+                    pairs_by_rid[rid].discard(gid)
+                groups.append(([gid], rids))
+                
+        # split large groups into batches
+        total_cost = sum(self._batch_cost(qids, rids, sizes) for qids, rids in groups)
+        max_cost = max(1, int(math.ceil(float(total_cost) / (self.cpus * 4))))
+        batches = []
+        for qids, rids in groups:
+            if len(qids) == 1:
+                for batch_rids in self._split_group(rids, qids, sizes, max_cost):
+                    batches.append((qids, batch_rids))
+            else:
+                for batch_qids in self._split_group(qids, rids, sizes, max_cost):
+                    batches.append((batch_qids, rids))
+            
+        return batches
+
+    def _worker(self, queue_in, queue_out):
+        """Process batches of genome pairs until signalled to stop."""
+
+        try:
+            while True:
+                task = queue_in.get(block=True, timeout=None)
+                if task is None:
+                    break
+                    
+                # results are returned as compact arrays of values, with
+                # genome pairs identified by their position in the batch
+                task_id, q_files, r_files = task
+                anis, afs = self._calculate_batch(q_files, r_files)
+
+                queue_out.put((task_id, anis, afs))
+        finally:
+            self._release_worker()
+            
+    def _release_worker(self):
+        """Release any resources held by a worker process."""
+        
+        pass
+
+    def _start_workers(self):
+        """Start pool of worker processes if it is not already running."""
+        
+        if self._workers:
+            return
+            
+        self._task_queue = mp.Queue()
+        self._result_queue = mp.Queue()
+        self._workers = [mp.Process(target=self._worker, 
+                                    args=(self._task_queue, self._result_queue),
+                                    daemon=True) for _ in range(self.cpus)]
+        for p in self._workers:
+            p.start()
+
+    def close(self):
+        """Stop pool of worker processes."""
+        
+        if getattr(self, 'staging', None):
+            self.staging.report('ANI calculation')
+            
+        if getattr(self, 'task_queue', None):
+            self.task_queue.cancel()
+            
+        if not self._workers:
+            return
+            
+        try:
+            for _ in self._workers:
+                self._task_queue.put(None)
+                
+            for p in self._workers:
+                p.join(timeout=10)
+                if p.is_alive():
+                    p.terminate()
+        finally:
+            self._workers = []
+            self._task_queue = None
+            self._result_queue = None
+            self._inflight_batches = {}
+            self._inflight_pairs = {}
+
+    def __enter__(self):
+        """Enter context manager."""
+        
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Exit context manager, stopping worker processes and writing the cache."""
+        
+        self.close()
+        self.write_cache()
+
+    def _submit(self, task_id, q_files, r_files):
+        """Submit batch of genome pairs to worker processes."""
+        
+        if self.task_queue:
+            self.task_queue.submit(task_id, q_files, r_files)
+        else:
+            self._task_queue.put((task_id, q_files, r_files))
+
+    def _next_result(self):
+        """Get next completed batch from worker processes."""
+        
+        if self.task_queue:
+            return self.task_queue.next_result()
+            
+        while True:
+            try:
+                return self._result_queue.get(block=True, timeout=60)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._workers):
+                    self.close()
+                    self.logger.error('ANI worker process terminated unexpectedly.')
+                    sys.exit(-1)
+
+    def _pair_key(self, qid, rid, genome_files):
+        """Get key of genome pair in ANI cache."""
+        
+        return (self.cache_key(qid, genome_files[qid]), 
+                self.cache_key(rid, genome_files[rid]))
+
+    def _dispatch(self, gid_pairs, genome_files, sizes):
+        """Submit genome pairs to worker processes as batches without waiting for results.
+        
+        Batches are submitted in order of decreasing estimated cost so large genomes
+        do not leave a single worker busy once all other work is done.
+        
+        Returns
+        -------
+        list
+            Task ID of each batch, in the order submitted.
+        list
+            Estimated cost of each batch.
+        float
+            Simulated speedup from submitting batches in order of decreasing cost.
+        """
+        
+        if not self.task_queue:
+            self._start_workers()
+        
+        batches = self._group_pairs(gid_pairs, sizes)
+        costs = [self._batch_cost(qids, rids, sizes) for qids, rids in batches]
+        input_makespan = self._makespan(costs, self.cpus)
+        
+        order = sorted(range(len(batches)), key=lambda idx: costs[idx], reverse=True)
+        batches = [batches[idx] for idx in order]
+        costs = [costs[idx] for idx in order]
+        scheduled_makespan = self._makespan(costs, self.cpus)
+        
+        task_files = genome_files
+        if self.staging and not self.task_queue:
+            # distributed workers stage genomic files to their own scratch space
+            staged_files = self.staging.stage_files(genome_files[gid] for gid in sizes)
+            task_files = {gid: staged_files[genome_files[gid]] for gid in sizes}
+            
+        task_ids = []
+        for qids, rids in batches:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            
+            self._submit(task_id, 
+                            [task_files[qid] for qid in qids], 
+                            [task_files[rid] for rid in rids])
+                            
+            self._inflight_batches[task_id] = (qids, rids, genome_files)
+            for qid, rid in product(qids, rids):
+                self._inflight_pairs[self._pair_key(qid, rid, genome_files)] = task_id
+                
+            task_ids.append(task_id)
+            
+        if self.task_queue:
+            self.logger.info(f'Submitted {len(batches):,} batches of genome pairs to ANI task queue in {self.queue_dir}.')
+            
+        return task_ids, costs, float(input_makespan) / scheduled_makespan
+
+    def _collect(self):
+        """Wait for next completed batch and add its values to the ANI cache.
+        
+        Returns
+        -------
+        int
+            Task ID of batch.
+        list
+            Tuple (qid, rid, ANI, AF) for each genome pair in batch.
+        """
+        
+        task_id, anis, afs = self._next_result()
+        qids, rids, genome_files = self._inflight_batches.pop(task_id)
+        
+        results = []
+        for idx, (qid, rid) in enumerate(product(qids, rids)):
+            ani = round_ani(anis[idx])
+            af = round_af(afs[idx])
+            
+            pair_key = self._pair_key(qid, rid, genome_files)
+            self.ani_cache.add(pair_key[0], pair_key[1], ani, af)
+            if self._inflight_pairs.get(pair_key) == task_id:
+                del self._inflight_pairs[pair_key]
+                
+            results.append((qid, rid, ani, af))
+            
+        self._unflushed += len(results)
+        if (self._unflushed >= self.checkpoint_pairs 
+                or time.time() - self._last_flush >= self.checkpoint_interval):
+            self.ani_cache.flush(silence=True)
+            self._unflushed = 0
+            self._last_flush = time.time()
+            
+        return task_id, results
+
+    def prefetch(self, gid_pairs, genome_files, genome_sizes=None):
+        """Start calculating ANI between genome pairs without waiting for the results.
+        
+        Values are added to the ANI cache as completed batches are collected by
+        later calls to pairs(), which wait for any requested genome pairs that are 
+        still being calculated rather than submitting them again. This allows ANI 
+        to be calculated in the background while the caller does other work.
+        
+        Parameters
+        ----------
+        gid_pairs : list
+            Genome pairs (qid, rid) to calculate ANI between.
+        genome_files : dict
+            Path to genomic FASTA file for each genome.
+        genome_sizes : dict
+            Size of each genome used to schedule the most expensive genome pairs first.
+        """
+        
+        if not gid_pairs or self.planner:
+            return
+            
+        _ani_af, pending_pairs = self._cached_pairs(gid_pairs, genome_files)
+        pending_pairs = set(pair for pair in pending_pairs
+                                if self._pair_key(pair[0], pair[1], genome_files) not in self._inflight_pairs)
+        if not pending_pairs:
+            return
+            
+        sizes = self._genome_sizes(set(gid for pair in pending_pairs for gid in pair),
+                                    genome_files,
+                                    genome_sizes)
+        self._dispatch(pending_pairs, genome_files, sizes)
+
+    def _cached_pairs(self, gid_pairs, genome_files):
+        """Get ANI results for genome pairs in cache, along with pairs requiring calculation."""
+        
+        ani_af = defaultdict(dict)
+        pending_pairs = set()
+        for qid, rid in gid_pairs:
+            cached = self.ani_cache.get(self.cache_key(qid, genome_files[qid]), 
+                                        self.cache_key(rid, genome_files[rid]))
+            if cached is not None:
+                ani_af[qid][rid] = cached
+            else:
+                pending_pairs.add((qid, rid))
+                
+        return ani_af, pending_pairs
+
+    def _calculate_pairs(self, gid_pairs, genome_files, genome_sizes, report_progress):
+        """Calculate ANI between genome pairs in parallel, using the cache where possible.
+        
+        Genome pairs already submitted by prefetch() are not submitted again, and
+        their values are taken from the ANI cache once their batches complete.
+        """
+        
+        ani_af, pending_pairs = self._cached_pairs(gid_pairs, genome_files)
+        
+        sizes = self._genome_sizes(set(gid for pair in pending_pairs for gid in pair),
+                                    genome_files,
+                                    genome_sizes)
+        
+        if self.planner:
+            # genome pairs are recorded and treated as unrelated
+            self.planner.add(gid_pairs, pending_pairs, sizes)
+            for qid, rid in pending_pairs:
+                ani_af[qid][rid] = (0.0, 0.0)
+            return dict(ani_af)
+            
+        if not pending_pairs:
+            return dict(ani_af)
+            
+        inflight_pairs = {}
+        for qid, rid in pending_pairs:
+            pair_key = self._pair_key(qid, rid, genome_files)
+            if pair_key in self._inflight_pairs:
+                inflight_pairs[(qid, rid)] = pair_key
+                
+        start_time = time.time()
+        new_pairs = pending_pairs.difference(inflight_pairs)
+        task_ids = []
+        costs = []
+        speedup = 1.0
+        if new_pairs:
+            task_ids, costs, speedup = self._dispatch(new_pairs, genome_files, sizes)
+            
+        own_tasks = set(task_ids)
+        waiting_tasks = set(task_ids)
+        waiting_tasks.update(self._inflight_pairs[pair_key] for pair_key in inflight_pairs.values())
+        
+        # batches submitted by prefetch() are collected as they complete, and 
+        # calibration is skipped if they were processed alongside these batches
+        prefetched_batches = 0
+        processed = 0
+        while waiting_tasks:
+            task_id, results = self._collect()
+            waiting_tasks.discard(task_id)
+            
+            for qid, rid, ani, af in results:
+                if (qid, rid) in pending_pairs:
+                    ani_af[qid][rid] = (ani, af)
+                    
+            if task_id not in own_tasks:
+                prefetched_batches += 1
+                continue
+                    
+            if report_progress:
+                processed += len(results)
+                statusStr = '-> Processing {:,} of {:,} ({:.2f}%) genome pairs.'.format(
+                                    processed, 
+                                    len(new_pairs), 
+                                    float(processed*100)/len(new_pairs)).ljust(86)
+                sys.stdout.write('%s\r' % statusStr)
+                sys.stdout.flush()
+                
+        # values of pairs calculated by prefetch() under 
+        # another genome ID are read from the cache
+        for (qid, rid), pair_key in inflight_pairs.items():
+            if rid not in ani_af.get(qid, {}):
+                ani_af[qid][rid] = self.ani_cache.get(*pair_key)
+                
+        if report_progress:
+            sys.stdout.write('\n')
+            
+            elapsed = max(time.time() - start_time, 1e-6)
+            self.logger.info('Calculated ANI for {:,} genome pairs in {:,.1f}s ({:,.1f} pairs/s, {:,.1f} Mbp compared/s).'.format(
+                                len(pending_pairs),
+                                elapsed,
+                                len(pending_pairs) / elapsed,
+                                sum(costs) / 1e6 / elapsed))
+            self.logger.info(' - simulated speedup from largest-first scheduling of {:,} batches: {:.2f}x (from estimated batch costs, not measured)'.format(
+                                len(task_ids),
+                                speedup))
+            
+            if task_ids and not prefetched_batches:
+                self._record_calibration(len(pending_pairs), 
+                                            costs, 
+                                            min(self.cpus, len(task_ids)), 
+                                            elapsed)
+            
+        self.ani_cache.flush(silence=True)
+                
+        return dict(ani_af)
+
+    def pairwise(self, gids, genome_files, check_cache=False, genome_sizes=None):
+        """Calculate ANI between all genome pairs in parallel."""
+        
+        if not gids:
+            return {}
+            
+        return self._calculate_pairs(list(permutations(gids, 2)), 
+                                        genome_files, 
+                                        genome_sizes,
+                                        report_progress=False)
+
+    def pairs(self, gid_pairs, genome_files, report_progress=True, check_cache=False, genome_sizes=None):
+        """Calculate ANI between specified genome pairs in parallel.
+        
+        Pairs are grouped by query or reference genome so each group can be
+        processed as a single batch. Previously calculated values are 
+        always taken from the ANI cache.
+        
+        Parameters
+        ----------
+        gid_pairs : list
+            Genome pairs (qid, rid) to process.
+        genome_files : dict
+            Path to genomic FASTA file for each genome.
+        report_progress : bool
+            Report progress and throughput of calculation.
+        check_cache : bool
+            Unused. Retained for backwards compatibility.
+        genome_sizes : dict
+            Size of each genome used to schedule the most expensive genome
+            pairs first. The size of the genomic file is used if not specified.
+        """
+        
+        if not gid_pairs:
+            return {}
+            
+        return self._calculate_pairs(gid_pairs, 
+                                        genome_files, 
+                                        genome_sizes,
+                                        report_progress)
+
+    def symmetric_pairs(self, gid_pairs, genome_files, min_ani, min_af=0.0, report_progress=True, genome_sizes=None):
+        """Calculate ANI in both directions between genome pairs, skipping the reverse direction when not required.
+        
+        Symmetric ANI and AF are the maximum of the values in each direction, so if the
+        first direction meets both thresholds the reverse direction cannot change whether
+        a pair meets the thresholds. The reverse direction is only calculated for pairs 
+        failing either threshold, or taken from the ANI cache if it is available.
+        
+        Parameters
+        ----------
+        gid_pairs : list
+            Genome pairs (gid1, gid2), where gid1 is used as the query genome in the first direction.
+        genome_files : dict
+            Path to genomic FASTA file for each genome.
+        min_ani : float
+            ANI threshold.
+        min_af : float
+            AF threshold.
+        report_progress : bool
+            Report progress and throughput of calculation.
+        genome_sizes : dict
+            Size of each genome used to schedule calculations.
+            
+        Returns
+        -------
+        dict
+            ANI and AF between genomes, ani_af[qid][rid] -> (ANI, AF), with values
+            omitted for the reverse direction of pairs meeting both thresholds.
+        """
+        
+        fwd_pairs = []
+        seen = set()
+        for gid1, gid2 in gid_pairs:
+            if (gid1, gid2) not in seen and (gid2, gid1) not in seen:
+                seen.add((gid1, gid2))
+                fwd_pairs.append((gid1, gid2))
+        
+        ani_af = defaultdict(dict, self.pairs(fwd_pairs, 
+                                                genome_files, 
+                                                report_progress=report_progress, 
+                                                genome_sizes=genome_sizes))
+        
+        rev_pairs = []
+        num_skipped = 0
+        for gid1, gid2 in fwd_pairs:
+            ani, af = ani_af[gid1][gid2]
+            if ani >= min_ani and af >= min_af:
+                cached = self.ani_cache.get(self.cache_key(gid2, genome_files[gid2]), 
+                                            self.cache_key(gid1, genome_files[gid1]))
+                if cached is not None:
+                    ani_af[gid2][gid1] = cached
+                else:
+                    num_skipped += 1
+            else:
+                rev_pairs.append((gid2, gid1))
+                
+        if report_progress:
+            self.logger.info(f'Calculation of the reverse direction was not required for {num_skipped:,} of {len(fwd_pairs):,} genome pairs.')
+            
+        rev_ani_af = self.pairs(rev_pairs, 
+                                genome_files, 
+                                report_progress=report_progress, 
+                                genome_sizes=genome_sizes)
+        for qid, rids in rev_ani_af.items():
+            ani_af[qid].update(rids)
+            
+        return dict(ani_af)
+
+    def symmetric_ani_cached(self, gid1, gid2, genome_file1, genome_file2):
+        """Calculate symmetric ANI and AF between two genomes."""
+        
+        ani_af12 = self.fastani(gid1, gid2, genome_file1, genome_file2)
+        ani_af21 = self.fastani(gid2, gid1, genome_file2, genome_file1)
+        
+        if self.planner:
+            return symmetric_ani({gid1: {gid2: ani_af12[2:]}, gid2: {gid1: ani_af21[2:]}}, gid1, gid2)
+
+        key1 = self.cache_key(gid1, genome_file1)
+        key2 = self.cache_key(gid2, genome_file2)
+        self.ani_cache.add(key1, key2, *ani_af12[2:])
+        self.ani_cache.add(key2, key1, *ani_af21[2:])
+        
+        return symmetric_ani(self.ani_cache, key1, key2)
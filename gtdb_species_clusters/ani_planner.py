@@ -0,0 +1,117 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import logging
+from collections import defaultdict
+
+
+class ANIPlanner(object):
+    """Plan the ANI workload of a pipeline without calculating ANI.
+
+    Genome pairs requested from an ANI engine during a dry run are recorded
+    instead of being calculated. The workload is reported as the number of
+    genome pairs requested, the number already in the ANI cache, and the
+    estimated CPU-hours required to calculate the remaining pairs.
+    """
+
+    def __init__(self, cpus, num_genera=10):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.cpus = cpus
+        self.num_genera = num_genera
+
+        self.requested = set()
+        self.pending = set()
+        self.sizes = {}
+        self.genera = {}
+
+        # CPU time to compare 1 Mbp of genomic sequence, and how it was determined
+        self.cpu_seconds_per_mbp = None
+        self.cost_source = None
+
+    def set_cost(self, cpu_seconds_per_mbp, cost_source):
+        """Set cost of calculating ANI used to estimate CPU time."""
+
+        self.cpu_seconds_per_mbp = cpu_seconds_per_mbp
+        self.cost_source = cost_source
+
+    def add(self, gid_pairs, pending_pairs, sizes):
+        """Record requested genome pairs and pairs requiring calculation.
+
+        Parameters
+        ----------
+        gid_pairs : iterable
+            Genome pairs (qid, rid) requested.
+        pending_pairs : set
+            Requested genome pairs not in the ANI cache.
+        sizes : dict
+            Size of genomes in pending pairs.
+        """
+
+        self.requested.update(gid_pairs)
+        self.pending.update(pending_pairs)
+        self.sizes.update(sizes)
+
+    def pair_cpu_hours(self, qid, rid):
+        """Estimated CPU-hours to calculate ANI for a genome pair."""
+
+        mbp = (self.sizes[qid] + self.sizes[rid]) / 1e6
+        return mbp * self.cpu_seconds_per_mbp / 3600.0
+
+    def report(self):
+        """Report planned ANI workload."""
+
+        num_requested = len(self.requested)
+        num_cached = num_requested - len(self.pending)
+
+        cpu_hours = 0.0
+        genus_pairs = defaultdict(int)
+        genus_cpu_hours = defaultdict(float)
+        for qid, rid in self.pending:
+            pair_cpu_hours = self.pair_cpu_hours(qid, rid)
+            cpu_hours += pair_cpu_hours
+
+            genus = self.genera.get(qid, 'g__')
+            genus_pairs[genus] += 1
+            genus_cpu_hours[genus] += pair_cpu_hours
+
+        self.logger.info('Planned ANI workload:')
+        self.logger.info(' - genome pairs requested: {:,}'.format(num_requested))
+        self.logger.info(' - genome pairs in ANI cache: {:,} ({:.1f}%)'.format(
+                            num_cached,
+                            num_cached * 100.0 / max(1, num_requested)))
+        self.logger.info(' - genome pairs to calculate: {:,}'.format(len(self.pending)))
+        self.logger.info(' - estimated CPU-hours: {:,.1f} ({:,.1f} hours with {:,} CPUs)'.format(
+                            cpu_hours,
+                            cpu_hours / self.cpus,
+                            self.cpus))
+        self.logger.info(' - cost of {:.3f} CPU-seconds per Mbp compared ({})'.format(
+                            self.cpu_seconds_per_mbp,
+                            self.cost_source))
+
+        if self.genera and genus_pairs:
+            self.logger.info('Genera with the most genome pairs to calculate:')
+            for genus in sorted(genus_pairs, key=genus_pairs.get, reverse=True)[0:self.num_genera]:
+                self.logger.info(' - {}: {:,} pairs, {:,.1f} CPU-hours'.format(
+                                    genus if genus != 'g__' else 'unassigned genus',
+                                    genus_pairs[genus],
+                                    genus_cpu_hours[genus]))
+
+        self.logger.info('Genome pairs without a cached ANI value were treated as unrelated, so the workload of '
+                            'stages that select representatives based on ANI is an upper bound.')
@@ -0,0 +1,328 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+import multiprocessing as mp
+from collections import deque
+
+
+def producer_tag(producer):
+    """Get short tag identifying the producer of ANI values in task filenames."""
+
+    return hashlib.blake2b(producer.encode('utf-8'), digest_size=6).hexdigest()
+
+
+def claimed_task_name(claimed_name):
+    """Get name of task from the name of its claim file."""
+
+    return claimed_name[0:claimed_name.index('.json.') + len('.json')]
+
+
+def write_atomic(data, output_file):
+    """Write JSON data so the file only becomes visible once complete."""
+
+    tmp_file = f'{output_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as fout:
+        json.dump(data, fout)
+    os.replace(tmp_file, output_file)
+
+
+class ANITaskQueue(object):
+    """Distribute batches of genome pairs to ANI workers through a shared directory.
+
+    Each batch is written as a task file to the tasks directory. Workers claim a
+    task by atomically renaming it into the claimed directory under a name unique
+    to the worker, and write the calculated values to the results directory. Workers periodically touch
+    claimed tasks, so tasks claimed by workers which have stopped are
+    returned to the queue once their claim has expired.
+
+    Tasks are named by the producer of ANI values so workers only claim
+    tasks they can calculate with the same tool, version and parameters, and
+    by a run ID so several pipelines can share a queue.
+    """
+
+    # claimed tasks not touched by a worker for this many seconds are requeued
+    claim_timeout = 600
+
+    # seconds to wait between checks for completed tasks
+    poll_interval = 1.0
+
+    # seconds between messages reporting a pipeline is waiting for workers
+    wait_report_interval = 600
+
+    def __init__(self, queue_dir, producer):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.queue_dir = queue_dir
+        self.producer = producer
+        self.run_id = '{}.{}_{}_{}'.format(producer_tag(producer),
+                                            socket.gethostname(),
+                                            os.getpid(),
+                                            int(time.time()))
+
+        self.task_dir = os.path.join(queue_dir, 'tasks')
+        self.claimed_dir = os.path.join(queue_dir, 'claimed')
+        self.result_dir = os.path.join(queue_dir, 'results')
+        for d in [self.task_dir, self.claimed_dir, self.result_dir]:
+            os.makedirs(d, exist_ok=True)
+
+        self.pending = set()
+        self.results = deque()
+        self.last_requeue = time.time()
+
+    def _task_name(self, task_id):
+        """Get filename of task, ordered by task ID within a run."""
+
+        return f'{self.run_id}.{task_id:09d}.json'
+
+    def submit(self, task_id, q_files, r_files):
+        """Add batch of genome pairs to the queue."""
+
+        write_atomic({'producer': self.producer,
+                        'task_id': task_id,
+                        'query_files': q_files,
+                        'ref_files': r_files},
+                        os.path.join(self.task_dir, self._task_name(task_id)))
+
+        self.pending.add(task_id)
+
+    def _requeue_expired(self):
+        """Return tasks with an expired claim to the queue."""
+
+        min_touched = time.time() - self.claim_timeout
+        for name in os.listdir(self.claimed_dir):
+            if not name.startswith(self.run_id):
+                continue
+
+            claimed_file = os.path.join(self.claimed_dir, name)
+            try:
+                if os.stat(claimed_file).st_mtime < min_touched:
+                    task_name = claimed_task_name(name)
+                    os.replace(claimed_file, os.path.join(self.task_dir, task_name))
+                    self.logger.warning(f'Returned task with expired claim to ANI task queue: {task_name}')
+            except FileNotFoundError:
+                pass
+
+    def _collect_results(self):
+        """Read completed tasks of this run from the results directory."""
+
+        for name in sorted(os.listdir(self.result_dir)):
+            if not name.startswith(self.run_id) or not name.endswith('.json'):
+                continue
+
+            result_file = os.path.join(self.result_dir, name)
+            with open(result_file) as f:
+                result = json.load(f)
+            os.remove(result_file)
+
+            # tasks may be completed more than once if a claim expired
+            task_id = result['task_id']
+            if task_id in self.pending:
+                self.pending.remove(task_id)
+                self.results.append((task_id, result['anis'], result['afs']))
+
+    def next_result(self):
+        """Wait for next completed task.
+
+        Returns
+        -------
+        int, list, list
+            Task ID, along with ANI and AF between each query and reference genome.
+        """
+
+        last_report = time.time()
+        while not self.results:
+            self._collect_results()
+            if self.results:
+                break
+
+            if time.time() - self.last_requeue >= self.claim_timeout / 4:
+                self._requeue_expired()
+                self.last_requeue = time.time()
+
+            if time.time() - last_report >= self.wait_report_interval:
+                self.logger.info('Waiting for ANI workers to complete {:,} tasks in {} (producer: {}).'.format(
+                                    len(self.pending),
+                                    self.queue_dir,
+                                    self.producer))
+                last_report = time.time()
+
+            time.sleep(self.poll_interval)
+
+        return self.results.popleft()
+
+    def cancel(self):
+        """Remove unclaimed tasks and uncollected results of this run."""
+
+        for d in [self.task_dir, self.result_dir]:
+            for name in os.listdir(d):
+                if name.startswith(self.run_id):
+                    try:
+                        os.remove(os.path.join(d, name))
+                    except FileNotFoundError:
+                        pass
+
+        self.pending = set()
+        self.results = deque()
+
+
+class ANIWorker(object):
+    """Calculate ANI for tasks claimed from a shared ANI task queue."""
+
+    def __init__(self, queue_dir, engine, cpus, idle_timeout=0):
+        """Initialization.
+
+        Parameters
+        ----------
+        queue_dir : str
+            Shared directory containing the ANI task queue.
+        engine : ANIEngine
+            Engine used to calculate ANI.
+        cpus : int
+            Number of tasks to process in parallel.
+        idle_timeout : float
+            Stop once no task has been available for this many seconds, or 0 to run until killed.
+        """
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.queue_dir = queue_dir
+        self.engine = engine
+        self.cpus = cpus
+        self.idle_timeout = idle_timeout
+
+        self.task_dir = os.path.join(queue_dir, 'tasks')
+        self.claimed_dir = os.path.join(queue_dir, 'claimed')
+        self.result_dir = os.path.join(queue_dir, 'results')
+        for d in [self.task_dir, self.claimed_dir, self.result_dir]:
+            os.makedirs(d, exist_ok=True)
+
+        self.tag = producer_tag(engine.producer)
+
+    def _claim(self):
+        """Claim next task calculated by the engine of this worker, or return None if the queue is empty."""
+
+        # claims are named by worker so a worker only ever
+        # touches or removes its own claim of a task
+        worker_id = f'{socket.gethostname()}_{os.getpid()}'
+
+        for name in sorted(os.listdir(self.task_dir)):
+            if not name.startswith(self.tag) or not name.endswith('.json'):
+                continue
+
+            claimed_file = os.path.join(self.claimed_dir, f'{name}.{worker_id}.claim')
+            try:
+                os.replace(os.path.join(self.task_dir, name), claimed_file)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+
+            os.utime(claimed_file)
+            return claimed_file
+
+        return None
+
+    def _heartbeat(self, claimed_file, done):
+        """Touch claimed task until processing is done so the claim does not expire."""
+
+        while not done.wait(ANITaskQueue.claim_timeout / 4):
+            try:
+                os.utime(claimed_file)
+            except FileNotFoundError:
+                break
+
+    def _process(self, claimed_file):
+        """Calculate ANI for a claimed task and write the result."""
+
+        with open(claimed_file) as f:
+            task = json.load(f)
+
+        name = claimed_task_name(os.path.basename(claimed_file))
+        if task['producer'] != self.engine.producer:
+            # producer tags only collide if the hashes of different producers match
+            os.replace(claimed_file, os.path.join(self.task_dir, name))
+            self.logger.error('Task requires ANI values calculated by {}, not {}.'.format(
+                                task['producer'],
+                                self.engine.producer))
+            return
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(claimed_file, done), daemon=True)
+        heartbeat.start()
+        try:
+            q_files = task['query_files']
+            r_files = task['ref_files']
+            if self.engine.staging:
+                staged_files = self.engine.staging.stage_files(q_files + r_files)
+                q_files = [staged_files[gf] for gf in q_files]
+                r_files = [staged_files[gf] for gf in r_files]
+
+            anis, afs = self.engine._calculate_batch(q_files, r_files)
+        finally:
+            done.set()
+            heartbeat.join()
+
+        write_atomic({'task_id': task['task_id'],
+                        'anis': anis.tolist(),
+                        'afs': afs.tolist()},
+                        os.path.join(self.result_dir, name))
+
+        try:
+            os.remove(claimed_file)
+        except FileNotFoundError:
+            pass
+
+    def _work(self):
+        """Process tasks until the queue has been idle for the specified time."""
+
+        try:
+            last_task = time.time()
+            while True:
+                claimed_file = self._claim()
+                if claimed_file is None:
+                    if self.idle_timeout and time.time() - last_task >= self.idle_timeout:
+                        break
+                    time.sleep(ANITaskQueue.poll_interval)
+                    continue
+
+                self._process(claimed_file)
+                last_task = time.time()
+        finally:
+            self.engine._release_worker()
+
+    def run(self):
+        """Process tasks from the ANI task queue using a pool of worker processes."""
+
+        self.logger.info('Processing ANI tasks in {} with {:,} worker processes (producer: {}).'.format(
+                            self.queue_dir,
+                            self.cpus,
+                            self.engine.producer))
+
+        workers = [mp.Process(target=self._work) for _ in range(self.cpus)]
+        for p in workers:
+            p.start()
+
+        for p in workers:
+            p.join()
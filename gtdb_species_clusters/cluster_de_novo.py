@@ -28,8 +28,6 @@ import pickle
 from itertools import combinations
 from collections import defaultdict, namedtuple, Counter
 
-from biolib.external.execute import check_dependencies
-
 from numpy import (mean as np_mean,
                     std as np_std)
 
@@ -49,17 +47,17 @@ from gtdb_species_clusters.type_genome_utils import (GenomeRadius,
                                             write_clusters,
                                             write_rep_radius)
                                     
-from gtdb_species_clusters.fastani import FastANI
-from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.greedy_ani import prefetch_greedy_ani, block_greedy_ani
 
 class ClusterDeNovo(object):
     """Infer de novo species clusters and type genomes for remaining genomes."""
 
-    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir, prefetch_genomes=0, greedy_block_size=0, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -74,7 +72,18 @@ class ClusterDeNovo(object):
         
         self.ClusteredGenome = namedtuple('ClusteredGenome', 'ani af gid')
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash_options = mash_options or {}
+        
+        # number of genomes to speculatively calculate ANI for
+        # ahead of greedy selection of representatives
+        self.prefetch_genomes = prefetch_genomes
+        
+        # number of genomes to calculate ANI for at once during greedy 
+        # selection of representatives, with selection then performed
+        # for each genome in turn using these precalculated values
+        self.greedy_block_size = greedy_block_size
         
     def _parse_type_clusters(self, type_genome_cluster_file):
         """Parse type genomes clustering information."""
@@ -171,7 +180,7 @@ class ClusterDeNovo(object):
     def _mash_ani_unclustered(self, genome_files, gids):
         """Calculate pairwise Mash ANI estimates between genomes."""
         
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         # create Mash sketch for potential representative genomes
         mash_nontype_sketch_file = os.path.join(self.output_dir, 'gtdb_unclustered_genomes.msh')
@@ -183,26 +192,23 @@ class ClusterDeNovo(object):
         mash.dist_pairwise( float(100 - self.min_mash_ani)/100, mash_nontype_sketch_file, mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
         
         # report pairs above Mash threshold
         mash_ani_pairs = []
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if mash_ani[qid][rid] >= self.min_mash_ani:
-                    if qid != rid:
-                        mash_ani_pairs.append((qid, rid))
-                        mash_ani_pairs.append((rid, qid))
+        for qid, rid, _ani in mash_candidates.candidate_pairs():
+            mash_ani_pairs.append((qid, rid))
+            mash_ani_pairs.append((rid, qid))
                 
         self.logger.info('Identified %d genome pairs with a Mash ANI >= %.1f%%.' % (len(mash_ani_pairs), self.min_mash_ani))
 
-        return mash_ani
+        return mash_candidates
         
     def _selected_rep_genomes(self,
                                 genome_files,
                                 nontype_radius, 
                                 unclustered_qc_gids, 
-                                mash_ani,
+                                mash_candidates,
                                 quality_metadata,
                                 rnd_type_genome):
         """Select representative genomes for species clusters in a  greedy fashion using species-specific ANI thresholds."""
@@ -221,19 +227,36 @@ class ClusterDeNovo(object):
         # greedily determine representatives for new species clusters
         cluster_rep_file = os.path.join(self.output_dir, 'cluster_reps.tsv')
         clusters = set()
+        rep_order = {}
         if not os.path.exists(cluster_rep_file):
             self.logger.info('Clustering genomes to identify representatives.')
             clustered_genomes = 0
             max_ani_pairs = 0
             for idx, (cur_gid, _score) in enumerate(sorted_gids):
+                if self.greedy_block_size:
+                    if idx % self.greedy_block_size == 0:
+                        block_ani_af = block_greedy_ani(self.fastani,
+                                                        [gid for gid, _score in sorted_gids[idx:idx + self.greedy_block_size]],
+                                                        clusters,
+                                                        mash_candidates,
+                                                        genome_files)
+                elif self.prefetch_genomes and idx % self.prefetch_genomes == 0:
+                    # ANI for the next window of genomes is calculated in the background
+                    # while this window is processed, along with any pairs for this window
+                    # involving representatives selected since it was prefetched
+                    prefetch_greedy_ani(self.fastani,
+                                        [gid for gid, _score in sorted_gids[idx:idx + 2*self.prefetch_genomes]],
+                                        clusters,
+                                        mash_candidates,
+                                        genome_files,
+                                        self.ani_sp)
 
                 # determine reference genomes to calculate ANI between
+                rep_gids = mash_candidates.candidate_reps(cur_gid, rep_order)
                 ani_pairs = []
-                if cur_gid in mash_ani:
-                    for rep_gid in clusters:
-                        if mash_ani[cur_gid].get(rep_gid, 0) >= self.min_mash_ani:
-                            ani_pairs.append((cur_gid, rep_gid))
-                            ani_pairs.append((rep_gid, cur_gid))
+                for rep_gid in rep_gids:
+                    ani_pairs.append((cur_gid, rep_gid))
+                    ani_pairs.append((rep_gid, cur_gid))
 
                 # determine if genome clusters with representative
                 clustered = False
@@ -241,12 +264,15 @@ class ClusterDeNovo(object):
                     if len(ani_pairs) > max_ani_pairs:
                         max_ani_pairs = len(ani_pairs)
                     
-                    ani_af = self.fastani.pairs(ani_pairs, genome_files, report_progress=False)
+                    if self.greedy_block_size:
+                        ani_af = block_ani_af
+                    else:
+                        ani_af = self.fastani.pairs(ani_pairs, genome_files, report_progress=False)
 
                     closest_rep_gid = None
                     closest_rep_ani = 0
                     closest_rep_af = 0
-                    for rep_gid in clusters:
+                    for rep_gid in rep_gids:
                         ani, af = symmetric_ani(ani_af, cur_gid, rep_gid)
 
                         if af >= self.af_sp:
@@ -266,6 +292,7 @@ class ClusterDeNovo(object):
                 if not clustered:
                     # genome is a new species cluster representative
                     clusters.add(cur_gid)
+                    rep_order[cur_gid] = len(rep_order)
                 else:
                     clustered_genomes += 1
                 
@@ -309,7 +336,7 @@ class ClusterDeNovo(object):
         all_reps = rep_genomes.union(type_gids)
         
         # calculate MASH distance between non-type/representative genomes and selected type/representatives genomes
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         mash_type_rep_sketch_file = os.path.join(self.output_dir, 'gtdb_rep_genomes.msh')
         type_rep_genome_list_file = os.path.join(self.output_dir, 'gtdb_rep_genomes.lst')
@@ -324,7 +351,7 @@ class ClusterDeNovo(object):
         mash.dist(float(100 - self.min_mash_ani)/100, mash_type_rep_sketch_file, mash_none_rep_sketch_file, mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
         
         # calculate ANI between non-type/representative genomes and selected type/representatives genomes
         clusters = {}
@@ -334,11 +361,9 @@ class ClusterDeNovo(object):
         genomes_to_cluster = passed_qc - set(clusters)
         ani_pairs = []
         for gid in genomes_to_cluster:
-            if gid in mash_ani:
-                for rep_gid in clusters:
-                    if mash_ani[gid].get(rep_gid, 0) >= self.min_mash_ani:
-                        ani_pairs.append((gid, rep_gid))
-                        ani_pairs.append((rep_gid, gid))
+            for rep_gid, _ani in mash_candidates.candidates(gid, clusters):
+                ani_pairs.append((gid, rep_gid))
+                ani_pairs.append((rep_gid, gid))
                         
         self.logger.info('Calculating ANI between %d species clusters and %d unclustered genomes (%d pairs):' % (
                             len(clusters), 
@@ -349,11 +374,12 @@ class ClusterDeNovo(object):
         # assign genomes to closest representatives 
         # that is within the representatives ANI radius
         self.logger.info('Assigning genomes to closest representative.')
+        rep_order = {rep_gid: idx for idx, rep_gid in enumerate(clusters)}
         for idx, cur_gid in enumerate(genomes_to_cluster):
             closest_rep_gid = None
             closest_rep_ani = 0
             closest_rep_af = 0
-            for rep_gid in clusters:
+            for rep_gid in mash_candidates.candidate_reps(cur_gid, rep_order):
                 ani, af = symmetric_ani(ani_af, cur_gid, rep_gid)
                 
                 if ani >= final_cluster_radius[rep_gid].ani and af >= self.af_sp:
@@ -567,6 +593,7 @@ class ClusterDeNovo(object):
         gtdb_taxonomy = read_gtdb_taxonomy(metadata_file)
         self.logger.info('Read NCBI taxonomy for %d genomes with %d manually defined updates.' % (len(ncbi_taxonomy), ncbi_update_count))
         self.logger.info('Read GTDB taxonomy for %d genomes.' % len(gtdb_taxonomy))
+        self.fastani.set_genome_genera({gid: taxa[5] for gid, taxa in gtdb_taxonomy.items()})
         
         # parse NCBI assembly files
         self.logger.info('Parsing NCBI assembly files.')
@@ -606,13 +633,13 @@ class ClusterDeNovo(object):
         
         # calculate Mash ANI estimates between unclustered genomes
         self.logger.info('Calculating Mash ANI estimates between unclustered genomes.')
-        mash_anis = self._mash_ani_unclustered(genome_files, unclustered_gids)
+        mash_candidates = self._mash_ani_unclustered(genome_files, unclustered_gids)
 
         # select species representatives genomes in a greedy fashion based on genome quality
         rep_genomes = self._selected_rep_genomes(genome_files,
                                                     nontype_radius, 
                                                     unclustered_gids, 
-                                                    mash_anis,
+                                                    mash_candidates,
                                                     quality_metadata,
                                                     rnd_type_genome)
         
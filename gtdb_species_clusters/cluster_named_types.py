@@ -27,7 +27,6 @@ from itertools import combinations
 from collections import defaultdict, namedtuple
 
 from biolib.taxonomy import Taxonomy
-from biolib.external.execute import check_dependencies
 
 from numpy import (mean as np_mean)
 
@@ -44,17 +43,16 @@ from gtdb_species_clusters.type_genome_utils import (GenomeRadius,
                                             write_clusters,
                                             write_rep_radius)
                                     
-from gtdb_species_clusters.fastani import FastANI
-from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
 
 class ClusterNamedTypes(object):
     """Cluster genomes to selected GTDB type genomes."""
 
-    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -68,7 +66,9 @@ class ClusterNamedTypes(object):
         
         self.ClusteredGenome = namedtuple('ClusteredGenome', 'ani af gid')
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash_options = mash_options or {}
         
     def _type_genome_radius(self, type_gids, type_genome_ani_file):
         """Calculate circumscription radius for type genomes."""
@@ -127,7 +127,7 @@ class ClusterNamedTypes(object):
     def _calculate_ani(self, type_gids, genome_files, ncbi_taxonomy, type_genome_sketch_file):
         """Calculate ANI between type and non-type genomes."""
         
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         # create Mash sketch for type genomes
         if not type_genome_sketch_file or not os.path.exists(type_genome_sketch_file):
@@ -153,16 +153,13 @@ class ClusterNamedTypes(object):
                                 mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
 
         # get pairs above Mash threshold
         mash_ani_pairs = []
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if mash_ani[qid][rid] >= self.min_mash_ani:
-                    if qid != rid:
-                        mash_ani_pairs.append((qid, rid))
-                        mash_ani_pairs.append((rid, qid))
+        for qid, rid, _ani in mash_candidates.candidate_pairs():
+            mash_ani_pairs.append((qid, rid))
+            mash_ani_pairs.append((rid, qid))
                 
         self.logger.info('Identified %d genome pairs with a Mash ANI >= %.1f%%.' % (len(mash_ani_pairs), self.min_mash_ani))
         
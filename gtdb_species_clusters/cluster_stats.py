@@ -28,8 +28,6 @@ import pickle
 from itertools import combinations
 from collections import defaultdict, namedtuple, Counter
 
-from biolib.external.execute import check_dependencies
-
 from numpy import (mean as np_mean,
                     median as np_median,
                     std as np_std,
@@ -42,17 +40,15 @@ from gtdb_species_clusters.taxon_utils import read_gtdb_taxonomy, read_gtdb_ncbi
 from gtdb_species_clusters.type_genome_utils import (GenomeRadius,
                                                         symmetric_ani)
                                             
-from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
 
 class ClusterStats(object):
     """Calculate statistics for species cluster."""
 
-    def __init__(self, af_sp, max_genomes, ani_cache_file, cpus, output_dir):
+    def __init__(self, af_sp, max_genomes, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -60,7 +56,9 @@ class ClusterStats(object):
         
         self.af_sp = af_sp
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash = create_mash(cpus, **(mash_options or {}))
         
         self.max_genomes_for_stats = max_genomes    # maximum number of randomly selected genomes to
                                                     # consider when calculating pairwise statistics
@@ -75,7 +73,7 @@ class ClusterStats(object):
                                                            'mean_ani_to_rep',
                                                            'ani_below_95'))
                                                            
-    def _find_multiple_reps(self, clusters, cluster_radius):
+    def _find_multiple_reps(self, clusters, cluster_radius, genome_files):
         """Determine number of non-rep genomes within ANI radius of multiple rep genomes.
         
         This method assumes the ANI cache contains all relevant ANI calculations between
@@ -92,14 +90,15 @@ class ClusterStats(object):
             
         self.logger.info('Considering %d representatives and %d non-representative genomes.' % (len(clusters), len(clustered_gids)))
             
+        ani_cache = self.fastani.cache_view(genome_files)
         nonrep_rep_count = defaultdict(set)
         for idx, gid in enumerate(clustered_gids):
-            cur_ani_cache = self.fastani.ani_cache[gid]
+            cur_ani_cache = ani_cache[gid]
             for rid in clusters:
                 if rid not in cur_ani_cache:
                     continue
                     
-                ani, af = symmetric_ani(self.fastani.ani_cache, gid, rid)
+                ani, af = symmetric_ani(ani_cache, gid, rid)
                 if af >= self.af_sp and ani >= cluster_radius[rid].ani:
                     nonrep_rep_count[gid].add((rid, ani))
                     
@@ -271,7 +270,7 @@ class ClusterStats(object):
                                                             genome_files, 
                                                             report_progress=False)
                 else:
-                    ani_af = self.fastani.ani_cache
+                    ani_af = self.fastani.cache_view(genome_files)
                 
                 # calculate statistics
                 anis = [symmetric_ani(ani_af, cid, rid)[0] for cid in cids]
@@ -333,7 +332,7 @@ class ClusterStats(object):
                                                         genome_files, 
                                                         report_progress=False)
                 else:
-                    ani_af = self.fastani.ani_cache
+                    ani_af = self.fastani.cache_view(genome_files)
                                                         
                 # calculate medoid point
                 if len(gids) > 2:
@@ -458,7 +457,7 @@ class ClusterStats(object):
         
         # determine number of non-rep genomes with ANI radius of multiple rep genomes
         if False:
-            nonrep_rep_count = self._find_multiple_reps(clusters, cluster_radius)
+            nonrep_rep_count = self._find_multiple_reps(clusters, cluster_radius, genome_files)
             
             fout = open(os.path.join(self.output_dir, 'nonrep_rep_ani_radius_count.tsv'), 'w')
             fout.write('Genome ID\tSpecies\tNo. rep radii\tMean radii')
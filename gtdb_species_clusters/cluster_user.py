@@ -27,8 +27,6 @@ import pickle
 from itertools import combinations
 from collections import defaultdict, namedtuple, Counter
 
-from biolib.external.execute import check_dependencies
-
 from numpy import (mean as np_mean,
                     std as np_std)
 
@@ -39,17 +37,16 @@ from gtdb_species_clusters.type_genome_utils import (GenomeRadius,
                                                         read_clusters,
                                                         symmetric_ani)
                                     
-from gtdb_species_clusters.fastani import FastANI
-from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
 
 class ClusterUser(object):
     """Cluster User genomes to GTDB species clusters."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -59,12 +56,14 @@ class ClusterUser(object):
         
         self.af_sp = 0.65
 
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+
+        self.mash_options = mash_options or {}
 
     def _mash_ani(self, genome_files, user_genomes, sp_clusters):
         """Calculate Mash ANI estimates between User genomes and species clusters."""
         
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         # create Mash sketch for User genomes
         mash_user_sketch_file = os.path.join(self.output_dir, 'gtdb_user_genomes.msh')
@@ -81,39 +80,36 @@ class ClusterUser(object):
         mash.dist(float(100 - self.min_mash_ani)/100, mash_sp_sketch_file, mash_user_sketch_file, mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
         
         # report pairs above Mash threshold
         mash_ani_pairs = []
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if mash_ani[qid][rid] >= self.min_mash_ani:
-                    if qid != rid:
-                        mash_ani_pairs.append((qid, rid))
-                        mash_ani_pairs.append((rid, qid))
+        for qid, rid, _ani in mash_candidates.candidate_pairs():
+            mash_ani_pairs.append((qid, rid))
+            mash_ani_pairs.append((rid, qid))
                 
         self.logger.info('Identified %d genome pairs with a Mash ANI >= %.1f%%.' % (len(mash_ani_pairs), self.min_mash_ani))
 
-        return mash_ani
+        return mash_candidates
         
     def _cluster(self,
                     genome_files,
                     sp_clusters,
                     rep_radius, 
                     user_genomes, 
-                    mash_anis):
+                    mash_candidates):
         """Cluster User genomes to existing species clusters."""
         
         # assign User genomes to closest species cluster
-        
+        rep_order = {rep_gid: idx for idx, rep_gid in enumerate(sp_clusters)}
         for idx, cur_gid in enumerate(user_genomes):
             # determine species cluster to calculate ANI between
             ani_pairs = []
-            if cur_gid in mash_anis:
-                for rep_gid in sp_clusters:
-                    if mash_anis[cur_gid].get(rep_gid, 0) >= self.min_mash_ani:
-                        ani_pairs.append((cur_gid, rep_gid))
-                        ani_pairs.append((rep_gid, cur_gid))
+            if cur_gid in mash_candidates:
+                rep_gids = mash_candidates.candidate_reps(cur_gid, rep_order)
+                for rep_gid in rep_gids:
+                    ani_pairs.append((cur_gid, rep_gid))
+                    ani_pairs.append((rep_gid, cur_gid))
 
                 # determine if genome clusters with representative
                 clustered = False
@@ -123,7 +119,7 @@ class ClusterUser(object):
                     closest_rep_gid = None
                     closest_rep_ani = 0
                     closest_rep_af = 0
-                    for rep_gid in sp_clusters:
+                    for rep_gid in rep_gids:
                         ani, af = symmetric_ani(ani_af, cur_gid, rep_gid)
                         
                         if af >= self.af_sp:
@@ -182,7 +178,7 @@ class ClusterUser(object):
 
         # calculate Mash ANI estimates between unclustered genomes
         self.logger.info('Calculating Mash ANI estimates between User genomes and species clusters.')
-        mash_anis = self._mash_ani(genome_files, user_genomes, sp_clusters)
+        mash_candidates = self._mash_ani(genome_files, user_genomes, sp_clusters)
 
         # cluster User genomes to species clusters
         self.logger.info('Assigning User genomes to closest species cluster.')
@@ -190,7 +186,7 @@ class ClusterUser(object):
                         sp_clusters,
                         rep_radius, 
                         user_genomes, 
-                        mash_anis)
+                        mash_candidates)
                         
         clustered_genomes = 0
         for rep_id in sp_clusters:
@@ -16,46 +16,38 @@
 ###############################################################################
 
 import os
+import re
 import sys
-import uuid
+import errno
+import shutil
 import tempfile
-import ntpath
-import logging
-import re
 import subprocess
-import multiprocessing as mp
-from itertools import combinations, permutations
-from collections import defaultdict
+from array import array
+
+from biolib.external.execute import check_dependencies
 
-from biolib.external.execute import check_dependencies, run
+from gtdb_species_clusters.ani_engine import ANIEngine
 
-from gtdb_species_clusters.genome_utils import canonical_gid
-from gtdb_species_clusters.type_genome_utils import symmetric_ani
 
+class FastANI(ANIEngine):
+    """Calculate average nucleotide identity between genomes with FastANI."""
 
-class FastANI(object):
-    """Calculate average nucleotide identity between genomes using a precomputed cache where possible."""
+    # length of genome fragments used by FastANI
+    frag_len = 3000
 
-    def __init__(self, ani_cache_file, cpus):
+    def __init__(self, ani_cache_file, cpus, **engine_args):
         """Initialization."""
         
         check_dependencies(['fastANI'])
         
-        self.cpus = cpus
-
-        self.logger = logging.getLogger('timestamp')
-        
-        self.ani_cache_file = ani_cache_file
-        self._read_cache()
+        self.version = self._get_version()
         
-        self.logger.info('Using FastANI v{}.'.format(self._get_version()))
-
-    def __del__(self):
-        """Destructor."""
+        ANIEngine.__init__(self, ani_cache_file, cpus, **engine_args)
         
-        self.write_cache()
+        self.logger.info('Using FastANI v{}.'.format(self.version))
         
-    def _get_version(self):
+    @staticmethod
+    def _get_version():
         """Returns the version of FastANI on the system path.
         
         Returns
@@ -75,303 +67,151 @@ class FastANI(object):
         except Exception as e:
             print(e)
             return 'unknown'
-        
-    def _read_cache(self):
-        """Read previously calculated ANI values."""
-        
-        self.ani_cache = defaultdict(lambda: {})
-
-        if self.ani_cache_file:
-            if os.path.exists(self.ani_cache_file):
-                cache_size = 0
-                for line in open(self.ani_cache_file):
-                    line_split = line.strip().split('\t')
-                    gid1 = line_split[0]
-                    gid2 = line_split[1]
-                    ani = float(line_split[2])
-                    af = float(line_split[3])
-                    self.ani_cache[gid1][gid2] = (ani, af)
-                    cache_size += 1
-                    
-                self.logger.info(f'Read ANI cache with {cache_size:,} entries.')
-            else:
-                self.logger.warning(f'ANI cache file does not exist: {self.ani_cache_file}')
-            
-    def write_cache(self, silence=False):
-        """Write cache to file."""
-        
-        if self.ani_cache_file:
-            fout = open(self.ani_cache_file, 'w')
-            cache_size = 0
-            for gid1 in self.ani_cache:
-                for gid2 in self.ani_cache[gid1]:
-                    ani, af = self.ani_cache[gid1][gid2]
-                    fout.write('%s\t%s\t%f\t%f\n' % (gid1, gid2, ani, af))
-                    cache_size += 1
-            fout.close()
-            
-            if not silence:
-                self.logger.info(f'Wrote ANI cache with {cache_size:,} entries.')
 
-    def _get_genome_id(self, genome_path):
-        """Extract genome ID from path to genomic file."""
+    def _scratch_root(self):
+        """Get directory for scratch files, preferring memory-backed storage."""
         
-        genome_id = ntpath.basename(genome_path)
-        if genome_id.startswith('GCA_') or genome_id.startswith('GCF_'):
-            genome_id = '_'.join(genome_id.split('_')[0:2])
-            if genome_id.startswith('GCA_'):
-                genome_id = 'GB_' + genome_id
-            else:
-                genome_id = 'RS_' + genome_id
-        else:
-            genome_id = '_'.join(genome_id.split('_')[0:2])
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            return '/dev/shm'
             
-        return canonical_gid(genome_id)
+        return tempfile.gettempdir()
         
-    def fastani(self, qid, rid, q_gf, r_gf):
-        """CalculateANI between a pair of genomes."""
-
-        # check cache
-        if qid in self.ani_cache:
-            if rid in self.ani_cache[qid]:
-                ani, af = self.ani_cache[qid][rid]
-                ani_af = (qid, rid, ani, af)
-                return ani_af
+    def _remove_stale_scratch(self, scratch_root):
+        """Remove scratch directories left by processes which no longer exist."""
         
-        # create file pointing to representative genome files
-        tmp_fastani_file = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
-        cmd = 'fastANI -q %s -r %s -o %s 2> /dev/null' % (
-                    q_gf, 
-                    r_gf, 
-                    tmp_fastani_file)
-            
-        run(cmd)
-
-        if os.path.exists(tmp_fastani_file) and os.stat(tmp_fastani_file).st_size > 0:
-            for line in open(tmp_fastani_file):
-                line_split = line.strip().split()
-                ani = float(line_split[2])
-                af = float(line_split[3])/int(line_split[4])
-                ani_af = (qid, rid, ani, af)
-        else:
-            ani_af = (qid, rid, 0.0, 0.0)
-
-        if os.path.exists(tmp_fastani_file):
-            os.remove(tmp_fastani_file)
-
-        return ani_af
-
-    def __fastani_worker(self, genomic_files, queue_in, queue_out):
-        """Process each data item in parallel."""
-
-        while True:
-            qid, rid = queue_in.get(block=True, timeout=None)
-            if qid == None:
-                break
-
-            ani_af = self.fastani(qid, rid, 
-                                    genomic_files[qid], 
-                                    genomic_files[rid])
-
-            queue_out.put(ani_af)
-
-    def __fastani_writer(self, all_ani_af, num_pairs, report_progress, queue_writer):
-        """Store or write results of worker threads in a single thread."""
-        
-        full_results = {}
-        processed = 0
-        while True:
-            ani_af = queue_writer.get(block=True, timeout=None)
-            if ani_af == None:
-                for qid in full_results:
-                    all_ani_af[qid] = full_results[qid]
-                break
-
-            qid, rid, ani, af = ani_af
-            if qid not in full_results:
-                full_results[qid] = {}
+        for name in os.listdir(scratch_root):
+            if not name.startswith('gtdb_fastani_'):
+                continue
                 
-            full_results[qid][rid] = (ani, af)
-            
-            if report_progress:
-                processed += 1
-                statusStr = '-> Processing {:,} of {:,} ({:.2f}%) genome pairs.'.format(
-                                    processed, 
-                                    num_pairs, 
-                                    float(processed*100)/num_pairs).ljust(86)
-                sys.stdout.write('%s\r' % statusStr)
-                sys.stdout.flush()
-                
-        if report_progress:
-            sys.stdout.write('\n')
-            
-    def pairwise(self, gids, genome_files, check_cache=False):
-        """Calculate FastANI between all genome pairs in parallel."""
-        
-        if not gids:
-            return {}
-            
-       # check if all pairs are in cache
-        if check_cache:
-            ani_af = defaultdict(lambda: {})
-            
-            in_cache = True
-            for qid, rid in permutations(gids, 2):
-                if qid in self.ani_cache:
-                    if rid in self.ani_cache:
-                        ani_af[qid][rid] = self.ani_cache[qid][rid]
-                    else:
-                        in_cache = False
-                        break
-                else:
-                    in_cache = False
-                    break
+            try:
+                pid = int(name[len('gtdb_fastani_'):])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    shutil.rmtree(os.path.join(scratch_root, name), ignore_errors=True)
                     
-            if in_cache:
-                return ani_af
-            
-        # calculate required ANI pairs
-        if len(gids) == 2: # skip overhead of setting up queues and processes
-            d = {}
-            gids = list(gids)
-            d[gids[0]] = {}
-            d[gids[1]] = {}
-            
-            qid, rid, ani, af = self.fastani(gids[0], gids[1],
-                                                genome_files[gids[0]],
-                                                genome_files[gids[1]])
-            d[qid][rid] = (ani, af)
-            self.ani_cache[qid][rid] = (ani, af)
-            
-            qid, rid, ani, af = self.fastani(gids[1], gids[0],
-                                                genome_files[gids[1]],
-                                                genome_files[gids[0]])
-            d[qid][rid] = (ani, af)
-            self.ani_cache[qid][rid] = (ani, af)
-
-            return d
+    def _scratch_dir(self):
+        """Get scratch directory of current process, which is reused for all FastANI calls."""
         
-        ani_af = mp.Manager().dict()
+        scratch_dir = os.path.join(self._scratch_root(), f'gtdb_fastani_{os.getpid()}')
+        if not os.path.exists(scratch_dir):
+            self._remove_stale_scratch(os.path.dirname(scratch_dir))
+            os.makedirs(scratch_dir)
+            
+        return scratch_dir
         
-        worker_queue = mp.Queue()
-        writer_queue = mp.Queue()
+    def _write_list(self, list_name, genome_files):
+        """Write list of genomic files for FastANI to scratch directory."""
         
-        for gid1, gid2 in permutations(gids, 2):
-            worker_queue.put((gid1, gid2))
-
-        for _ in range(self.cpus):
-            worker_queue.put((None, None))
-
-        try:
-            workerProc = [mp.Process(target = self.__fastani_worker, args = (genome_files,
-                                                                                worker_queue, 
-                                                                                writer_queue)) for _ in range(self.cpus)]
-            writeProc = mp.Process(target = self.__fastani_writer, args = (ani_af, 0, False, writer_queue))
-
-            writeProc.start()
-
-            for p in workerProc:
-                p.start()
-
-            for p in workerProc:
-                p.join()
-
-            writer_queue.put(None)
-            writeProc.join()
-        except:
-            for p in workerProc:
-                p.terminate()
-            writeProc.terminate()
+        list_file = os.path.join(self._scratch_dir(), list_name)
+        with open(list_file, 'w') as fout:
+            for gf in sorted(set(genome_files)):
+                fout.write(gf + '\n')
+                
+        return list_file
         
-        ani_af = dict(ani_af)
-        for qid in ani_af:
-            for rid in ani_af[qid]:
-                self.ani_cache[qid][rid] = ani_af[qid][rid]
+    def _release_worker(self):
+        """Remove scratch directory of worker process."""
         
-        return ani_af
+        scratch_dir = os.path.join(self._scratch_root(), f'gtdb_fastani_{os.getpid()}')
+        shutil.rmtree(scratch_dir, ignore_errors=True)
         
-    def pairs(self, gid_pairs, genome_files, report_progress=True, check_cache=False):
-        """Calculate FastANI between specified genome pairs in parallel."""
+    def close(self):
+        """Stop pool of worker processes and remove scratch files."""
         
-        if not gid_pairs:
-            return {}
-            
-        # check if all pairs are in cache
-        if check_cache:
-            ani_af = defaultdict(lambda: {})
-            
-            in_cache = True
-            for qid, rid in gid_pairs:
-                if qid in self.ani_cache:
-                    if rid in self.ani_cache[qid]:
-                        ani_af[qid][rid] = self.ani_cache[qid][rid]
-                    else:
-                        in_cache = False
-                        break
-                else:
-                    in_cache = False
-                    break
-                    
-            if in_cache:
-                return ani_af
+        ANIEngine.close(self)
+        self._release_worker()
 
-        # calculate required ANI pairs
-        if len(gid_pairs) <= 6: # skip overhead of setting up queues and processes
-            d = defaultdict(lambda: {})
-            for qid, rid in gid_pairs:
-                qid, rid, ani, af = self.fastani(qid, rid, 
-                                                    genome_files[qid],
-                                                    genome_files[rid])
-                d[qid][rid] = (ani, af)
-                self.ani_cache[qid][rid] = (ani, af)
-            return d
+    @classmethod
+    def _producer(cls, version):
+        """Get string identifying the given version and parameters of FastANI."""
         
-        ani_af = mp.Manager().dict()
+        return f'fastANI:{version}:fragLen={cls.frag_len}'
+
+    @classmethod
+    def current_producer(cls):
+        """Get string identifying the version of FastANI on the system path and its parameters.
         
-        worker_queue = mp.Queue()
-        writer_queue = mp.Queue()
+        Returns None if the version of FastANI cannot be determined, as the
+        producer would not match values calculated with any version.
+        """
         
-        for gid1, gid2 in gid_pairs:
-            worker_queue.put((gid1, gid2))
-
-        for _ in range(self.cpus):
-            worker_queue.put((None, None))
-
-        try:
-            workerProc = [mp.Process(target = self.__fastani_worker, args = (genome_files,
-                                                                                worker_queue, 
-                                                                                writer_queue)) for _ in range(self.cpus)]
-            writeProc = mp.Process(target = self.__fastani_writer, args = (ani_af, len(gid_pairs), report_progress, writer_queue))
-
-            writeProc.start()
-
-            for p in workerProc:
-                p.start()
-
-            for p in workerProc:
-                p.join()
-
-            writer_queue.put(None)
-            writeProc.join()
-        except:
-            for p in workerProc:
-                p.terminate()
-            writeProc.terminate()
+        check_dependencies(['fastANI'])
         
-        ani_af = dict(ani_af)
-        for qid in ani_af:
-            for rid in ani_af[qid]:
-                self.ani_cache[qid][rid] = ani_af[qid][rid]
+        version = cls._get_version()
+        if version == 'unknown':
+            return None
         
-        return ani_af
+        return cls._producer(version)
 
-    def symmetric_ani_cached(self, gid1, gid2, genome_file1, genome_file2):
-        """Calculate symmetric ANI and AF between two genomes."""
+    def _get_producer(self):
+        """Get string identifying the version and parameters of FastANI."""
         
-        ani_af12 = self.fastani(gid1, gid2, genome_file1, genome_file2)
-        ani_af21 = self.fastani(gid2, gid1, genome_file2, genome_file1)
+        return self._producer(self.version)
 
-        self.ani_cache[gid1][gid2] = ani_af12[2:]
-        self.ani_cache[gid2][gid1] = ani_af21[2:]
+    def _calculate_batch(self, q_files, r_files):
+        """Calculate ANI between all query and reference genomic files with a single FastANI call.
+        
+        Parameters
+        ----------
+        q_files : list
+            Path to genomic FASTA file of each query genome.
+        r_files : list
+            Path to genomic FASTA file of each reference genome.
+            
+        Returns
+        -------
+        array, array
+            ANI and AF between each query and reference genome, 
+            ordered by query and then reference genome.
+        """
         
-        return symmetric_ani(self.ani_cache, gid1, gid2)
+        cmd = ['fastANI']
+        if len(q_files) == 1:
+            cmd += ['-q', q_files[0]]
+        else:
+            cmd += ['--ql', self._write_list('query_list.txt', q_files)]
+            
+        if len(r_files) == 1:
+            cmd += ['-r', r_files[0]]
+        else:
+            cmd += ['--rl', self._write_list('ref_list.txt', r_files)]
+            
+        # results are streamed from stdout rather than written to a file
+        cmd += ['--fragLen', str(self.frag_len), '-o', '/dev/stdout']
+        
+        # results are reported using the path to the genomic files
+        file_ani_af = {}
+        proc = subprocess.Popen(cmd, 
+                                stdout=subprocess.PIPE, 
+                                stderr=subprocess.DEVNULL, 
+                                encoding='utf-8')
+        for line in proc.stdout:
+            line_split = line.strip().split()
+            if len(line_split) != 5:
+                continue
+                
+            try:
+                ani = float(line_split[2])
+                af = float(line_split[3])/int(line_split[4])
+            except ValueError:
+                continue
+                
+            file_ani_af[(line_split[0], line_split[1])] = (ani, af)
+            
+        rtn = proc.wait()
+        if rtn != 0:
+            self.logger.error('Failed to execute: {}'.format(' '.join(cmd)))
+            sys.exit(rtn)
+            
+        anis = array('f')
+        afs = array('f')
+        for q_gf in q_files:
+            for r_gf in r_files:
+                ani, af = file_ani_af.get((q_gf, r_gf), (0.0, 0.0))
+                anis.append(ani)
+                afs.append(af)
+                
+        return anis, afs
@@ -0,0 +1,131 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import gzip
+import hashlib
+import logging
+
+from gtdb_species_clusters.ani_cache import CacheLock
+
+FINGERPRINT_PREFIX = 'fp:'
+
+
+def genome_fingerprint(genome_file):
+    """Calculate fingerprint of the content of a genomic FASTA file.
+
+    Gzipped files are fingerprinted on their uncompressed content
+    so recompressing a genome does not change its fingerprint.
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+
+    if genome_file.endswith('.gz'):
+        f = gzip.open(genome_file, 'rb')
+    else:
+        f = open(genome_file, 'rb')
+
+    with f:
+        while True:
+            block = f.read(1024*1024)
+            if not block:
+                break
+            h.update(block)
+
+    return FINGERPRINT_PREFIX + h.hexdigest()
+
+
+class GenomeFingerprints(object):
+    """Content fingerprints of genomic FASTA files.
+
+    Fingerprints are only calculated once for each file and are
+    recorded along with the modification time and size of the file.
+    A fingerprint is recalculated if either of these change.
+
+    The fingerprint file may be shared by processes running at the same
+    time, so it is locked while written and fingerprints recorded by
+    other processes are merged with those of this process.
+    """
+
+    def __init__(self, fingerprint_file):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.fingerprint_file = fingerprint_file
+        self.lock = CacheLock(fingerprint_file) if fingerprint_file else None
+        self.modified = False
+
+        self.fingerprints = self._read()
+        if self.fingerprints:
+            self.logger.info(f'Read fingerprints for {len(self.fingerprints):,} genomic files.')
+
+    def _read(self):
+        """Read previously calculated fingerprints."""
+
+        fingerprints = {}
+        if not self.fingerprint_file or not os.path.exists(self.fingerprint_file):
+            return fingerprints
+
+        with open(self.fingerprint_file) as f:
+            for line in f:
+                line_split = line.rstrip('\n').split('\t')
+                if len(line_split) != 4:
+                    continue
+
+                genome_file, mtime_ns, size, fingerprint = line_split
+                fingerprints[genome_file] = (int(mtime_ns), int(size), fingerprint)
+
+        return fingerprints
+
+    def write(self):
+        """Write fingerprints to file."""
+
+        if not self.fingerprint_file or not self.modified:
+            return
+
+        with self.lock.acquire():
+            # retain fingerprints written by other processes, with
+            # fingerprints calculated by this process taking precedence
+            fingerprints = self._read()
+            fingerprints.update(self.fingerprints)
+            self.fingerprints = fingerprints
+
+            tmp_file = f'{self.fingerprint_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as fout:
+                for genome_file, (mtime_ns, size, fingerprint) in self.fingerprints.items():
+                    fout.write(f'{genome_file}\t{mtime_ns}\t{size}\t{fingerprint}\n')
+
+            os.replace(tmp_file, self.fingerprint_file)
+
+        self.modified = False
+
+    def fingerprint(self, genome_file):
+        """Get fingerprint of genomic file."""
+
+        genome_file = os.path.abspath(genome_file)
+        stat = os.stat(genome_file)
+
+        cached = self.fingerprints.get(genome_file)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        fingerprint = genome_fingerprint(genome_file)
+        self.fingerprints[genome_file] = (stat.st_mtime_ns, stat.st_size, fingerprint)
+        self.modified = True
+
+        return fingerprint
@@ -0,0 +1,205 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import gzip
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GenomeStaging(object):
+    """Stage genomic FASTA files in local scratch space.
+
+    Genomic files are copied, and decompressed if necessary, into a scratch
+    directory so external tools read them from local storage. Staged files are
+    retained between runs and the least recently used files are removed once
+    the scratch directory exceeds its maximum size. Files used within the
+    last hour are never removed so files in use by running tools are retained,
+    which may allow the scratch directory to temporarily exceed its maximum size.
+    """
+
+    # staged files used within this many seconds are not removed
+    min_evict_age = 3600
+
+    def __init__(self, stage_dir, max_size, cpus=1):
+        """Initialization.
+
+        Parameters
+        ----------
+        stage_dir : str
+            Directory used to stage genomic files.
+        max_size : int
+            Maximum size of staged files in bytes.
+        cpus : int
+            Number of files to stage in parallel.
+        """
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.stage_dir = stage_dir
+        self.max_size = max_size
+        self.cpus = cpus
+
+        os.makedirs(self.stage_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        self.cur_size = self._staged_size()
+
+    @staticmethod
+    def create(stage_dir, max_size, cpus=1):
+        """Create staging area if a staging directory is specified, otherwise return None."""
+
+        if not stage_dir:
+            return None
+
+        return GenomeStaging(stage_dir, max_size, cpus)
+
+    def _entries(self):
+        """Get staged entries as (last used, size, entry directory)."""
+
+        entries = []
+        for entry in os.scandir(self.stage_dir):
+            if not entry.is_dir():
+                continue
+
+            size = 0
+            for staged in os.scandir(entry.path):
+                size += staged.stat().st_size
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+        return entries
+
+    def _staged_size(self):
+        """Get total size of staged files."""
+
+        return sum(size for _last_used, size, _entry_dir in self._entries())
+
+    def staged_path(self, genome_file):
+        """Get path of staged copy of a genomic file.
+
+        The name of the genomic file is retained, without any
+        compression extension, as tools report genomes by filename.
+        """
+
+        genome_file = os.path.abspath(genome_file)
+        entry_id = hashlib.blake2b(genome_file.encode('utf-8'), digest_size=8).hexdigest()
+
+        filename = os.path.basename(genome_file)
+        if filename.endswith('.gz'):
+            filename = filename[0:-3]
+
+        return os.path.join(self.stage_dir, entry_id, filename)
+
+    def stage(self, genome_file):
+        """Stage genomic file, returning the path to the staged copy."""
+
+        staged_file = self.staged_path(genome_file)
+        entry_dir = os.path.dirname(staged_file)
+        src_stat = os.stat(genome_file)
+
+        # staged copies have the modification time of the source file
+        try:
+            if os.stat(staged_file).st_mtime_ns == src_stat.st_mtime_ns:
+                os.utime(entry_dir)
+                with self.lock:
+                    self.hits += 1
+                return staged_file
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_file = f'{staged_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if genome_file.endswith('.gz'):
+            with gzip.open(genome_file, 'rb') as f, open(tmp_file, 'wb') as fout:
+                shutil.copyfileobj(f, fout, 1024*1024)
+        else:
+            shutil.copyfile(genome_file, tmp_file)
+
+        os.utime(tmp_file, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.replace(tmp_file, staged_file)
+
+        staged_size = os.path.getsize(staged_file)
+        with self.lock:
+            self.misses += 1
+            self.bytes_read += src_stat.st_size
+            self.bytes_written += staged_size
+            self.cur_size += staged_size
+
+        return staged_file
+
+    def stage_files(self, genome_files):
+        """Stage genomic files in parallel.
+
+        Returns
+        -------
+        dict
+            Path to staged copy of each genomic file.
+        """
+
+        unique_files = sorted(set(genome_files))
+        with ThreadPoolExecutor(max_workers=max(1, self.cpus)) as executor:
+            staged_files = dict(zip(unique_files, executor.map(self.stage, unique_files)))
+
+        if self.cur_size > self.max_size:
+            self.evict()
+
+        return staged_files
+
+    def evict(self):
+        """Remove least recently used staged files until within the maximum size."""
+
+        entries = sorted(self._entries())
+        total_size = sum(size for _last_used, size, _entry_dir in entries)
+
+        min_last_used = time.time() - self.min_evict_age
+        for last_used, size, entry_dir in entries:
+            if total_size <= self.max_size or last_used >= min_last_used:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+        self.cur_size = total_size
+
+    def report(self, stage_name):
+        """Report staging statistics."""
+
+        requests = self.hits + self.misses
+        if requests == 0:
+            return
+
+        self.logger.info('Staged genomic files for {}: {:,} of {:,} ({:.1f}%) already staged, {:,.1f} MB read and {:,.1f} MB written to scratch.'.format(
+                            stage_name,
+                            self.hits,
+                            requests,
+                            self.hits * 100.0 / requests,
+                            self.bytes_read / 1024**2,
+                            self.bytes_written / 1024**2))
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
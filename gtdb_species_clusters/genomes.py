@@ -181,6 +181,23 @@ class Genomes(object):
                             reverse=True):
             yield gid
 
+    def genome_lengths(self):
+        """Get length of each genome."""
+        
+        return {gid: genome.length for gid, genome in self.genomes.items()}
+        
+    def genome_genera(self):
+        """Get GTDB genus of each genome, or NCBI genus if genome has no GTDB genus."""
+        
+        genera = {}
+        for gid, genome in self.genomes.items():
+            genus = genome.gtdb_taxa.genus
+            if genus == 'g__':
+                genus = genome.ncbi_taxa.genus
+            genera[gid] = genus
+            
+        return genera
+
     def get_gid(self, idx):
         """Get ID of genome at specific index."""
         
@@ -0,0 +1,87 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+
+def prefetch_greedy_ani(ani_engine, window_gids, reps, mash_candidates, genome_files, ani_sp):
+    """Speculatively start calculating ANI required to process upcoming genomes during greedy selection.
+
+    ANI is calculated between each genome and current representatives, and between
+    each genome and preceding genomes in the window which are likely to become new
+    representatives as they have no current representative with a Mash ANI above the
+    species threshold. Calculation proceeds in the background while genomes are
+    processed, with values placed in the ANI cache as they are collected by the
+    per-genome calls to pairs(). These calls wait for anticipated values which
+    are still being calculated and calculate any values not anticipated, so
+    selection is unaffected.
+
+    Parameters
+    ----------
+    ani_engine : ANIEngine
+        Engine used to calculate ANI.
+    window_gids : list
+        Genomes to prefetch ANI for, in the order they will be processed.
+    reps : set
+        Current representatives.
+    mash_candidates : MashCandidateIndex
+        Candidate genome pairs with a Mash ANI above the filtering threshold.
+    genome_files : dict
+        Genomic file of each genome.
+    ani_sp : float
+        ANI threshold for species.
+    """
+
+    likely_reps = set()
+    ani_pairs = []
+    for cur_gid in window_gids:
+        if cur_gid not in mash_candidates:
+            continue
+
+        for rep_gid, _ani in mash_candidates.candidates(cur_gid):
+            if rep_gid in reps or rep_gid in likely_reps:
+                ani_pairs.append((cur_gid, rep_gid))
+                ani_pairs.append((rep_gid, cur_gid))
+
+        if mash_candidates.max_ani(cur_gid, reps) < ani_sp:
+            likely_reps.add(cur_gid)
+
+    ani_engine.prefetch(ani_pairs, genome_files)
+
+
+def block_greedy_ani(ani_engine, block_gids, reps, mash_candidates, genome_files):
+    """Calculate ANI required to process a block of genomes during greedy selection.
+
+    ANI is calculated between each genome and all current representatives and all
+    preceding genomes in the block, subject to the same Mash ANI filtering used when
+    processing a single genome. This includes every pair that can be required to
+    process the block, regardless of which genomes become new representatives.
+
+    Returns
+    -------
+    dict
+        ANI and AF between genome pairs, ani_af[qid][rid] -> (ANI, AF).
+    """
+
+    block_index = {gid: idx for idx, gid in enumerate(block_gids)}
+
+    ani_pairs = []
+    for idx, cur_gid in enumerate(block_gids):
+        for rep_gid, _ani in mash_candidates.candidates(cur_gid):
+            if rep_gid in reps or block_index.get(rep_gid, idx) < idx:
+                ani_pairs.append((cur_gid, rep_gid))
+                ani_pairs.append((rep_gid, cur_gid))
+
+    return ani_engine.pairs(ani_pairs, genome_files, report_progress=False)
@@ -21,20 +21,19 @@ import logging
 import ntpath
 import pickle
 import operator
-from itertools import combinations, permutations
-from collections import defaultdict, namedtuple
-
-from biolib.external.execute import check_dependencies
+from collections import namedtuple
 
 from numpy import (mean as np_mean,
                     std as np_std)
 
-from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 from gtdb_species_clusters.type_genome_utils import (ClusteredGenome,
                                                         GenomeRadius,
                                                         symmetric_ani,
+                                                        symmetric_ani_bound,
                                                         write_rep_radius,
                                                         write_clusters)
                                                         
@@ -50,11 +49,11 @@ class IntraSpeciesDereplication(object):
                     max_genomes_per_sp,
                     ani_cache_file, 
                     cpus, 
-                    output_dir):
+                    output_dir,
+                    ani_options=None,
+                    mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -67,8 +66,8 @@ class IntraSpeciesDereplication(object):
         # minimum MASH ANI value for dereplicating within a species
         self.min_mash_intra_sp_ani = derep_ani - 1.0
 
-        self.mash = Mash(self.cpus)
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.mash = create_mash(self.cpus, **(mash_options or {}))
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
         self.user_id_map = {}
 
@@ -94,24 +93,15 @@ class IntraSpeciesDereplication(object):
                                 silence=True)
 
         # read Mash distances
-        mash_ani = self.mash.read_ani(mash_dist_file)
-        
-        # report pairs above Mash threshold
-        revised_mash_ani = defaultdict(lambda: {})
-        count = 0
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if qid != rid:
-                    new_qid = canonical_gid(self.user_id_map.get(qid, qid))
-                    new_rid = canonical_gid(self.user_id_map.get(rid, rid))
-                    revised_mash_ani[new_qid][new_rid] = mash_ani[qid][rid]
-                    count += 1
+        mash_candidates = MashCandidateIndex(self.mash.read_ani(mash_dist_file),
+                                                INIT_MASH_ANI_FILTER,
+                                                lambda gid: canonical_gid(self.user_id_map.get(gid, gid)))
                         
         self.logger.info(' - identified {:,} pairs passing Mash filtering of ANI >= {:.1f}%.'.format(
-                            count,
+                            mash_candidates.num_pairs(),
                             INIT_MASH_ANI_FILTER))
 
-        return revised_mash_ani
+        return mash_candidates
         
     def priority_score(self, gid, genomes):
         """Get priority score of genome."""
@@ -135,27 +125,20 @@ class IntraSpeciesDereplication(object):
         
         return [d[0] for d in sorted_by_priority]
 
-    def mash_sp_dereplicate(self, mash_ani, sorted_gids, ani_threshold):
+    def mash_sp_dereplicate(self, mash_candidates, sorted_gids, ani_threshold):
         """Dereplicate genomes in species using Mash distances."""
         
         # perform greedy selection of new representatives
         sp_reps = []
+        sp_rep_set = set()
         for gid in sorted_gids:
-            clustered = False
-            for rep_id in sp_reps:
-                if gid in mash_ani:
-                    ani = mash_ani[gid].get(rep_id, 0)
-                else:
-                    ani = 0
-
-                if ani >= ani_threshold:
-                    clustered = True
-                    break
+            clustered = mash_candidates.max_ani(gid, sp_rep_set) >= ani_threshold
 
             if not clustered:
                 # genome was not assigned to an existing representative,
                 # so make it a new representative genome
                 sp_reps.append(gid)
+                sp_rep_set.add(gid)
 
         return sp_reps
 
@@ -173,13 +156,13 @@ class IntraSpeciesDereplication(object):
         sorted_gids = [rid] + sorted_gids
 
         # calculate Mash ANI between genomes
-        mash_ani = []
+        mash_candidates = None
         if len(sorted_gids) > 1:
             # calculate MASH distances between genomes
             out_prefix = os.path.join(mash_out_dir, species[3:].lower().replace(' ', '_'))
-            mash_ani = self.mash_sp_ani(sorted_gids,
-                                            genomes,
-                                            out_prefix)
+            mash_candidates = self.mash_sp_ani(sorted_gids,
+                                                genomes,
+                                                out_prefix)
                                             
         # perform initial dereplication using Mash for species with excessive
         # numbers of genomes
@@ -194,7 +177,7 @@ class IntraSpeciesDereplication(object):
                     sorted_gids = mash_rep_gids[0:self.max_genomes_per_sp]
                     break
                     
-                mash_rep_gids = self.mash_sp_dereplicate(mash_ani, 
+                mash_rep_gids = self.mash_sp_dereplicate(mash_candidates, 
                                                             sorted_gids, 
                                                             ani_threshold)
                     
@@ -241,22 +224,28 @@ class IntraSpeciesDereplication(object):
                 prev_mash_rep_gids = mash_rep_gids
                 prev_ani_threshold = ani_threshold
         
-        # calculate FastANI ANI/AF between genomes passing Mash filtering
+        # calculate FastANI ANI/AF between genomes passing Mash filtering,
+        # with the reverse direction only calculated for pairs where it
+        # could change the outcome of dereplication
+        gid_order = {gid: idx for idx, gid in enumerate(sorted_gids)}
         ani_pairs = set()
-        for gid1, gid2 in permutations(sorted_gids, 2):
-            if gid1 in mash_ani and gid2 in mash_ani[gid1]:
-                if mash_ani[gid1][gid2] >= self.min_mash_intra_sp_ani:
-                    ani_pairs.add((gid1, gid2))
-                    ani_pairs.add((gid2, gid1))
+        if mash_candidates:
+            for qid in sorted_gids:
+                for rid, _ani in mash_candidates.candidates(qid, gid_order, self.min_mash_intra_sp_ani):
+                    if gid_order[qid] < gid_order[rid]:
+                        ani_pairs.add((qid, rid))
+                    else:
+                        ani_pairs.add((rid, qid))
+        ani_pairs = sorted(ani_pairs, key=lambda pair: (gid_order[pair[0]], gid_order[pair[1]]))
         
         self.logger.info(' - calculating FastANI between {:,} pairs with Mash ANI >= {:.1f}%.'.format(
                             len(ani_pairs),
                             self.min_mash_intra_sp_ani))
-        ani_af = self.fastani.pairs(ani_pairs, 
-                                    genomes.genomic_files, 
-                                    report_progress=False,
-                                    check_cache=True)
-        self.fastani.write_cache(silence=True)
+        ani_af = self.fastani.symmetric_pairs(ani_pairs, 
+                                                genomes.genomic_files, 
+                                                self.derep_ani,
+                                                self.derep_af,
+                                                report_progress=False)
         
         # perform greedy dereplication
         sp_reps = []
@@ -264,7 +253,7 @@ class IntraSpeciesDereplication(object):
             # determine if genome clusters with existing representative
             clustered = False
             for rid in sp_reps:
-                ani, af = symmetric_ani(ani_af, gid, rid)
+                ani, af = symmetric_ani_bound(ani_af, gid, rid)
 
                 if ani >= self.derep_ani and af >= self.derep_af:
                     clustered = True
@@ -284,6 +273,24 @@ class IntraSpeciesDereplication(object):
             subsp_clusters[rid] = [rid]
             
         non_rep_gids = set(sorted_gids) - set(sp_reps)
+        
+        # assigning genomes to the most similar representative requires
+        # symmetric ANI so calculate any missing reverse directions
+        rev_pairs = []
+        for gid in non_rep_gids:
+            for rid in sp_reps:
+                if rid in ani_af.get(gid, {}) and gid not in ani_af.get(rid, {}):
+                    rev_pairs.append((rid, gid))
+                elif gid in ani_af.get(rid, {}) and rid not in ani_af.get(gid, {}):
+                    rev_pairs.append((gid, rid))
+                    
+        rev_ani_af = self.fastani.pairs(rev_pairs, 
+                                        genomes.genomic_files, 
+                                        report_progress=False)
+        for qid, rids in rev_ani_af.items():
+            ani_af.setdefault(qid, {}).update(rids)
+        self.fastani.write_cache(silence=True)
+        
         for gid in non_rep_gids:
             closest_rid = None
             max_ani = 0
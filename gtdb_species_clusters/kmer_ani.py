@@ -0,0 +1,233 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import gzip
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from gtdb_species_clusters.ani_engine import ANIEngine
+
+
+# 2-bit encoding of nucleotides, with 4 indicating an ambiguous base
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b'ACGT', range(4)):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def read_contigs(genome_file):
+    """Read contigs from genomic FASTA file as arrays of 2-bit encoded bases."""
+
+    if genome_file.endswith('.gz'):
+        f = gzip.open(genome_file, 'rb')
+    else:
+        f = open(genome_file, 'rb')
+
+    contigs = []
+    seq = []
+    with f:
+        for line in f:
+            if line.startswith(b'>'):
+                if seq:
+                    contigs.append(BASE_CODES[np.frombuffer(b''.join(seq), dtype=np.uint8)])
+                seq = []
+            else:
+                seq.append(line.rstrip())
+
+    if seq:
+        contigs.append(BASE_CODES[np.frombuffer(b''.join(seq), dtype=np.uint8)])
+
+    return contigs
+
+
+def canonical_kmers(codes, k):
+    """Get canonical k-mers in a sequence.
+
+    Parameters
+    ----------
+    codes : ndarray
+        2-bit encoded bases.
+    k : int
+        Length of k-mers.
+
+    Returns
+    -------
+    ndarray, ndarray
+        Canonical k-mers and their start position in the sequence.
+        K-mers containing ambiguous bases are omitted.
+    """
+
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+    fwd = np.zeros(num_kmers, dtype=np.uint64)
+    rev = np.zeros(num_kmers, dtype=np.uint64)
+    bases = np.minimum(codes, 3).astype(np.uint64)
+    for idx in range(k):
+        window = bases[idx:idx + num_kmers]
+        fwd = (fwd << np.uint64(2)) | window
+        rev |= (np.uint64(3) - window) << np.uint64(2 * idx)
+
+    ambiguous = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (ambiguous[k:] - ambiguous[:num_kmers]) == 0
+    positions = np.nonzero(valid)[0]
+
+    return np.minimum(fwd, rev)[valid], positions
+
+
+class KmerANI(ANIEngine):
+    """Estimate average nucleotide identity between genomes from shared k-mers.
+
+    Following FastANI, the query genome is split into fragments and the identity
+    of each fragment to the reference genome is estimated. Here, identity is
+    estimated from the fraction of k-mers in a fragment found in the reference
+    genome, which is expected to be identity^k for independent substitutions.
+    ANI is the mean identity of fragments meeting a minimum identity, and AF is the
+    fraction of fragments meeting this identity. The calculation is performed
+    in-process with NumPy so no external tools are required.
+    """
+
+    # version of estimator, which must be changed if results change
+    version = '1.0'
+
+    # values predating recording of producers were calculated with FastANI
+    accept_legacy_cache = False
+
+    # number of genomes to retain k-mers for in each worker process
+    max_loaded_genomes = 32
+
+    # length of genome fragments and k-mers, and minimum
+    # identity of fragments, following FastANI defaults
+    frag_len = 3000
+    k = 16
+    min_identity = 0.80
+
+    def __init__(self, ani_cache_file, cpus, **engine_args):
+        """Initialization."""
+
+        self._ref_kmers = OrderedDict()
+        self._query_kmers = OrderedDict()
+
+        ANIEngine.__init__(self, ani_cache_file, cpus, **engine_args)
+
+        self.logger.info('Using NumPy k-mer ANI engine v{}.'.format(self.version))
+
+    @classmethod
+    def current_producer(cls):
+        """Get string identifying the version and parameters of the k-mer ANI estimator."""
+
+        return f'kmerANI:{cls.version}:k={cls.k}:fragLen={cls.frag_len}:minIdentity={cls.min_identity}'
+
+    def _get_producer(self):
+        """Get string identifying the version and parameters of the k-mer ANI estimator."""
+
+        return self.current_producer()
+
+    def _cached(self, loaded, genome_file, load):
+        """Get k-mers for genome, retaining the most recently used genomes."""
+
+        kmers = loaded.get(genome_file)
+        if kmers is not None:
+            loaded.move_to_end(genome_file)
+            return kmers
+
+        kmers = load(genome_file)
+        loaded[genome_file] = kmers
+        if len(loaded) > self.max_loaded_genomes:
+            loaded.popitem(last=False)
+
+        return kmers
+
+    def _load_ref_kmers(self, genome_file):
+        """Get sorted, unique canonical k-mers in reference genome."""
+
+        kmers = [canonical_kmers(codes, self.k)[0] for codes in read_contigs(genome_file)]
+        if not kmers:
+            return np.zeros(0, dtype=np.uint64)
+
+        return np.unique(np.concatenate(kmers))
+
+    def _load_query_kmers(self, genome_file):
+        """Get canonical k-mers in each fragment of query genome.
+
+        Returns
+        -------
+        ndarray, ndarray, int
+            K-mers, index of fragment containing each k-mer, and number of fragments.
+        """
+
+        all_kmers = []
+        all_frag_ids = []
+        num_frags = 0
+        for codes in read_contigs(genome_file):
+            contig_frags = len(codes) // self.frag_len
+            if contig_frags == 0:
+                continue
+
+            kmers, positions = canonical_kmers(codes[0:contig_frags * self.frag_len], self.k)
+
+            # only consider k-mers fully contained in a fragment
+            in_frag = (positions % self.frag_len) <= self.frag_len - self.k
+            all_kmers.append(kmers[in_frag])
+            all_frag_ids.append(num_frags + positions[in_frag] // self.frag_len)
+            num_frags += contig_frags
+
+        if not all_kmers:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), 0
+
+        return np.concatenate(all_kmers), np.concatenate(all_frag_ids), num_frags
+
+    def ani_af(self, query_kmers, ref_kmers):
+        """Estimate ANI and AF between query and reference genome."""
+
+        kmers, frag_ids, num_frags = query_kmers
+        if num_frags == 0 or len(ref_kmers) == 0:
+            return 0.0, 0.0
+
+        idx = np.minimum(np.searchsorted(ref_kmers, kmers), len(ref_kmers) - 1)
+        shared = ref_kmers[idx] == kmers
+
+        total = np.bincount(frag_ids, minlength=num_frags)
+        hits = np.bincount(frag_ids, weights=shared, minlength=num_frags)
+
+        has_kmers = total > 0
+        identity = np.zeros(num_frags)
+        identity[has_kmers] = (hits[has_kmers] / total[has_kmers]) ** (1.0 / self.k)
+
+        mapped = identity >= self.min_identity
+        if not mapped.any():
+            return 0.0, 0.0
+
+        return 100 * float(identity[mapped].mean()), float(mapped.sum()) / num_frags
+
+    def _calculate_batch(self, q_files, r_files):
+        """Calculate ANI between all query and reference genomic files."""
+
+        anis = array('f')
+        afs = array('f')
+        for q_gf in q_files:
+            query_kmers = self._cached(self._query_kmers, q_gf, self._load_query_kmers)
+            for r_gf in r_files:
+                ref_kmers = self._cached(self._ref_kmers, r_gf, self._load_ref_kmers)
+                ani, af = self.ani_af(query_kmers, ref_kmers)
+                anis.append(ani)
+                afs.append(af)
+
+        return anis, afs
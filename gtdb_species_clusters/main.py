@@ -20,6 +20,8 @@ import sys
 import csv
 import logging
 import random
+import shutil
+import tempfile
 from collections import defaultdict
 
 from biolib.common import check_file_exists, make_sure_path_exists, is_float
@@ -28,7 +30,10 @@ from biolib.taxonomy import Taxonomy
 from biolib.newick import parse_label
 
 from gtdb_species_clusters.qc_genomes import QcGenomes
-from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
+from gtdb_species_clusters.ani_planner import ANIPlanner
+from gtdb_species_clusters.ani_queue import ANIWorker
+from gtdb_species_clusters.genome_staging import GenomeStaging
 from gtdb_species_clusters.select_type_genomes import SelectTypeGenomes
 from gtdb_species_clusters.cluster_named_types import ClusterNamedTypes
 from gtdb_species_clusters.cluster_de_novo import ClusterDeNovo
@@ -59,6 +64,7 @@ from gtdb_species_clusters.update_summary_stats import UpdateSummaryStats
 
 from gtdb_species_clusters.merge_test import MergeTest
 from gtdb_species_clusters.intra_sp_derep import IntraSpeciesDereplication
+from gtdb_species_clusters.ani_cache_manager import ANICacheManager
 
 from gtdb_species_clusters.exceptions import GTDB_Error
 
@@ -68,6 +74,10 @@ class OptionsParser():
         """Initialization"""
         self.logger = logging.getLogger()
         
+        # options used to create ANI engines and Mash backends
+        self.ani_options = {}
+        self.mash_options = {}
+        
     def qc_genomes(self, args):
         """Quality check all potential GTDB genomes."""
         
@@ -113,7 +123,11 @@ class OptionsParser():
         make_sure_path_exists(args.output_dir)
 
         try:
-            p = SelectTypeGenomes(args.ani_cache_file, args.cpus, args.output_dir)
+            p = SelectTypeGenomes(args.ani_cache_file, 
+                                    args.cpus, 
+                                    args.output_dir,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
             p.run(args.qc_file,
                         args.gtdb_metadata_file,
                         args.ltp_blast_file,
@@ -146,7 +160,9 @@ class OptionsParser():
                                     args.af_sp,
                                     args.ani_cache_file, 
                                     args.cpus,
-                                    args.output_dir)
+                                    args.output_dir,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
             p.run(args.qc_file,
                     args.gtdb_metadata_file,
                     args.genome_path_file,
@@ -180,7 +196,11 @@ class OptionsParser():
                                     args.af_sp,
                                     args.ani_cache_file, 
                                     args.cpus,
-                                    args.output_dir)
+                                    args.output_dir,
+                                    args.prefetch_genomes,
+                                    args.greedy_block_size,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
             p.run(args.qc_file,
                         args.gtdb_metadata_file,
                         args.gtdb_user_genomes_file,
@@ -209,7 +229,9 @@ class OptionsParser():
         try:
             p = ClusterUser(args.ani_cache_file, 
                                 args.cpus,
-                                args.output_dir)
+                                args.output_dir,
+                                ani_options=self.ani_options,
+                                mash_options=self.mash_options)
             p.run(args.gtdb_metadata_file,
                         args.genome_path_file,
                         args.final_cluster_file)
@@ -306,7 +328,7 @@ class OptionsParser():
         check_file_exists(args.untrustworthy_type_ledger)
         make_sure_path_exists(args.output_dir)
         
-        p = ResolveTypes(args.ani_cache_file, args.cpus, args.output_dir)
+        p = ResolveTypes(args.ani_cache_file, args.cpus, args.output_dir, ani_options=self.ani_options)
         p.run(args.cur_gtdb_metadata_file,
                 args.cur_genomic_path_file,
                 args.qc_passed_file,
@@ -374,7 +396,7 @@ class OptionsParser():
         check_file_exists(args.sp_priority_ledger)
         make_sure_path_exists(args.output_dir)
         
-        p = RepActions(args.ani_cache_file, args.cpus, args.output_dir)
+        p = RepActions(args.ani_cache_file, args.cpus, args.output_dir, ani_options=self.ani_options)
         p.run(args.rep_change_summary_file,
                 args.prev_gtdb_metadata_file,
                 args.prev_genomic_path_file,
@@ -408,7 +430,9 @@ class OptionsParser():
         
         p = UpdateSelectRepresentatives(args.ani_cache_file, 
                                     args.cpus, 
-                                    args.output_dir)
+                                    args.output_dir,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
         p.run(args.updated_sp_cluster_file,
                 args.cur_gtdb_metadata_file,
                 args.cur_genomic_path_file,
@@ -441,7 +465,9 @@ class OptionsParser():
                                     args.af_sp,
                                     args.ani_cache_file, 
                                     args.cpus, 
-                                    args.output_dir)
+                                    args.output_dir,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
         p.run(args.named_rep_file,
                 args.cur_gtdb_metadata_file,
                 args.cur_genomic_path_file,
@@ -474,7 +500,8 @@ class OptionsParser():
         p = UpdateErroneousNCBI(args.ani_ncbi_erroneous,
                             args.ani_cache_file, 
                             args.cpus, 
-                            args.output_dir)
+                            args.output_dir,
+                            ani_options=self.ani_options)
         p.run(args.gtdb_clusters_file,
                 args.cur_gtdb_metadata_file,
                 args.cur_genomic_path_file,
@@ -541,7 +568,11 @@ class OptionsParser():
                                     args.af_sp,
                                     args.ani_cache_file, 
                                     args.cpus, 
-                                    args.output_dir)
+                                    args.output_dir,
+                                    args.prefetch_genomes,
+                                    args.greedy_block_size,
+                                    ani_options=self.ani_options,
+                                    mash_options=self.mash_options)
         p.run(args.named_cluster_file,
                 args.cur_gtdb_metadata_file,
                 args.cur_genomic_path_file,
@@ -629,7 +660,8 @@ class OptionsParser():
 
         p = UpdateSpeciesInit(args.ani_cache_file, 
                                 args.cpus, 
-                                args.output_dir)
+                                args.output_dir,
+                                ani_options=self.ani_options)
         p.run(args.gtdb_clusters_file,
                 args.prev_gtdb_metadata_file,
                 args.prev_genomic_path_file,
@@ -875,7 +907,7 @@ class OptionsParser():
         
         make_sure_path_exists(args.output_dir)
         
-        p = MergeTest(args.ani_cache_file, args.cpus, args.output_dir)
+        p = MergeTest(args.ani_cache_file, args.cpus, args.output_dir, ani_options=self.ani_options)
         p.run(args.gtdb_metadata_file,
                 args.genome_path_file,
                 args.species1,
@@ -898,7 +930,9 @@ class OptionsParser():
                                         args.max_genomes_per_sp,
                                         args.ani_cache_file, 
                                         args.cpus, 
-                                        args.output_dir)
+                                        args.output_dir,
+                                        ani_options=self.ani_options,
+                                        mash_options=self.mash_options)
         p.run(args.gtdb_clusters_file,
                 args.gtdb_metadata_file,
                 args.genomic_path_file,
@@ -1014,15 +1048,89 @@ class OptionsParser():
                             args.max_genomes,
                             args.ani_cache_file,
                             args.cpus, 
-                            args.output_dir)
+                            args.output_dir,
+                            ani_options=self.ani_options,
+                            mash_options=self.mash_options)
         p.run(args.cluster_file, 
                 args.genome_path_file,
                 args.gtdb_metadata_file)
 
+    def ani_cache(self, args):
+        """Inspect and maintain ANI cache files."""
+        
+        p = ANICacheManager()
+        if args.ani_cache_action == 'merge':
+            for ani_cache_file in args.ani_cache_files:
+                check_file_exists(ani_cache_file)
+            p.merge(args.ani_cache_files, args.output_file, args.output_format)
+        elif args.ani_cache_action == 'compact':
+            check_file_exists(args.ani_cache_file)
+            p.compact(args.ani_cache_file, args.output_format)
+        elif args.ani_cache_action == 'stats':
+            check_file_exists(args.ani_cache_file)
+            p.stats(args.ani_cache_file)
+        elif args.ani_cache_action == 'subset':
+            check_file_exists(args.ani_cache_file)
+            check_file_exists(args.genome_id_file)
+            p.subset(args.ani_cache_file, 
+                        args.genome_id_file, 
+                        args.output_file, 
+                        args.require_both, 
+                        args.output_format)
+        elif args.ani_cache_action == 'upgrade':
+            check_file_exists(args.ani_cache_file)
+            p.upgrade(args.ani_cache_file, 
+                        args.purge, 
+                        args.purge_legacy, 
+                        args.ani_engine, 
+                        args.producer)
+        else:
+            self.logger.error('Unknown ani_cache action: {}'.format(args.ani_cache_action))
+            sys.exit(-1)
+            
+        self.logger.info('Done.')
+        
+    def ani_worker(self, args):
+        """Calculate ANI for tasks in a shared ANI task queue."""
+        
+        engine = create_ani_engine(None, 1, **self.ani_options)
+        p = ANIWorker(args.queue_dir, engine, args.cpus, args.idle_timeout)
+        p.run()
+        
+        self.logger.info('Done.')
+
     def run(self, args):
         """Parse user arguments and call the correct pipeline(s)"""
 
         logging.basicConfig(format='', level=logging.INFO)
+        
+        # genomic files are staged once for use by both ANI engines and Mash
+        staging = None
+        if getattr(args, 'staging_dir', None):
+            staging = GenomeStaging(args.staging_dir, 
+                                    int(args.staging_size * 1024**3), 
+                                    getattr(args, 'cpus', 1))
+            
+        planner = None
+        dry_run_dir = None
+        if getattr(args, 'dry_run', False):
+            # output files are written to a temporary directory so 
+            # they are not mistaken for the results of a complete run
+            planner = ANIPlanner(args.cpus)
+            dry_run_dir = tempfile.mkdtemp(prefix='gtdb_dry_run_')
+            args.output_dir = dry_run_dir
+            self.logger.info(f'Performing dry run without calculating ANI, output files written to {dry_run_dir} will be removed.')
+            
+        self.ani_options = {'engine': getattr(args, 'ani_engine', 'fastani'),
+                            'cache_format': getattr(args, 'ani_cache_format', None),
+                            'fingerprint_keys': getattr(args, 'ani_cache_fingerprint', False),
+                            'shared_cache': getattr(args, 'ani_cache_shared', False),
+                            'queue_dir': getattr(args, 'ani_queue_dir', None),
+                            'planner': planner,
+                            'staging': staging}
+        self.mash_options = {'backend': getattr(args, 'mash_backend', 'mash'),
+                                'sketch_store_dir': getattr(args, 'mash_sketch_dir', None),
+                                'staging': staging}
 
         if args.subparser_name == 'qc_genomes':
             self.qc_genomes(args)
@@ -1088,8 +1196,16 @@ class OptionsParser():
             self.rep_compare(args)
         elif args.subparser_name == 'cluster_stats':
             self.cluster_stats(args)
+        elif args.subparser_name == 'ani_cache':
+            self.ani_cache(args)
+        elif args.subparser_name == 'ani_worker':
+            self.ani_worker(args)
         else:
             self.logger.error('Unknown gtdb_species_clusters command: ' + args.subparser_name + '\n')
             sys.exit()
+            
+        if dry_run_dir:
+            planner.report()
+            shutil.rmtree(dry_run_dir, ignore_errors=True)
 
         return 0
@@ -23,24 +23,84 @@ import ntpath
 import logging
 import multiprocessing as mp
 from itertools import combinations
-from collections import defaultdict
 
 from biolib.external.execute import check_dependencies, run
 
 from gtdb_species_clusters.genome_utils import read_genome_path, canonical_gid
+from gtdb_species_clusters.mash_sketch_store import MashSketchStore
+from gtdb_species_clusters.mash_ani import MashANI, NPZ_MAGIC
+
+
+# backends available for sketching genomes and calculating Mash distances
+MASH_BACKENDS = ('mash', 'numpy')
+
+
+def create_mash(cpus, backend='mash', **mash_args):
+    """Create backend for calculating Mash distance between genomes.
+    
+    Parameters
+    ----------
+    cpus : int
+        Number of CPUs to use.
+    backend : str
+        Name of backend.
+    mash_args : dict
+        Options of the backend, as described by Mash.
+    """
+        
+    if backend == 'mash':
+        return Mash(cpus, **mash_args)
+    elif backend == 'numpy':
+        from gtdb_species_clusters.minhash import MinHash
+        return MinHash(cpus, **mash_args)
+        
+    raise ValueError(f'Unknown Mash backend: {backend}')
+    
 
 class Mash(object):
     """Calculate Mash distance between genomes."""
 
-    def __init__(self, cpus):
-        """Initialization."""
+    def __init__(self, cpus, sketch_store_dir=None, staging=None):
+        """Initialization.
         
-        check_dependencies(['mash'])
+        Parameters
+        ----------
+        cpus : int
+            Number of CPUs to use.
+        sketch_store_dir : str
+            Directory of persistent store of per-genome sketches, or None to sketch all genomes.
+        staging : GenomeStaging
+            Staging area for genomic files in local scratch space, or None to disable staging.
+        """
         
         self.cpus = cpus
+        
+        # k-mer and sketch size used to create sketches
+        self.kmer_size = 16
+        self.sketch_size = 5000
 
         self.logger = logging.getLogger('timestamp')
         
+        # Mash ANI values read while calculating distances, indexed by distance file
+        self._mash_ani = {}
+        
+        # genomic files are staged to local scratch space if enabled
+        self.staging = staging
+        
+        # sketches are assembled from a store of per-genome sketches if enabled
+        self.sketch_store = None
+        if sketch_store_dir:
+            self.sketch_store = MashSketchStore(sketch_store_dir, 
+                                                self.kmer_size, 
+                                                self.sketch_size, 
+                                                cpus)
+        
+        self._init_backend()
+        
+    def _init_backend(self):
+        """Initialize backend used to create sketches and calculate distances."""
+        
+        check_dependencies(['mash'])
         self.logger.info('Using Mash v{}.'.format(self._get_version()))
         
     def _get_version(self):
@@ -75,39 +135,191 @@ class Mash(object):
             
         return gid
 
-    def sketch(self, gids, genome_files, genome_list_file, sketch_file, silence=False):
-        """Create Mash sketch for genomes."""
+    def _sketch_file(self, sketch_file):
+        """Get file used to store a sketch requested with the given name."""
         
-        # create Mash sketch for potential representative genomes
-        if not os.path.exists(sketch_file):
-            fout = open(genome_list_file, 'w')
-            for gid in gids:
-                fout.write(genome_files[gid] + '\n')
-            fout.close()
+        return sketch_file
 
+    def _sketch_compatible(self, sketch_file):
+        """Check if sketch file was created by this backend."""
+        
+        with open(sketch_file, 'rb') as f:
+            return f.read(len(NPZ_MAGIC)) != NPZ_MAGIC
+
+    def _sketch_members(self, gids, genome_files):
+        """Get genomic file of each genome in a sketch, along with its modification time and size."""
+        
+        members = {}
+        for gid in gids:
+            genome_file = os.path.abspath(genome_files[gid])
+            stat = os.stat(genome_file)
+            members[gid] = (genome_file, stat.st_mtime_ns, stat.st_size)
+            
+        return members
+        
+    def _read_members(self, sketch_file):
+        """Read genomes recorded as members of a sketch, or None if no record exists."""
+        
+        members_file = sketch_file + '.members'
+        if not os.path.exists(members_file):
+            return None
+            
+        members = {}
+        with open(members_file) as f:
+            for line in f:
+                gid, genome_file, mtime_ns, size = line.rstrip('\n').split('\t')
+                members[gid] = (genome_file, int(mtime_ns), int(size))
+                
+        return members
+        
+    def _write_members(self, sketch_file, members):
+        """Record genomes that are members of a sketch."""
+        
+        members_file = sketch_file + '.members'
+        with open(members_file + '.tmp', 'w') as fout:
+            for gid, (genome_file, mtime_ns, size) in members.items():
+                fout.write(f'{gid}\t{genome_file}\t{mtime_ns}\t{size}\n')
+        os.replace(members_file + '.tmp', members_file)
+        
+    def _create_sketch(self, gids, genome_files, genome_list_file, sketch_file, silence):
+        """Create Mash sketch for genomes, replacing any existing sketch."""
+        
+        if self.sketch_store:
             if not silence:
-                self.logger.info(f'Creating Mash sketch for {len(gids):,} genomes.')
-            cmd = 'mash sketch -l -p %d -k 16 -s 5000 -o %s %s 2> /dev/null' % (self.cpus, 
-                                                                                sketch_file, 
-                                                                                genome_list_file)
-            run(cmd)
-        else:
+                self.logger.info(f'Creating Mash sketch for {len(gids):,} genomes from sketch store.')
+            genome_sketches = self.sketch_store.sketch([genome_files[gid] for gid in gids], self.staging)
+            self.sketch_store.paste(genome_sketches, genome_list_file, sketch_file)
+            return
+            
+        sketch_files = [genome_files[gid] for gid in gids]
+        if self.staging:
+            staged_files = self.staging.stage_files(sketch_files)
+            sketch_files = [staged_files[gf] for gf in sketch_files]
+            self.staging.report('Mash sketching')
+            
+        fout = open(genome_list_file, 'w')
+        for gf in sketch_files:
+            fout.write(gf + '\n')
+        fout.close()
+
+        if not silence:
+            self.logger.info(f'Creating Mash sketch for {len(gids):,} genomes.')
+        cmd = 'mash sketch -l -p %d -k %d -s %d -o %s %s 2> /dev/null' % (self.cpus, 
+                                                                            self.kmer_size,
+                                                                            self.sketch_size,
+                                                                            sketch_file, 
+                                                                            genome_list_file)
+        run(cmd)
+        
+    def _extend_sketch(self, gids, genome_files, genome_list_file, sketch_file, silence):
+        """Add genomes to an existing Mash sketch."""
+        
+        # Mash appends the .msh extension to output files
+        sketch_prefix = sketch_file[0:-4] if sketch_file.endswith('.msh') else sketch_file
+        added_sketch_file = sketch_prefix + '.added.msh'
+        self._create_sketch(gids, genome_files, genome_list_file, added_sketch_file, silence)
+        
+        cmd = 'mash paste %s %s %s 2> /dev/null' % (sketch_prefix + '.extended', 
+                                                    sketch_file, 
+                                                    added_sketch_file)
+        run(cmd)
+        
+        os.replace(sketch_prefix + '.extended.msh', sketch_file)
+        os.remove(added_sketch_file)
+
+    def sketch(self, gids, genome_files, genome_list_file, sketch_file, silence=False):
+        """Create Mash sketch for genomes.
+        
+        The genomes in a sketch are recorded so an existing sketch can be reused
+        if it contains the same genomes, extended if genomes have only been added,
+        or recreated if genomes have been removed or their genomic files modified.
+        """
+        
+        sketch_file = self._sketch_file(sketch_file)
+        members = self._sketch_members(gids, genome_files)
+        
+        if os.path.exists(sketch_file) and not self._sketch_compatible(sketch_file):
+            if not silence:
+                self.logger.warning('Recreating previously generated sketch file created by a different Mash backend.')
+            os.remove(sketch_file)
+        
+        if os.path.exists(sketch_file):
+            prev_members = self._read_members(sketch_file)
+            if prev_members is None:
+                if not silence:
+                    self.logger.warning('Using previously generated sketch file with no record of its genomes.')
+                return
+                
+            if prev_members == members:
+                if not silence:
+                    self.logger.warning('Using previously generated sketch file.')
+                return
+                
+            if all(members.get(gid) == member for gid, member in prev_members.items()):
+                added_gids = [gid for gid in members if gid not in prev_members]
+                if not silence:
+                    self.logger.info(f'Extending previously generated sketch file with {len(added_gids):,} added genomes.')
+                self._extend_sketch(added_gids, genome_files, genome_list_file, sketch_file, silence)
+                self._write_members(sketch_file, members)
+                return
+                
             if not silence:
-                self.logger.warning('Using previously generated sketch file.')
+                self.logger.warning('Recreating previously generated sketch file as genomes have been removed or modified.')
+            os.remove(sketch_file)
+                
+        self._create_sketch(gids, genome_files, genome_list_file, sketch_file, silence)
+        self._write_members(sketch_file, members)
+            
+    def _dist(self, min_dist, ref_sketch_file, query_sketch_file, dist_file):
+        """Calculate Mash distances, reading the output of Mash as it is produced.
+        
+        Distances are written alongside the distance file as a compact sparse 
+        matrix of Mash ANI values, rather than the text output of Mash.
+        """
+        
+        cmd = ['mash', 'dist', 
+                '-p', str(self.cpus), 
+                '-d', str(min_dist), 
+                '-v', str(1e-5), 
+                ref_sketch_file, 
+                query_sketch_file]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with proc.stdout:
+            mash_ani = MashANI.read_mash_dist(proc.stdout, self._mash_genome_id)
+            
+        rtn = proc.wait()
+        if rtn != 0:
+            self.logger.error('Mash failed to calculate distances between {} and {}.'.format(ref_sketch_file, 
+                                                                                            query_sketch_file))
+            sys.exit(rtn)
+            
+        mash_ani.write(self._ani_file(dist_file))
+        self._mash_ani[dist_file] = mash_ani
+        
+    def _ani_file(self, dist_file):
+        """Get file with the compact Mash ANI values of a distance file."""
+        
+        dist_prefix = dist_file[0:-4] if dist_file.endswith('.dst') else dist_file
+        return dist_prefix + '.mash_ani.npz'
+            
+    def _dist_current(self, dist_file, sketch_files):
+        """Check if Mash ANI values exist and were created after their sketch files were last modified."""
+        
+        ani_file = self._ani_file(dist_file)
+        if not os.path.exists(ani_file):
+            return False
+            
+        dist_mtime = os.path.getmtime(ani_file)
+        return all(os.path.getmtime(sf) <= dist_mtime for sf in sketch_files)
             
     def dist_pairwise(self, min_dist, sketch_file, dist_file, silence=False):
         """Calculate pairwise Mash distance between genomes."""
 
-        if not os.path.exists(dist_file):
+        sketch_file = self._sketch_file(sketch_file)
+        if not self._dist_current(dist_file, [sketch_file]):
             if not silence:
                 self.logger.info('Calculating pairwise Mash distances between genomes (d = %.2f).' % min_dist)
-            cmd = 'mash dist -p %d -d %f -v %f %s %s > %s 2> /dev/null' % (self.cpus,
-                                                                            min_dist,
-                                                                            1e-5,
-                                                                            sketch_file, 
-                                                                            sketch_file, 
-                                                                            dist_file)
-            run(cmd)
+            self._dist(min_dist, sketch_file, sketch_file, dist_file)
         else:
             if not silence:
                 self.logger.warning('Using previously generated pairwise distance file.')
@@ -115,29 +327,33 @@ class Mash(object):
     def dist(self, min_dist, ref_sketch_file, query_sketch_file, dist_file, silence=False):
         """Calculate Mash distance between reference and query genomes."""
 
-        if not os.path.exists(dist_file):
+        ref_sketch_file = self._sketch_file(ref_sketch_file)
+        query_sketch_file = self._sketch_file(query_sketch_file)
+        if not self._dist_current(dist_file, [ref_sketch_file, query_sketch_file]):
             if not silence:
                 self.logger.info('Calculating Mash distances between reference and query genomes (d = %.2f).' % min_dist)
-            cmd = 'mash dist -p %d -d %f -v %f %s %s > %s 2> /dev/null' % (self.cpus,
-                                                                            min_dist,
-                                                                            1e-5,
-                                                                            ref_sketch_file, 
-                                                                            query_sketch_file, 
-                                                                            dist_file)
-            run(cmd)
+            self._dist(min_dist, ref_sketch_file, query_sketch_file, dist_file)
         else:
             if not silence:
                 self.logger.warning('Using previously generated pairwise distance file.')
             
     def read_ani(self, dist_file):
-        """Read ANI estimates."""
-
-        mash_ani = defaultdict(lambda: {})
-        for line in open(dist_file):
-            line_split = line.strip().split('\t')
+        """Read ANI estimates.
+        
+        Returns
+        -------
+        MashANI
+            Mash ANI between genomes, mash_ani[qid][rid] -> ANI.
+        """
+        
+        mash_ani = self._mash_ani.pop(dist_file, None)
+        if mash_ani is not None:
+            return mash_ani
             
-            rid = self._mash_genome_id(line_split[0])
-            qid = self._mash_genome_id(line_split[1])
-            mash_ani[qid][rid] = 100 - 100*float(line_split[2])
+        ani_file = self._ani_file(dist_file)
+        if os.path.exists(ani_file):
+            return MashANI.read(ani_file)
 
-        return mash_ani
+        # distance file written by 'mash dist'
+        with open(dist_file, 'rb') as f:
+            return MashANI.read_mash_dist(f, self._mash_genome_id)
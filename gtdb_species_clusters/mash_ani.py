@@ -0,0 +1,315 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+from array import array
+
+import numpy as np
+
+
+# first bytes of a NumPy .npz archive, used for compact Mash ANI and sketch files
+NPZ_MAGIC = b'PK\x03\x04'
+
+
+class MashANIRow(object):
+    """Mash ANI between a query genome and its reference genomes.
+
+    Supports the read-only dictionary operations used with a row of the
+    nested dictionary previously used for Mash ANI, mash_ani[qid][rid].
+    """
+
+    def __init__(self, mash_ani, indices, anis):
+        """Initialization."""
+
+        self.mash_ani = mash_ani
+        self.indices = indices
+        self.anis = anis
+
+    def _pos(self, rid):
+        """Get position of reference genome in row, or -1 if it is not present."""
+
+        idx = self.mash_ani.gid_index.get(rid)
+        if idx is None or len(self.indices) == 0:
+            return -1
+
+        pos = np.searchsorted(self.indices, idx)
+        if pos < len(self.indices) and self.indices[pos] == idx:
+            return pos
+
+        return -1
+
+    def get(self, rid, default=None):
+        """Get Mash ANI to reference genome."""
+
+        pos = self._pos(rid)
+        if pos < 0:
+            return default
+
+        return float(self.anis[pos])
+
+    def __getitem__(self, rid):
+        """Get Mash ANI to reference genome."""
+
+        pos = self._pos(rid)
+        if pos < 0:
+            raise KeyError(rid)
+
+        return float(self.anis[pos])
+
+    def __contains__(self, rid):
+        """Check if there is a Mash ANI to reference genome."""
+
+        return self._pos(rid) >= 0
+
+    def __len__(self):
+        """Number of reference genomes."""
+
+        return len(self.indices)
+
+    def __iter__(self):
+        """Iterate over reference genomes."""
+
+        gids = self.mash_ani.gids
+        for idx in self.indices:
+            yield gids[idx]
+
+    def keys(self):
+        """Reference genomes."""
+
+        return list(self)
+
+    def values(self):
+        """Mash ANI to each reference genome."""
+
+        return [float(ani) for ani in self.anis]
+
+    def items(self):
+        """Reference genomes and their Mash ANI."""
+
+        gids = self.mash_ani.gids
+        return [(gids[idx], float(ani)) for idx, ani in zip(self.indices, self.anis)]
+
+
+class MashANI(object):
+    """Sparse matrix of Mash ANI values between genomes.
+
+    Values are stored in compressed sparse row format, with a row for each
+    query genome and genome IDs interned as integer indices. ANI values are
+    stored as 64-bit floats so they compare against Mash ANI thresholds
+    exactly as the values calculated from Mash distances. Rows are accessed as mash_ani[qid][rid] or
+    mash_ani[qid].get(rid, 0), as with a nested dictionary.
+    """
+
+    def __init__(self, gids, indptr, indices, anis):
+        """Initialization.
+
+        Parameters
+        ----------
+        gids : list
+            Genome ID of each index.
+        indptr : ndarray
+            Start of each row in indices and anis, with a final entry giving the number of values.
+        indices : ndarray
+            Index of reference genome for each value, sorted within each row.
+        anis : ndarray
+            Mash ANI values.
+        """
+
+        self.gids = list(gids)
+        self.gid_index = {gid: idx for idx, gid in enumerate(self.gids)}
+
+        self.indptr = indptr
+        self.indices = indices
+        self.anis = anis
+
+    @staticmethod
+    def from_pairs(gids, q_indices, r_indices, anis):
+        """Create matrix from the genome indices and Mash ANI of each genome pair."""
+
+        q_indices = np.asarray(q_indices, dtype=np.int32)
+        r_indices = np.asarray(r_indices, dtype=np.int32)
+        anis = np.asarray(anis, dtype=np.float64)
+
+        order = np.lexsort((r_indices, q_indices))
+        q_indices = q_indices[order]
+        r_indices = r_indices[order]
+        anis = anis[order]
+
+        # retain the last value of any duplicated genome pair
+        if len(anis) > 1:
+            last = np.ones(len(anis), dtype=bool)
+            last[:-1] = (q_indices[1:] != q_indices[:-1]) | (r_indices[1:] != r_indices[:-1])
+            q_indices = q_indices[last]
+            r_indices = r_indices[last]
+            anis = anis[last]
+
+        indptr = np.zeros(len(gids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(q_indices, minlength=len(gids)), out=indptr[1:])
+
+        return MashANI(gids, indptr, r_indices, anis)
+
+    @staticmethod
+    def read_mash_dist(lines, mash_genome_id):
+        """Read output of 'mash dist' into a sparse matrix.
+
+        Parameters
+        ----------
+        lines : iterable
+            Lines of 'mash dist' output as bytes.
+        mash_genome_id : function
+            Function giving genome ID of a genome name reported by Mash.
+        """
+
+        gids = []
+        gid_index = {}
+        name_index = {}
+
+        def intern(name):
+            idx = name_index.get(name)
+            if idx is None:
+                gid = mash_genome_id(name.decode('utf-8'))
+                idx = gid_index.get(gid)
+                if idx is None:
+                    idx = len(gids)
+                    gid_index[gid] = idx
+                    gids.append(gid)
+                name_index[name] = idx
+
+            return idx
+
+        q_indices = array('i')
+        r_indices = array('i')
+        anis = array('d')
+        for line in lines:
+            line_split = line.split(b'\t', 3)
+            if len(line_split) < 3:
+                continue
+
+            r_indices.append(intern(line_split[0]))
+            q_indices.append(intern(line_split[1]))
+            anis.append(100 - 100*float(line_split[2]))
+
+        return MashANI.from_pairs(gids, q_indices, r_indices, anis)
+
+    def write(self, output_file):
+        """Write matrix to file in compact binary format."""
+
+        tmp_file = f'{output_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as fout:
+            np.savez(fout,
+                        gids=np.array(self.gids, dtype=str),
+                        indptr=self.indptr,
+                        indices=self.indices,
+                        anis=self.anis)
+
+        os.replace(tmp_file, output_file)
+
+    @staticmethod
+    def read(input_file):
+        """Read matrix written in compact binary format."""
+
+        with np.load(input_file, allow_pickle=False) as data:
+            return MashANI(data['gids'].tolist(),
+                            data['indptr'],
+                            data['indices'],
+                            data['anis'])
+
+    def _row_slice(self, qid):
+        """Get slice of values for query genome, or None if genome is not present."""
+
+        idx = self.gid_index.get(qid)
+        if idx is None:
+            return None
+
+        return slice(self.indptr[idx], self.indptr[idx + 1])
+
+    def __getitem__(self, qid):
+        """Get Mash ANI between query genome and its reference genomes."""
+
+        s = self._row_slice(qid)
+        if s is None:
+            s = slice(0, 0)
+
+        return MashANIRow(self, self.indices[s], self.anis[s])
+
+    def get(self, qid, default=None):
+        """Get Mash ANI between query genome and its reference genomes."""
+
+        if qid not in self:
+            return default
+
+        return self[qid]
+
+    def __contains__(self, qid):
+        """Check if there are Mash ANI values for query genome."""
+
+        s = self._row_slice(qid)
+        return s is not None and s.stop > s.start
+
+    def __iter__(self):
+        """Iterate over query genomes with Mash ANI values."""
+
+        for idx in np.nonzero(np.diff(self.indptr))[0]:
+            yield self.gids[idx]
+
+    def __len__(self):
+        """Number of query genomes with Mash ANI values."""
+
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+    def items(self):
+        """Query genomes and their Mash ANI to reference genomes."""
+
+        return [(qid, self[qid]) for qid in self]
+
+    def num_pairs(self):
+        """Number of genome pairs with a Mash ANI value."""
+
+        return len(self.anis)
+
+    def neighbours(self, qid, min_ani):
+        """Get reference genomes with a Mash ANI to the query genome at or above the specified value.
+
+        Returns
+        -------
+        list
+            Tuple (rid, ANI) for each reference genome.
+        """
+
+        s = self._row_slice(qid)
+        if s is None:
+            return []
+
+        anis = self.anis[s]
+        mask = anis >= min_ani
+        return [(self.gids[idx], float(ani)) for idx, ani in zip(self.indices[s][mask], anis[mask])]
+
+    def pairs(self, min_ani):
+        """Get genome pairs with a Mash ANI at or above the specified value.
+
+        Returns
+        -------
+        list
+            Tuple (qid, rid, ANI) for each genome pair.
+        """
+
+        positions = np.nonzero(self.anis >= min_ani)[0]
+        q_indices = np.searchsorted(self.indptr, positions, side='right') - 1
+
+        gids = self.gids
+        return [(gids[q_idx], gids[r_idx], float(ani))
+                    for q_idx, r_idx, ani in zip(q_indices, self.indices[positions], self.anis[positions])]
@@ -0,0 +1,220 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import numpy as np
+
+
+class MashCandidateIndex(object):
+    """Index of candidate genome pairs with a Mash ANI at or above a threshold.
+
+    Only pairs between different genomes with a Mash ANI at or above the
+    threshold of the index are retained, and the candidates of each genome
+    are ordered by decreasing Mash ANI. Queries for the candidate
+    representatives of a genome therefore take time proportional to the
+    number of candidates of the genome, rather than the number of
+    representatives.
+    """
+
+    def __init__(self, mash_ani, min_ani, gid_map=None):
+        """Initialization.
+
+        Parameters
+        ----------
+        mash_ani : MashANI
+            Mash ANI between genomes.
+        min_ani : float
+            Minimum Mash ANI of candidate pairs.
+        gid_map : function
+            Function giving the genome ID used by the index for a genome ID reported by Mash.
+        """
+
+        self.min_ani = min_ani
+
+        gids = mash_ani.gids
+        if gid_map:
+            gids = [gid_map(gid) for gid in gids]
+
+        self.gids = []
+        self.gid_index = {}
+        remap = np.zeros(len(gids), dtype=np.int32)
+        for idx, gid in enumerate(gids):
+            new_idx = self.gid_index.get(gid)
+            if new_idx is None:
+                new_idx = len(self.gids)
+                self.gid_index[gid] = new_idx
+                self.gids.append(gid)
+            remap[idx] = new_idx
+
+        positions = np.nonzero(mash_ani.anis >= min_ani)[0]
+        q_indices = remap[np.searchsorted(mash_ani.indptr, positions, side='right') - 1]
+        r_indices = remap[mash_ani.indices[positions]]
+        anis = mash_ani.anis[positions]
+
+        keep = q_indices != r_indices
+        q_indices = q_indices[keep]
+        r_indices = r_indices[keep]
+        anis = anis[keep]
+
+        # retain the highest value of genome pairs duplicated by mapping genome IDs
+        if gid_map and len(anis) > 1:
+            order = np.lexsort((-anis, r_indices, q_indices))
+            q_indices = q_indices[order]
+            r_indices = r_indices[order]
+            anis = anis[order]
+
+            first = np.ones(len(anis), dtype=bool)
+            first[1:] = (q_indices[1:] != q_indices[:-1]) | (r_indices[1:] != r_indices[:-1])
+            q_indices = q_indices[first]
+            r_indices = r_indices[first]
+            anis = anis[first]
+
+        # order candidates of each genome by decreasing Mash ANI, with ties
+        # broken by genome index so the order is reproducible
+        order = np.lexsort((r_indices, -anis, q_indices))
+        q_indices = q_indices[order]
+        self.indices = r_indices[order]
+        self.anis = anis[order]
+
+        self.indptr = np.zeros(len(self.gids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(q_indices, minlength=len(self.gids)), out=self.indptr[1:])
+
+    def __contains__(self, gid):
+        """Check if genome has any candidates."""
+
+        idx = self.gid_index.get(gid)
+        return idx is not None and self.indptr[idx + 1] > self.indptr[idx]
+
+    def num_pairs(self):
+        """Number of candidate genome pairs."""
+
+        return len(self.anis)
+
+    def _row(self, gid):
+        """Get indices and Mash ANI of candidates of a genome."""
+
+        idx = self.gid_index.get(gid)
+        if idx is None:
+            return self.indices[0:0], self.anis[0:0]
+
+        s = slice(self.indptr[idx], self.indptr[idx + 1])
+        return self.indices[s], self.anis[s]
+
+    def candidates(self, gid, reps=None, min_ani=None):
+        """Get candidates of a genome in order of decreasing Mash ANI.
+
+        Parameters
+        ----------
+        gid : str
+            Genome to get candidates of.
+        reps : container
+            Restrict candidates to these genomes, or None for all genomes.
+        min_ani : float
+            Minimum Mash ANI of candidates, or None to use the threshold of the index.
+
+        Returns
+        -------
+        list
+            Tuple (candidate ID, Mash ANI) for each candidate.
+        """
+
+        indices, anis = self._row(gid)
+        if min_ani is not None and min_ani > self.min_ani:
+            # candidates are in order of decreasing ANI
+            indices = indices[0:np.count_nonzero(anis >= min_ani)]
+
+        gids = self.gids
+        if reps is None:
+            return [(gids[idx], float(ani)) for idx, ani in zip(indices, anis)]
+
+        return [(gids[idx], float(ani)) for idx, ani in zip(indices, anis) if gids[idx] in reps]
+
+    def candidate_reps(self, gid, rep_order):
+        """Get candidates of a genome amongst representatives, in the order the representatives were added.
+
+        Representatives with the same ANI to a genome are resolved by the first
+        representative considered, so candidates are returned in the order of the
+        representatives rather than by Mash ANI. Only the candidates of the genome
+        are sorted, so the time taken is proportional to the number of candidates
+        rather than the number of representatives.
+
+        Parameters
+        ----------
+        gid : str
+            Genome to get candidate representatives of.
+        rep_order : dict
+            Position of each representative, rep_order[rep_gid] -> position.
+
+        Returns
+        -------
+        list
+            Genome ID of each candidate representative.
+        """
+
+        rep_gids = [cand_gid for cand_gid, _ani in self.candidates(gid) if cand_gid in rep_order]
+        rep_gids.sort(key=rep_order.__getitem__)
+
+        return rep_gids
+
+    def nearest(self, gid, k, reps=None):
+        """Get the k candidates of a genome with the highest Mash ANI.
+
+        Returns
+        -------
+        list
+            Tuple (candidate ID, Mash ANI) for each candidate.
+        """
+
+        indices, anis = self._row(gid)
+
+        nearest = []
+        for idx, ani in zip(indices, anis):
+            if len(nearest) == k:
+                break
+
+            cid = self.gids[idx]
+            if reps is None or cid in reps:
+                nearest.append((cid, float(ani)))
+
+        return nearest
+
+    def max_ani(self, gid, reps=None):
+        """Get highest Mash ANI between a genome and its candidates, or 0 if it has none."""
+
+        nearest = self.nearest(gid, 1, reps)
+        if nearest:
+            return nearest[0][1]
+
+        return 0.0
+
+    def candidate_pairs(self, min_ani=None):
+        """Get candidate genome pairs.
+
+        Returns
+        -------
+        list
+            Tuple (qid, rid, Mash ANI) for each candidate pair.
+        """
+
+        positions = np.arange(len(self.anis))
+        if min_ani is not None and min_ani > self.min_ani:
+            positions = np.nonzero(self.anis >= min_ani)[0]
+
+        q_indices = np.searchsorted(self.indptr, positions, side='right') - 1
+
+        gids = self.gids
+        return [(gids[q_idx], gids[r_idx], float(ani))
+                    for q_idx, r_idx, ani in zip(q_indices, self.indices[positions], self.anis[positions])]
@@ -0,0 +1,135 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import sys
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from gtdb_species_clusters.genome_fingerprint import GenomeFingerprints, FINGERPRINT_PREFIX
+
+
+class MashSketchStore(object):
+    """Persistent store of Mash sketches for individual genomes.
+
+    Sketches are keyed by a fingerprint of the content of the genomic file
+    and the name of the file, which Mash records as the name of the genome,
+    so a genome is only sketched again if its genomic file changes. Sketches
+    created with different k-mer or sketch sizes are kept in separate
+    directories. Sketch files for a set of genomes are assembled from the
+    stored sketches with 'mash paste'.
+    """
+
+    def __init__(self, store_dir, kmer_size, sketch_size, cpus):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+        self.cpus = cpus
+
+        self.sketch_dir = os.path.join(store_dir, f'k{kmer_size}_s{sketch_size}')
+        os.makedirs(self.sketch_dir, exist_ok=True)
+
+        self.fingerprints = GenomeFingerprints(os.path.join(store_dir, 'fingerprints.tsv'))
+
+    def sketch_path(self, genome_file):
+        """Get path of stored sketch for a genomic file."""
+
+        fingerprint = self.fingerprints.fingerprint(genome_file)[len(FINGERPRINT_PREFIX):]
+
+        filename = os.path.basename(genome_file)
+        if filename.endswith('.gz'):
+            filename = filename[0:-3]
+
+        return os.path.join(self.sketch_dir, fingerprint[0:2], f'{fingerprint}_{filename}.msh')
+
+    def _sketch_genome(self, genome_file, sketch_file):
+        """Create sketch for a single genome."""
+
+        os.makedirs(os.path.dirname(sketch_file), exist_ok=True)
+
+        # Mash appends the .msh extension to the output file
+        tmp_file = f'{sketch_file[0:-4]}.{os.getpid()}.{threading.get_ident()}.tmp'
+        cmd = ['mash', 'sketch',
+                '-k', str(self.kmer_size),
+                '-s', str(self.sketch_size),
+                '-o', tmp_file,
+                genome_file]
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+        if proc.returncode != 0:
+            self.logger.error('Mash failed to sketch {}: {}'.format(genome_file, proc.stderr.strip()))
+            sys.exit(proc.returncode)
+
+        os.replace(tmp_file + '.msh', sketch_file)
+
+    def sketch(self, genome_files, staging=None):
+        """Get stored sketch for each genome, sketching new or modified genomes.
+
+        Parameters
+        ----------
+        genome_files : list
+            Path to genomic FASTA file of each genome.
+        staging : GenomeStaging
+            Staging area used to read genomes requiring sketching, or None to read genomes directly.
+
+        Returns
+        -------
+        list
+            Path to stored sketch of each genome.
+        """
+
+        sketch_files = [self.sketch_path(gf) for gf in genome_files]
+        self.fingerprints.write()
+
+        missing = [(gf, sf) for gf, sf in zip(genome_files, sketch_files) if not os.path.exists(sf)]
+        if missing:
+            input_files = [gf for gf, _sf in missing]
+            if staging:
+                staged_files = staging.stage_files(input_files)
+                input_files = [staged_files[gf] for gf in input_files]
+                staging.report('Mash sketching')
+
+            with ThreadPoolExecutor(max_workers=max(1, self.cpus)) as executor:
+                list(executor.map(self._sketch_genome, input_files, [sf for _gf, sf in missing]))
+
+        self.logger.info('Reused stored Mash sketches for {:,} of {:,} genomes and sketched {:,} new or modified genomes.'.format(
+                            len(sketch_files) - len(missing),
+                            len(sketch_files),
+                            len(missing)))
+
+        return sketch_files
+
+    def paste(self, sketch_files, sketch_list_file, output_sketch_file):
+        """Combine stored sketches into a single sketch file."""
+
+        with open(sketch_list_file, 'w') as fout:
+            for sf in sketch_files:
+                fout.write(sf + '\n')
+
+        output_prefix = output_sketch_file
+        if output_prefix.endswith('.msh'):
+            output_prefix = output_prefix[0:-4]
+
+        cmd = ['mash', 'paste', '-l', output_prefix, sketch_list_file]
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+        if proc.returncode != 0:
+            self.logger.error('Mash failed to combine sketches: {}'.format(proc.stderr.strip()))
+            sys.exit(proc.returncode)
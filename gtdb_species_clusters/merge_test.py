@@ -27,30 +27,27 @@ from itertools import combinations
 from collections import defaultdict, namedtuple
 
 from biolib.taxonomy import Taxonomy
-from biolib.external.execute import check_dependencies
 
 from numpy import (mean as np_mean)
 
 from gtdb_species_clusters.taxon_utils import read_gtdb_taxonomy
 from gtdb_species_clusters.type_genome_utils import symmetric_ani
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 
 
 class MergeTest(object):
     """Produce information relevant to merging two sister species."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
         
         self.logger = logging.getLogger('timestamp')
 
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
     def top_hits(self, species, rid, ani_af, genomes):
         """Report top 5 hits to species."""
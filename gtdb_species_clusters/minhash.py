@@ -0,0 +1,344 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import multiprocessing as mp
+
+import numpy as np
+
+from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.mash_ani import MashANI, NPZ_MAGIC
+from gtdb_species_clusters.kmer_ani import read_contigs, canonical_kmers
+
+
+# seed of hash function used by Mash
+HASH_SEED = 42
+
+# ASCII code of each 2-bit encoded base
+ASCII_BASES = np.array([ord(base) for base in 'ACGT'], dtype=np.uint8)
+
+# value used to pad sketches with fewer hashes than the sketch size
+PAD_HASH = np.int64(1) << np.int64(40)
+
+
+def _rotl32(x, r):
+    """Rotate 32-bit integers left."""
+
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def murmur3_32(data, seed):
+    """Calculate 32-bit MurmurHash3 (x86) of equal length byte strings.
+
+    Parameters
+    ----------
+    data : ndarray
+        Byte strings to hash, as a 2D array of uint8 with one string per row.
+    seed : int
+        Seed of hash function.
+
+    Returns
+    -------
+    ndarray
+        Hash of each byte string as uint32.
+    """
+
+    c1 = np.uint32(0xcc9e2d51)
+    c2 = np.uint32(0x1b873593)
+
+    num_strings, length = data.shape
+    num_blocks = length // 4
+
+    h = np.full(num_strings, seed, dtype=np.uint32)
+    if num_blocks:
+        blocks = np.ascontiguousarray(data[:, 0:num_blocks * 4]).view('<u4')
+        for idx in range(num_blocks):
+            k1 = blocks[:, idx] * c1
+            k1 = _rotl32(k1, 15)
+            k1 *= c2
+
+            h ^= k1
+            h = _rotl32(h, 13)
+            h = h * np.uint32(5) + np.uint32(0xe6546b64)
+
+    tail = data[:, num_blocks * 4:]
+    if tail.shape[1]:
+        k1 = np.zeros(num_strings, dtype=np.uint32)
+        for idx in range(tail.shape[1]):
+            k1 |= tail[:, idx].astype(np.uint32) << np.uint32(8 * idx)
+        k1 *= c1
+        k1 = _rotl32(k1, 15)
+        k1 *= c2
+        h ^= k1
+
+    h ^= np.uint32(length)
+    h ^= h >> np.uint32(16)
+    h *= np.uint32(0x85ebca6b)
+    h ^= h >> np.uint32(13)
+    h *= np.uint32(0xc2b2ae35)
+    h ^= h >> np.uint32(16)
+
+    return h
+
+
+def sketch_genome(genome_file, kmer_size, sketch_size):
+    """Create MinHash sketch of a genome.
+
+    Following Mash, canonical k-mers are hashed as uppercase text
+    with 32-bit MurmurHash3 and the smallest unique hashes retained.
+    K-mers containing ambiguous bases are ignored.
+    """
+
+    kmers = [canonical_kmers(codes, kmer_size)[0] for codes in read_contigs(genome_file)]
+    if not kmers:
+        return np.zeros(0, dtype=np.uint32)
+
+    kmers = np.unique(np.concatenate(kmers))
+
+    shifts = np.arange(2 * (kmer_size - 1), -1, -2, dtype=np.uint64)
+    bases = (kmers[:, np.newaxis] >> shifts) & np.uint64(3)
+    hashes = np.unique(murmur3_32(ASCII_BASES[bases], HASH_SEED))
+
+    return hashes[0:sketch_size]
+
+
+def _sketch_genome_worker(args):
+    """Create MinHash sketch of a genome in a worker process."""
+
+    return sketch_genome(*args)
+
+
+class MinHashSketches(object):
+    """MinHash sketches of a set of genomes stored in a compact binary format."""
+
+    def __init__(self, names, hashes, kmer_size, sketch_size):
+        """Initialization.
+
+        Parameters
+        ----------
+        names : list
+            Name of each genome, which is the path to its genomic file as with Mash.
+        hashes : list
+            Sorted hashes in the sketch of each genome.
+        """
+
+        self.names = list(names)
+        self.hashes = hashes
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+
+    def write(self, sketch_file):
+        """Write sketches to file."""
+
+        offsets = np.zeros(len(self.hashes) + 1, dtype=np.int64)
+        np.cumsum([len(h) for h in self.hashes], out=offsets[1:])
+        all_hashes = np.concatenate(self.hashes) if self.hashes else np.zeros(0, dtype=np.uint32)
+
+        tmp_file = f'{sketch_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as fout:
+            np.savez(fout,
+                        names=np.array(self.names, dtype=str),
+                        offsets=offsets,
+                        hashes=all_hashes.astype(np.uint32),
+                        params=np.array([self.kmer_size, self.sketch_size], dtype=np.int64))
+
+        os.replace(tmp_file, sketch_file)
+
+    @staticmethod
+    def read(sketch_file):
+        """Read sketches from file."""
+
+        with np.load(sketch_file, allow_pickle=False) as data:
+            offsets = data['offsets']
+            all_hashes = data['hashes']
+            kmer_size, sketch_size = data['params'].tolist()
+
+            hashes = [all_hashes[offsets[idx]:offsets[idx + 1]] for idx in range(len(offsets) - 1)]
+            return MinHashSketches(data['names'].tolist(), hashes, kmer_size, sketch_size)
+
+    def matrix(self, start, end):
+        """Get hashes of sketches as a matrix padded to the sketch size, along with the number of hashes in each sketch."""
+
+        block = self.hashes[start:end]
+        matrix = np.full((len(block), self.sketch_size), PAD_HASH, dtype=np.int64)
+        lengths = np.zeros(len(block), dtype=np.int64)
+        for idx, hashes in enumerate(block):
+            matrix[idx, 0:len(hashes)] = hashes
+            lengths[idx] = len(hashes)
+
+        return matrix, lengths
+
+
+def mash_distances(query_hashes, ref_matrix, ref_lengths, kmer_size, sketch_size):
+    """Calculate Mash distance between a query sketch and a matrix of reference sketches.
+
+    As in Mash, the Jaccard index is estimated from the hashes shared by both
+    sketches amongst the smallest hashes of their union, up to the sketch size.
+    This is calculated for all reference sketches at once from the rank of each
+    reference hash in the union of the two sketches.
+    """
+
+    query_hashes = query_hashes.astype(np.int64)
+    num_query = len(query_hashes)
+    if num_query == 0:
+        return np.ones(ref_matrix.shape[0])
+
+    valid = np.arange(sketch_size) < ref_lengths[:, np.newaxis]
+
+    # number of query hashes smaller than each reference hash
+    rank_in_query = np.searchsorted(query_hashes, ref_matrix)
+    shared = valid & (query_hashes[np.minimum(rank_in_query, num_query - 1)] == ref_matrix)
+
+    shared_before = np.cumsum(shared, axis=1) - shared
+    union_rank = np.arange(sketch_size) + rank_in_query - shared_before
+
+    common = np.count_nonzero(shared & (union_rank < sketch_size), axis=1)
+    denom = np.minimum(sketch_size, ref_lengths + num_query - shared.sum(axis=1))
+
+    jaccard = common / np.maximum(denom, 1)
+    with np.errstate(divide='ignore'):
+        dist = -np.log(2 * jaccard / (1 + jaccard)) / kmer_size
+
+    return np.where(common > 0, np.minimum(dist, 1.0), 1.0)
+
+
+class MinHash(Mash):
+    """Calculate Mash distance between genomes with an in-process NumPy MinHash implementation.
+
+    Sketches are created with the same k-mer size, sketch size, and hash function
+    as Mash, but are stored in a compact binary format that can only be read by
+    this class. Sketch files are given a distinct extension in place of the .msh
+    extension of Mash so they are never passed to Mash. Mash p-values are not 
+    calculated so distances are only filtered by the maximum distance.
+    """
+
+    # number of reference sketches compared to a query sketch at once
+    block_size = 1000
+
+    # extension of sketch files
+    sketch_ext = '.minhash.npz'
+
+    def _init_backend(self):
+        """Initialize backend used to create sketches and calculate distances."""
+
+        if self.sketch_store:
+            self.logger.warning('Sketch store contains Mash sketches and is not used by the NumPy MinHash backend.')
+            self.sketch_store = None
+
+        self.logger.info(f'Using NumPy MinHash sketches (k={self.kmer_size}, s={self.sketch_size}).')
+
+    def _sketch_file(self, sketch_file):
+        """Get file used to store a sketch requested with the given name, replacing any .msh extension."""
+
+        if sketch_file.endswith(self.sketch_ext):
+            return sketch_file
+
+        sketch_prefix = sketch_file[0:-4] if sketch_file.endswith('.msh') else sketch_file
+        return sketch_prefix + self.sketch_ext
+
+    def _sketch_compatible(self, sketch_file):
+        """Check if sketch file was created by this backend."""
+
+        with open(sketch_file, 'rb') as f:
+            return f.read(len(NPZ_MAGIC)) == NPZ_MAGIC
+
+    def _sketch_files(self, genome_files):
+        """Create sketch of each genomic file."""
+
+        args = [(gf, self.kmer_size, self.sketch_size) for gf in genome_files]
+        if self.cpus > 1 and len(args) > 1:
+            with mp.Pool(min(self.cpus, len(args))) as pool:
+                return pool.map(_sketch_genome_worker, args)
+
+        return [_sketch_genome_worker(a) for a in args]
+
+    def _create_sketch(self, gids, genome_files, genome_list_file, sketch_file, silence):
+        """Create sketch for genomes, replacing any existing sketch."""
+
+        names = [genome_files[gid] for gid in gids]
+        if self.staging:
+            staged_files = self.staging.stage_files(names)
+            names = [staged_files[gf] for gf in names]
+            self.staging.report('Mash sketching')
+
+        with open(genome_list_file, 'w') as fout:
+            for gf in names:
+                fout.write(gf + '\n')
+
+        if not silence:
+            self.logger.info(f'Creating MinHash sketch for {len(names):,} genomes.')
+
+        sketches = MinHashSketches(names, self._sketch_files(names), self.kmer_size, self.sketch_size)
+        sketches.write(sketch_file)
+
+    def _extend_sketch(self, gids, genome_files, genome_list_file, sketch_file, silence):
+        """Add genomes to an existing sketch."""
+
+        sketches = MinHashSketches.read(sketch_file)
+
+        sketch_prefix = sketch_file[0:-len(self.sketch_ext)]
+        added_sketch_file = sketch_prefix + '.added' + self.sketch_ext
+        self._create_sketch(gids, genome_files, genome_list_file, added_sketch_file, silence)
+        added = MinHashSketches.read(added_sketch_file)
+
+        MinHashSketches(sketches.names + added.names,
+                        sketches.hashes + added.hashes,
+                        self.kmer_size,
+                        self.sketch_size).write(sketch_file)
+        os.remove(added_sketch_file)
+
+    def _dist(self, min_dist, ref_sketch_file, query_sketch_file, dist_file):
+        """Calculate Mash distances between all reference and query sketches."""
+
+        refs = MinHashSketches.read(ref_sketch_file)
+        queries = MinHashSketches.read(query_sketch_file)
+
+        ref_gids = [self._mash_genome_id(name) for name in refs.names]
+        query_gids = [self._mash_genome_id(name) for name in queries.names]
+
+        gids = []
+        gid_index = {}
+        for gid in ref_gids + query_gids:
+            if gid not in gid_index:
+                gid_index[gid] = len(gids)
+                gids.append(gid)
+
+        q_indices = []
+        r_indices = []
+        anis = []
+        for start in range(0, len(refs.names), self.block_size):
+            end = min(start + self.block_size, len(refs.names))
+            ref_matrix, ref_lengths = refs.matrix(start, end)
+            block_indices = np.array([gid_index[gid] for gid in ref_gids[start:end]], dtype=np.int32)
+
+            for query_gid, query_hashes in zip(query_gids, queries.hashes):
+                dist = mash_distances(query_hashes, ref_matrix, ref_lengths, self.kmer_size, self.sketch_size)
+                hits = np.nonzero(dist <= min_dist)[0]
+                if len(hits) == 0:
+                    continue
+
+                q_indices.append(np.full(len(hits), gid_index[query_gid], dtype=np.int32))
+                r_indices.append(block_indices[hits])
+                anis.append(100 - 100*dist[hits])
+
+        if anis:
+            mash_ani = MashANI.from_pairs(gids, np.concatenate(q_indices), np.concatenate(r_indices), np.concatenate(anis))
+        else:
+            mash_ani = MashANI.from_pairs(gids, [], [], [])
+
+        mash_ani.write(self._ani_file(dist_file))
+        self._mash_ani[dist_file] = mash_ani
@@ -27,7 +27,6 @@ from itertools import combinations, product
 from collections import defaultdict, namedtuple
 
 from biolib.taxonomy import Taxonomy
-from biolib.external.execute import check_dependencies
 
 from numpy import (mean as np_mean,
                     std as np_std)
@@ -54,17 +53,16 @@ from gtdb_species_clusters.type_genome_utils import (NCBI_TYPE_SPECIES,
                                             symmetric_ani,
                                             quality_score)
                                     
-from gtdb_species_clusters.fastani import FastANI
-from gtdb_species_clusters.mash import Mash
+from gtdb_species_clusters.ani_engine import create_ani_engine
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
 
 class SelectTypeGenomes(object):
     """Select GTDB type genomes for named species."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -75,7 +73,9 @@ class SelectTypeGenomes(object):
         
         self.max_ani_neighbour = 97.0
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash_options = mash_options or {}
         
         self.BlastHit = namedtuple('BlastHit', ['ltp_species', 'ssu_len', 'align_len', 'perc_identity', 'bitscore', 'evalue'])
         
@@ -914,7 +914,7 @@ class SelectTypeGenomes(object):
     def _ani_type_genomes(self, genome_files, type_genomes, ncbi_taxonomy):
         """Calculate ANI between type genomes."""
         
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         # create Mash sketch for potential representative genomes
         genome_list_file = os.path.join(self.output_dir, 'gtdb_type_genomes.lst')
@@ -926,16 +926,13 @@ class SelectTypeGenomes(object):
         mash.dist_pairwise(float(100 - self.min_mash_ani)/100, sketch, mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
 
         # get pairs above Mash threshold
         mash_ani_pairs = []
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if mash_ani[qid][rid] >= self.min_mash_ani:
-                    if qid != rid:
-                        mash_ani_pairs.append((qid, rid))
-                        mash_ani_pairs.append((rid, qid))
+        for qid, rid, _ani in mash_candidates.candidate_pairs():
+            mash_ani_pairs.append((qid, rid))
+            mash_ani_pairs.append((rid, qid))
                 
         self.logger.info('Identified %d genome pairs with a Mash ANI >= %.1f%%.' % (len(mash_ani_pairs), self.min_mash_ani))
 
@@ -161,6 +161,24 @@ def symmetric_ani(ani_af, gid1, gid2):
     return ani, af
     
     
+def symmetric_ani_bound(ani_af, gid1, gid2):
+    """Calculate lower bound on symmetric ANI statistics from the directions calculated between genomes."""
+    
+    if gid1 == gid2:
+        return 100.0, 1.0
+        
+    values = []
+    if gid1 in ani_af and gid2 in ani_af[gid1]:
+        values.append(ani_af[gid1][gid2])
+    if gid2 in ani_af and gid1 in ani_af[gid2]:
+        values.append(ani_af[gid2][gid1])
+        
+    if not values:
+        return 0.0, 0.0
+        
+    return max(ani for ani, _af in values), max(af for _ani, af in values)
+    
+    
 def quality_score(gids, quality_metadata):
     """"Calculate quality score for genomes."""
 
@@ -23,13 +23,13 @@ import pickle
 from itertools import combinations
 from collections import defaultdict, namedtuple
 
-from biolib.external.execute import check_dependencies
-
 from numpy import (mean as np_mean,
                     std as np_std)
 
-from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.greedy_ani import prefetch_greedy_ani, block_greedy_ani
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 from gtdb_species_clusters.type_genome_utils import (ClusteredGenome,
                                                         GenomeRadius,
@@ -42,11 +42,9 @@ from gtdb_species_clusters.type_genome_utils import (ClusteredGenome,
 class UpdateClusterDeNovo(object):
     """Infer de novo species clusters and representatives for remaining genomes."""
 
-    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir, prefetch_genomes=0, greedy_block_size=0, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -59,7 +57,18 @@ class UpdateClusterDeNovo(object):
 
         self.min_mash_ani = 90.0
 
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+
+        self.mash_options = mash_options or {}
+        
+        # number of genomes to speculatively calculate ANI for
+        # ahead of greedy selection of representatives
+        self.prefetch_genomes = prefetch_genomes
+        
+        # number of genomes to calculate ANI for at once during greedy 
+        # selection of representatives, with selection then performed
+        # for each genome in turn using these precalculated values
+        self.greedy_block_size = greedy_block_size
         
     def _parse_named_clusters(self, named_cluster_file):
         """Parse named GTDB species clusters."""
@@ -131,7 +140,7 @@ class UpdateClusterDeNovo(object):
     def _mash_ani_unclustered(self, cur_genomes, gids):
         """Calculate pairwise Mash ANI estimates between genomes."""
         
-        mash = Mash(self.cpus)
+        mash = create_mash(self.cpus, **self.mash_options)
         
         # create Mash sketch for potential representative genomes
         mash_nontype_sketch_file = os.path.join(self.output_dir, 'gtdb_unclustered_genomes.msh')
@@ -143,30 +152,28 @@ class UpdateClusterDeNovo(object):
         mash.dist_pairwise( float(100 - self.min_mash_ani)/100, mash_nontype_sketch_file, mash_dist_file)
 
         # read Mash distances
-        mash_ani = mash.read_ani(mash_dist_file)
+        mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file), self.min_mash_ani)
         
         # report pairs above Mash threshold
         mash_ani_pairs = []
-        for qid in mash_ani:
-            for rid in mash_ani[qid]:
-                if mash_ani[qid][rid] >= self.min_mash_ani:
-                    n_qid = cur_genomes.user_uba_id_map.get(qid, qid)
-                    n_rid = cur_genomes.user_uba_id_map.get(rid, rid)
-                    if n_qid != n_rid:
-                        mash_ani_pairs.append((n_qid, n_rid))
-                        mash_ani_pairs.append((n_rid, n_qid))
+        for qid, rid, _ani in mash_candidates.candidate_pairs():
+            n_qid = cur_genomes.user_uba_id_map.get(qid, qid)
+            n_rid = cur_genomes.user_uba_id_map.get(rid, rid)
+            if n_qid != n_rid:
+                mash_ani_pairs.append((n_qid, n_rid))
+                mash_ani_pairs.append((n_rid, n_qid))
                 
         self.logger.info('Identified {:,} genome pairs with a Mash ANI >= {:.1f}%.'.format(
                             len(mash_ani_pairs), 
                             self.min_mash_ani))
 
-        return mash_ani
+        return mash_candidates
         
     def _selected_rep_genomes(self,
                                 cur_genomes,
                                 nonrep_radius, 
                                 unclustered_qc_gids, 
-                                mash_ani):
+                                mash_candidates):
         """Select de novo representatives for species clusters in a greedy fashion using species-specific ANI thresholds."""
 
         # sort genomes by quality score
@@ -177,18 +184,35 @@ class UpdateClusterDeNovo(object):
         # greedily determine representatives for new species clusters
         cluster_rep_file = os.path.join(self.output_dir, 'cluster_reps.tsv')
         clusters = set()
+        rep_order = {}
         if not os.path.exists(cluster_rep_file):
             clustered_genomes = 0
             max_ani_pairs = 0
             for idx, (cur_gid, _score) in enumerate(q_sorted):
+                if self.greedy_block_size:
+                    if idx % self.greedy_block_size == 0:
+                        block_ani_af = block_greedy_ani(self.fastani,
+                                                        [gid for gid, _score in q_sorted[idx:idx + self.greedy_block_size]],
+                                                        clusters,
+                                                        mash_candidates,
+                                                        cur_genomes.genomic_files)
+                elif self.prefetch_genomes and idx % self.prefetch_genomes == 0:
+                    # ANI for the next window of genomes is calculated in the background
+                    # while this window is processed, along with any pairs for this window
+                    # involving representatives selected since it was prefetched
+                    prefetch_greedy_ani(self.fastani,
+                                        [gid for gid, _score in q_sorted[idx:idx + 2*self.prefetch_genomes]],
+                                        clusters,
+                                        mash_candidates,
+                                        cur_genomes.genomic_files,
+                                        self.ani_sp)
 
                 # determine reference genomes to calculate ANI between
+                rep_gids = mash_candidates.candidate_reps(cur_gid, rep_order)
                 ani_pairs = []
-                if cur_gid in mash_ani:
-                    for rep_gid in clusters:
-                        if mash_ani[cur_gid].get(rep_gid, 0) >= self.min_mash_ani:
-                            ani_pairs.append((cur_gid, rep_gid))
-                            ani_pairs.append((rep_gid, cur_gid))
+                for rep_gid in rep_gids:
+                    ani_pairs.append((cur_gid, rep_gid))
+                    ani_pairs.append((rep_gid, cur_gid))
 
                 # determine if genome clusters with representative
                 clustered = False
@@ -196,12 +220,15 @@ class UpdateClusterDeNovo(object):
                     if len(ani_pairs) > max_ani_pairs:
                         max_ani_pairs = len(ani_pairs)
                     
-                    ani_af = self.fastani.pairs(ani_pairs, cur_genomes.genomic_files, report_progress=False)
+                    if self.greedy_block_size:
+                        ani_af = block_ani_af
+                    else:
+                        ani_af = self.fastani.pairs(ani_pairs, cur_genomes.genomic_files, report_progress=False)
 
                     closest_rep_gid = None
                     closest_rep_ani = 0
                     closest_rep_af = 0
-                    for rep_gid in clusters:
+                    for rep_gid in rep_gids:
                         ani, af = symmetric_ani(ani_af, cur_gid, rep_gid)
 
                         if af >= self.af_sp:
@@ -221,6 +248,7 @@ class UpdateClusterDeNovo(object):
                 if not clustered:
                     # genome is a new species cluster representative
                     clusters.add(cur_gid)
+                    rep_order[cur_gid] = len(rep_order)
                 else:
                     clustered_genomes += 1
                 
@@ -267,7 +295,7 @@ class UpdateClusterDeNovo(object):
 
         if True: #***
             # calculate MASH distance between non-representatives and representatives genomes
-            mash = Mash(self.cpus)
+            mash = create_mash(self.cpus, **self.mash_options)
             
             mash_rep_sketch_file = os.path.join(self.output_dir, 'gtdb_rep_genomes.msh')
             rep_genome_list_file = os.path.join(self.output_dir, 'gtdb_rep_genomes.lst')
@@ -286,6 +314,9 @@ class UpdateClusterDeNovo(object):
 
             # read Mash distances
             mash_ani = mash.read_ani(mash_dist_file)
+            mash_candidates = MashCandidateIndex(mash_ani,
+                                                    self.min_mash_ani,
+                                                    lambda gid: cur_genomes.user_uba_id_map.get(gid, gid))
             
             # calculate ANI between non-representatives and representatives genomes
             clusters = {}
@@ -305,33 +336,30 @@ class UpdateClusterDeNovo(object):
                                     mash_ani_pairs.append((n_rid, n_gid))
                                     
             mash_ani_pairs = []
-            for qid in mash_ani:
-                n_qid = cur_genomes.user_uba_id_map.get(qid, qid)
+            for n_qid, n_rid, _ani in mash_candidates.candidate_pairs():
                 assert n_qid in nonrep_gids
+                assert n_rid in all_reps
                 
-                for rid in mash_ani[qid]:
-                    n_rid = cur_genomes.user_uba_id_map.get(rid, rid)
-                    assert n_rid in all_reps
-                    
-                    if (mash_ani[qid][rid] >= self.min_mash_ani
-                        and n_qid != n_rid):
-                        mash_ani_pairs.append((n_qid, n_rid))
-                        mash_ani_pairs.append((n_rid, n_qid))
+                mash_ani_pairs.append((n_qid, n_rid))
+                mash_ani_pairs.append((n_rid, n_qid))
                             
             self.logger.info('Calculating ANI between {:,} species clusters and {:,} unclustered genomes ({:,} pairs):'.format(
                                 len(clusters), 
                                 len(nonrep_gids),
                                 len(mash_ani_pairs)))
-            ani_af = self.fastani.pairs(mash_ani_pairs, cur_genomes.genomic_files)
+            ani_af = self.fastani.pairs(mash_ani_pairs, 
+                                        cur_genomes.genomic_files,
+                                        genome_sizes=cur_genomes.genome_lengths())
 
             # assign genomes to closest representatives 
             # that is within the representatives ANI radius
             self.logger.info('Assigning genomes to closest representative.')
+            rep_order = {rep_gid: idx for idx, rep_gid in enumerate(clusters)}
             for idx, cur_gid in enumerate(nonrep_gids):
                 closest_rep_gid = None
                 closest_rep_ani = 0
                 closest_rep_af = 0
-                for rep_gid in clusters:
+                for rep_gid in mash_candidates.candidate_reps(cur_gid, rep_order):
                     ani, af = symmetric_ani(ani_af, cur_gid, rep_gid)
                     
                     if ani >= final_cluster_radius[rep_gid].ani and af >= self.af_sp:
@@ -416,13 +444,13 @@ class UpdateClusterDeNovo(object):
 
         # calculate Mash ANI estimates between unclustered genomes
         self.logger.info('Calculating Mash ANI estimates between unclustered genomes.')
-        mash_anis = self._mash_ani_unclustered(cur_genomes, unclustered_gids)
+        mash_candidates = self._mash_ani_unclustered(cur_genomes, unclustered_gids)
 
         # select de novo species representatives in a greedy fashion based on genome quality
         de_novo_rep_gids = self._selected_rep_genomes(cur_genomes,
                                                         nonrep_radius, 
                                                         unclustered_gids, 
-                                                        mash_anis)
+                                                        mash_candidates)
 
         # cluster all non-representative genomes to representative genomes
         final_cluster_radius = rep_radius.copy()
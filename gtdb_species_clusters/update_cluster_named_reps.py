@@ -27,12 +27,12 @@ from itertools import combinations
 from collections import defaultdict, namedtuple
 
 from biolib.taxonomy import Taxonomy
-from biolib.external.execute import check_dependencies
 
 from numpy import (mean as np_mean)
 
-from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.ani_engine import create_ani_engine
 
 from gtdb_species_clusters.genome import Genome
 from gtdb_species_clusters.genomes import Genomes
@@ -52,11 +52,9 @@ from gtdb_species_clusters.type_genome_utils import (GenomeRadius,
 class UpdateClusterNamedReps(object):
     """Cluster genomes to selected GTDB representatives."""
 
-    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_sp, af_sp, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -71,7 +69,9 @@ class UpdateClusterNamedReps(object):
         
         self.ClusteredGenome = namedtuple('ClusteredGenome', 'ani af gid')
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash_options = mash_options or {}
         
     def _rep_radius(self, rep_gids, rep_ani_file):
         """Calculate circumscription radius for representative genomes."""
@@ -146,7 +146,7 @@ class UpdateClusterNamedReps(object):
         """Calculate ANI between representative and non-representative genomes."""
         
         if True: #***
-            mash = Mash(self.cpus)
+            mash = create_mash(self.cpus, **self.mash_options)
             
             # create Mash sketch for representative genomes
             if not rep_mash_sketch_file or not os.path.exists(rep_mash_sketch_file):
@@ -172,24 +172,23 @@ class UpdateClusterNamedReps(object):
                                     mash_dist_file)
 
             # read Mash distances
-            mash_ani = mash.read_ani(mash_dist_file)
+            mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file),
+                                                    self.min_mash_ani,
+                                                    lambda gid: cur_genomes.user_uba_id_map.get(gid, gid))
 
             # get pairs above Mash threshold
             mash_ani_pairs = []
-            for qid in mash_ani:
-                for rid in mash_ani[qid]:
-                    if mash_ani[qid][rid] >= self.min_mash_ani:
-                        n_qid = cur_genomes.user_uba_id_map.get(qid, qid)
-                        n_rid = cur_genomes.user_uba_id_map.get(rid, rid)
-                        if n_qid != n_rid:
-                            mash_ani_pairs.append((n_qid, n_rid))
-                            mash_ani_pairs.append((n_rid, n_qid))
+            for n_qid, n_rid, _ani in mash_candidates.candidate_pairs():
+                mash_ani_pairs.append((n_qid, n_rid))
+                mash_ani_pairs.append((n_rid, n_qid))
                     
             self.logger.info('Identified {:,} genome pairs with a Mash ANI >= {:.1f}%.'.format(len(mash_ani_pairs), self.min_mash_ani))
             
             # calculate ANI between pairs
             self.logger.info('Calculating ANI between {:,} genome pairs:'.format(len(mash_ani_pairs)))
-            ani_af = self.fastani.pairs(mash_ani_pairs, cur_genomes.genomic_files)
+            ani_af = self.fastani.pairs(mash_ani_pairs, 
+                                        cur_genomes.genomic_files,
+                                        genome_sizes=cur_genomes.genome_lengths())
             pickle.dump(ani_af, open(os.path.join(self.output_dir, 'ani_af_rep_vs_nonrep.pkl'), 'wb'))
         else:
             self.logger.warning('Using previously calculated results in: {}'.format('ani_af_rep_vs_nonrep.pkl'))
@@ -282,6 +281,7 @@ class UpdateClusterNamedReps(object):
         self.logger.info('Reading path to current genomic FASTA files.')
         cur_genomes.load_genomic_file_paths(cur_genomic_path_file)
         cur_genomes.load_genomic_file_paths(uba_genome_paths)
+        self.fastani.set_genome_genera(cur_genomes.genome_genera())
 
         # get representative genomes
         rep_gids = set()
@@ -28,7 +28,7 @@ from numpy import (mean as np_mean, std as np_std)
 from biolib.taxonomy import Taxonomy
 
 from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.ani_engine import create_ani_engine
 
 from gtdb_species_clusters.genomes import Genomes
 
@@ -37,7 +37,7 @@ from gtdb_species_clusters.species_priority_manager import SpeciesPriorityManage
 from gtdb_species_clusters.specific_epithet_manager import SpecificEpithetManager
 from gtdb_species_clusters.ncbi_species_manager import NCBI_SpeciesManager
 from gtdb_species_clusters.genome_utils import canonical_gid
-from gtdb_species_clusters.type_genome_utils import (read_clusters, symmetric_ani)
+from gtdb_species_clusters.type_genome_utils import (read_clusters, symmetric_ani_bound)
 from gtdb_species_clusters.taxon_utils import (generic_name,
                                                 specific_epithet,
                                                 canonical_taxon,
@@ -59,14 +59,15 @@ class UpdateErroneousNCBI(object):
                     ani_ncbi_erroneous,
                     ani_cache_file, 
                     cpus, 
-                    output_dir):
+                    output_dir,
+                    ani_options=None):
         """Initialization."""
         
         self.output_dir = output_dir
         self.logger = logging.getLogger('timestamp')
         
         self.ani_ncbi_erroneous = ani_ncbi_erroneous
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
     def identify_misclassified_genomes_ani(self, cur_genomes, cur_clusters):
         """Identify genomes with erroneous NCBI species assignments, based on ANI to type strain genomes."""
@@ -121,7 +122,6 @@ class UpdateErroneousNCBI(object):
                 gid_pairs = []
                 for gid in gids_to_check:
                     gid_pairs.append((type_rid, gid))
-                    gid_pairs.append((gid, type_rid))
                     
                 statusStr = '-> Establishing erroneous assignments for {} [ANI pairs: {:,}; {:,} of {:,} species].'.format(
                                     ncbi_species,
@@ -131,13 +131,15 @@ class UpdateErroneousNCBI(object):
                 sys.stdout.write('{}\r'.format(statusStr))
                 sys.stdout.flush()
                     
-                ani_af = self.fastani.pairs(gid_pairs, 
+                # reverse direction is only required for
+                # genomes below the ANI threshold
+                ani_af = self.fastani.symmetric_pairs(gid_pairs, 
                                     cur_genomes.genomic_files, 
-                                    report_progress=False, 
-                                    check_cache=True)
+                                    self.ani_ncbi_erroneous,
+                                    report_progress=False)
 
                 for gid in gids_to_check:
-                    ani, af = symmetric_ani(ani_af, type_rid, gid)
+                    ani, af = symmetric_ani_bound(ani_af, type_rid, gid)
                     if ani < self.ani_ncbi_erroneous:
                         misclassified_gids.add(gid)
                         fout.write('{}\t{}\t{}\t{}\t{:.2f}\t{:.3f}\n'.format(
@@ -24,7 +24,7 @@ from collections import defaultdict
 
 from numpy import (mean as np_mean, std as np_std)
 
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 from gtdb_species_clusters.species_clusters import SpeciesClusters
 from gtdb_species_clusters.species_priority_manager import SpeciesPriorityManager
@@ -36,13 +36,13 @@ from gtdb_species_clusters.genome_utils import select_highest_quality
 class RepActions(object):
     """Perform initial actions required for changed representatives."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None):
         """Initialization."""
         
         self.output_dir = output_dir
         self.logger = logging.getLogger('timestamp')
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
         # action parameters
         self.genomic_update_ani = 99.0
@@ -27,7 +27,7 @@ from numpy import (mean as np_mean, std as np_std)
 
 from biolib.external.execute import check_dependencies
 
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 from gtdb_species_clusters.genome_utils import canonical_gid, exclude_from_refseq
 from gtdb_species_clusters.taxon_utils import generic_name, specific_epithet, canonical_taxon
@@ -37,7 +37,7 @@ from gtdb_species_clusters.type_genome_utils import symmetric_ani
 class ResolveTypes(object):
     """Resolve cases where a species has multiple genomes assembled from the type strain."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None):
         """Initialization."""
         
         self.ltp_dir = 'rna_ltp_132'
@@ -53,7 +53,7 @@ class ResolveTypes(object):
         self.logger = logging.getLogger('timestamp')
         self.cpus = cpus
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
         self.ani_pickle_dir = os.path.join(self.output_dir, 'ani_pickles')
         if not os.path.exists(self.ani_pickle_dir):
@@ -31,13 +31,13 @@ from itertools import combinations, product
 from collections import defaultdict, namedtuple
 
 from biolib.taxonomy import Taxonomy
-from biolib.external.execute import check_dependencies
 
 from numpy import (mean as np_mean,
                     std as np_std)
 
-from gtdb_species_clusters.mash import Mash
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.ani_engine import create_ani_engine
 
 from gtdb_species_clusters.genome import Genome
 from gtdb_species_clusters.genomes import Genomes
@@ -52,11 +52,9 @@ from gtdb_species_clusters.species_priority_manager import SpeciesPriorityManage
 class UpdateSelectRepresentatives(object):
     """Select GTDB representatives for named species."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None, mash_options=None):
         """Initialization."""
         
-        check_dependencies(['fastANI', 'mash'])
-        
         self.cpus = cpus
         self.output_dir = output_dir
 
@@ -68,7 +66,9 @@ class UpdateSelectRepresentatives(object):
         self.max_ani_neighbour = 97.0
         self.max_af_neighbour = 0.65
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
+        
+        self.mash_options = mash_options or {}
         
         self.BlastHit = namedtuple('BlastHit', ['ltp_species', 'ssu_len', 'align_len', 'perc_identity', 'bitscore', 'evalue'])
 
@@ -551,7 +551,7 @@ class UpdateSelectRepresentatives(object):
         
         if True: #***
             self.logger.info('Using Mash to identify similar genome pairs.')
-            mash = Mash(self.cpus)
+            mash = create_mash(self.cpus, **self.mash_options)
             
             # sanity check
             for gid, sp in all_rep_genomes.items():
@@ -569,18 +569,15 @@ class UpdateSelectRepresentatives(object):
             mash.dist_pairwise(float(100 - self.min_mash_ani)/100, sketch, mash_dist_file)
 
             # read Mash distances
-            mash_ani = mash.read_ani(mash_dist_file)
+            mash_candidates = MashCandidateIndex(mash.read_ani(mash_dist_file),
+                                                    self.min_mash_ani,
+                                                    lambda gid: cur_genomes.user_uba_id_map.get(gid, gid))
 
             # get pairs above Mash threshold
             mash_ani_pairs = []
-            for qid in mash_ani:
-                for rid in mash_ani[qid]:
-                    if mash_ani[qid][rid] >= self.min_mash_ani:
-                        if qid != rid:
-                            q = cur_genomes.user_uba_id_map.get(qid, qid)
-                            r = cur_genomes.user_uba_id_map.get(rid, rid)
-                            mash_ani_pairs.append((q, r))
-                            mash_ani_pairs.append((r, q))
+            for q, r, _ani in mash_candidates.candidate_pairs():
+                mash_ani_pairs.append((q, r))
+                mash_ani_pairs.append((r, q))
                     
             self.logger.info(' ... identified {:,} genome pairs with a Mash ANI >= {:.1f}%.'.format(len(mash_ani_pairs), self.min_mash_ani))
 
@@ -612,7 +609,9 @@ class UpdateSelectRepresentatives(object):
             # calculate ANI between pairs
             gid_pairs = genus_ani_pairs.union(mash_ani_pairs)
             self.logger.info('Calculating ANI between {:,} genome pairs:'.format(len(gid_pairs)))
-            ani_af = self.fastani.pairs(gid_pairs, cur_genomes.genomic_files)
+            ani_af = self.fastani.pairs(gid_pairs, 
+                                        cur_genomes.genomic_files,
+                                        genome_sizes=cur_genomes.genome_lengths())
             pickle.dump(ani_af, open(os.path.join(self.output_dir, 'reps_ani_af.pkl'), 'wb'))
         else:
             ani_af = pickle.load(open(os.path.join(self.output_dir, 'reps_ani_af.pkl'), 'rb'))
@@ -1019,6 +1018,7 @@ class UpdateSelectRepresentatives(object):
         self.logger.info('Reading path to current genomic FASTA files.')
         cur_genomes.load_genomic_file_paths(cur_genomic_path_file)
         cur_genomes.load_genomic_file_paths(uba_genome_paths)
+        self.fastani.set_genome_genera(cur_genomes.genome_genera())
         
         # determine new NCBI species requiring a GTDB representative to be selected
         self.logger.info('Determining NCBI species unrepresented by GTDB species clusters.')
@@ -39,7 +39,7 @@ from numpy import (mean as np_mean, std as np_std)
 
 from biolib.taxonomy import Taxonomy
 
-from gtdb_species_clusters.fastani import FastANI
+from gtdb_species_clusters.ani_engine import create_ani_engine
 from gtdb_species_clusters.genomes import Genomes
 from gtdb_species_clusters.species_clusters import SpeciesClusters
 from gtdb_species_clusters.species_name_manager import SpeciesNameManager
@@ -61,13 +61,13 @@ from gtdb_species_clusters.taxon_utils import (generic_name,
 class UpdateSpeciesInit(object):
     """Produce initial best guess at GTDB species clusters."""
 
-    def __init__(self, ani_cache_file, cpus, output_dir):
+    def __init__(self, ani_cache_file, cpus, output_dir, ani_options=None):
         """Initialization."""
         
         self.output_dir = output_dir
         self.logger = logging.getLogger('timestamp')
         
-        self.fastani = FastANI(ani_cache_file, cpus)
+        self.fastani = create_ani_engine(ani_cache_file, cpus, **(ani_options or {}))
         
         self.sp_name_log = open(os.path.join(self.output_dir, 'sp_name_log.tsv'), 'w')
         self.sp_name_log.write('GTDB domain\tGenome ID\tPrevious GTDB species\tNew GTDB species\tAction\n')
@@ -0,0 +1,155 @@
+import os
+import random
+from itertools import product
+
+import pytest
+
+from gtdb_species_clusters import cluster_de_novo
+from gtdb_species_clusters.ani_engine import ANIEngine
+from gtdb_species_clusters.cluster_de_novo import ClusterDeNovo
+from gtdb_species_clusters.mash_ani import MashANI
+from gtdb_species_clusters.mash_candidate_index import MashCandidateIndex
+from gtdb_species_clusters.type_genome_utils import GenomeRadius
+
+
+ANI_SP = 95.0
+AF_SP = 0.65
+
+
+class TableANIEngine(ANIEngine):
+    """ANI engine whose worker processes look up ANI and AF between genomes in a table."""
+
+    def __init__(self, ani_af, cpus):
+        self.ani_af = ani_af
+        self.calls = []
+        self.prefetch_calls = []
+
+        super().__init__(None, cpus)
+
+    def _get_producer(self):
+        return 'table'
+
+    def _calculate_batch(self, q_files, r_files):
+        values = [self.ani_af[os.path.splitext(q_file)[0]][os.path.splitext(r_file)[0]]
+                    for q_file, r_file in product(q_files, r_files)]
+
+        return [ani for ani, _af in values], [af for _ani, af in values]
+
+    def pairs(self, gid_pairs, genome_files, report_progress=True, check_cache=False, genome_sizes=None):
+        self.calls.append(list(gid_pairs))
+
+        return super().pairs(gid_pairs, genome_files, report_progress, check_cache, genome_sizes)
+
+    def prefetch(self, gid_pairs, genome_files, genome_sizes=None):
+        self.prefetch_calls.append(list(gid_pairs))
+
+        super().prefetch(gid_pairs, genome_files, genome_sizes)
+
+
+def random_genomes(seed, num_genomes=120, num_species=25):
+    """Create random ANI values between genomes and a Mash candidate graph consistent with them."""
+
+    rnd = random.Random(seed)
+
+    gids = [f'G{idx:04d}' for idx in range(num_genomes)]
+    species = {gid: rnd.randrange(num_species) for gid in gids}
+
+    ani_af = {gid: {} for gid in gids}
+    q_indices = []
+    r_indices = []
+    mash_anis = []
+    for q_idx, qid in enumerate(gids):
+        for r_idx, rid in enumerate(gids):
+            if qid == rid:
+                continue
+
+            if species[qid] == species[rid]:
+                ani = round(rnd.uniform(93.0, 99.5), 1)
+            else:
+                ani = round(rnd.uniform(80.0, 96.0), 1)
+            ani_af[qid][rid] = (ani, round(rnd.uniform(0.5, 1.0), 2))
+
+            # Mash ANI is a noisy estimate of ANI
+            mash_ani = ani + rnd.uniform(-1.5, 1.5)
+            if mash_ani >= 90.0:
+                q_indices.append(q_idx)
+                r_indices.append(r_idx)
+                mash_anis.append(mash_ani)
+
+    mash_candidates = MashCandidateIndex(MashANI.from_pairs(gids, q_indices, r_indices, mash_anis), 90.0)
+
+    return gids, ani_af, mash_candidates
+
+
+def select_reps(tmp_path, monkeypatch, seed, greedy_block_size=0, prefetch_genomes=0):
+    """Select representatives with the specified block size or number of genomes to prefetch ANI for."""
+
+    gids, ani_af, mash_candidates = random_genomes(seed)
+
+    ani_engine = TableANIEngine(ani_af, 2)
+    monkeypatch.setattr(cluster_de_novo, 'create_ani_engine', lambda *args, **kwargs: ani_engine)
+
+    output_dir = tmp_path / f'block_{greedy_block_size}_prefetch_{prefetch_genomes}'
+    output_dir.mkdir()
+    p = ClusterDeNovo(ANI_SP,
+                        AF_SP,
+                        None,
+                        1,
+                        str(output_dir),
+                        prefetch_genomes=prefetch_genomes,
+                        greedy_block_size=greedy_block_size)
+
+    nontype_radius = {gid: GenomeRadius(ani=ANI_SP, af=None, neighbour_gid=None) for gid in gids}
+
+    # genomes are processed in the same random order for each block size
+    random.seed(seed)
+    reps = p._selected_rep_genomes({gid: f'{gid}.fna' for gid in gids},
+                                    nontype_radius,
+                                    gids,
+                                    mash_candidates,
+                                    None,
+                                    True)
+    ani_engine.close()
+
+    random.seed(seed)
+    order = random.sample(gids, len(gids))
+
+    return reps, nontype_radius, order, mash_candidates, ani_engine
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+@pytest.mark.parametrize('greedy_block_size, prefetch_genomes', [(2, 0), (7, 0), (32, 0), (500, 0),
+                                                                    (0, 2), (0, 7), (0, 32), (0, 500)])
+def test_batched_selection_matches_single_genome_selection(tmp_path, monkeypatch, seed, greedy_block_size, prefetch_genomes):
+    reps, radius, order, mash_candidates, ani_engine = select_reps(tmp_path, monkeypatch, seed)
+    batch_reps, batch_radius, _order, _mash_candidates, batch_engine = select_reps(tmp_path,
+                                                                                    monkeypatch,
+                                                                                    seed,
+                                                                                    greedy_block_size,
+                                                                                    prefetch_genomes)
+
+    # by default, ANI is calculated separately for each genome against its candidate representatives
+    assert ani_engine.calls
+    assert all(set.intersection(*[set(pair) for pair in gid_pairs]) for gid_pairs in ani_engine.calls)
+
+    assert batch_reps == reps
+    assert batch_radius == radius
+    assert 1 < len(reps) < len(order)
+    if prefetch_genomes:
+        assert any(batch_engine.prefetch_calls)
+
+    # check batches include genomes which are candidates of a genome
+    # which became a representative earlier in the same batch
+    batch_size = greedy_block_size or prefetch_genomes
+    mid_block_reps = 0
+    for start in range(0, len(order), batch_size):
+        block = order[start:start + batch_size]
+        for idx, rep_gid in enumerate(block):
+            if rep_gid not in reps:
+                continue
+
+            later_gids = set(block[idx + 1:])
+            if any(cand_gid in later_gids for cand_gid, _ani in mash_candidates.candidates(rep_gid)):
+                mid_block_reps += 1
+
+    assert mid_block_reps > 0
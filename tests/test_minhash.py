@@ -0,0 +1,143 @@
+import math
+import os
+import random
+
+import numpy as np
+import pytest
+
+from gtdb_species_clusters.mash import create_mash
+from gtdb_species_clusters.minhash import (HASH_SEED,
+                                            MinHashSketches,
+                                            mash_distances,
+                                            murmur3_32,
+                                            sketch_genome)
+
+
+KMER_SIZE = 16
+SKETCH_SIZE = 5000
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def random_sequence(rnd, length):
+    return ''.join(rnd.choice('ACGT') for _ in range(length))
+
+
+def write_genome(genome_file, seq):
+    with open(genome_file, 'w') as fout:
+        fout.write('>contig\n')
+        for idx in range(0, len(seq), 80):
+            fout.write(seq[idx:idx + 80] + '\n')
+
+    return str(genome_file)
+
+
+def mash_sketch(seq, kmer_size, sketch_size):
+    """Sketch a sequence following the definition used by Mash."""
+
+    hashes = set()
+    for idx in range(len(seq) - kmer_size + 1):
+        kmer = seq[idx:idx + kmer_size]
+        canonical = min(kmer, kmer.translate(COMPLEMENT)[::-1]).encode('ascii')
+        data = np.frombuffer(canonical, dtype=np.uint8).reshape(1, -1)
+        hashes.add(int(murmur3_32(data, HASH_SEED)[0]))
+
+    return sorted(hashes)[0:sketch_size]
+
+
+def mash_distance(sketch1, sketch2, kmer_size, sketch_size):
+    """Mash distance estimated from the smallest hashes in the union of two sketches."""
+
+    union = sorted(set(sketch1) | set(sketch2))[0:sketch_size]
+    common = len(set(union) & set(sketch1) & set(sketch2))
+    jaccard = common / len(union)
+    if common == 0:
+        return 1.0
+
+    return min(-math.log(2 * jaccard / (1 + jaccard)) / kmer_size, 1.0)
+
+
+def sketch_distances(query_file, ref_files, kmer_size, sketch_size):
+    query_hashes = sketch_genome(query_file, kmer_size, sketch_size)
+    refs = MinHashSketches(ref_files,
+                            [sketch_genome(ref_file, kmer_size, sketch_size) for ref_file in ref_files],
+                            kmer_size,
+                            sketch_size)
+    ref_matrix, ref_lengths = refs.matrix(0, len(ref_files))
+
+    return mash_distances(query_hashes, ref_matrix, ref_lengths, kmer_size, sketch_size)
+
+
+@pytest.mark.parametrize('data, seed, expected', [(b'', 0, 0x00000000),
+                                                    (b'', 1, 0x514E28B7),
+                                                    (b'', 0xffffffff, 0x81F16F39),
+                                                    (b'\xff\xff\xff\xff', 0, 0x76293B50),
+                                                    (b'!Ce\x87', 0, 0xF55B516B),
+                                                    (b'abc', 0, 0xB3DD93FA),
+                                                    (b'Hello, world!', 1234, 0xFAF6CDB3),
+                                                    (b'The quick brown fox jumps over the lazy dog', 0, 0x2E4FF723)])
+def test_murmur3_32_matches_reference_values(data, seed, expected):
+    strings = np.frombuffer(data, dtype=np.uint8).reshape(1, len(data))
+
+    assert int(murmur3_32(strings, seed)[0]) == expected
+
+
+def test_identical_and_disjoint_genomes(tmp_path):
+    rnd = random.Random(1)
+    seq = random_sequence(rnd, 20000)
+
+    genome_file = write_genome(tmp_path / 'genome.fna', seq)
+    copy_file = write_genome(tmp_path / 'copy.fna', seq)
+    disjoint_file = write_genome(tmp_path / 'disjoint.fna', 'A' * 20000)
+
+    dist = sketch_distances(genome_file, [copy_file, disjoint_file], KMER_SIZE, SKETCH_SIZE)
+
+    assert dist[0] == 0.0
+    assert dist[1] == 1.0
+
+
+@pytest.mark.parametrize('sketch_size', [SKETCH_SIZE, 500])
+def test_distance_matches_mash_definition(tmp_path, sketch_size):
+    rnd = random.Random(2)
+    seq = random_sequence(rnd, 12000)
+
+    # related genomes share part of their sequence and contain point mutations
+    related = []
+    for shared_len, num_mutations in [(12000, 60), (9000, 0), (6000, 200)]:
+        mutated = list(seq[0:shared_len] + random_sequence(rnd, 12000 - shared_len))
+        for pos in rnd.sample(range(shared_len), num_mutations):
+            mutated[pos] = rnd.choice([base for base in 'ACGT' if base != mutated[pos]])
+        related.append(''.join(mutated))
+
+    query_file = write_genome(tmp_path / 'query.fna', seq)
+    ref_files = [write_genome(tmp_path / f'ref_{idx}.fna', ref_seq) for idx, ref_seq in enumerate(related)]
+
+    dist = sketch_distances(query_file, ref_files, KMER_SIZE, sketch_size)
+
+    query_sketch = mash_sketch(seq, KMER_SIZE, sketch_size)
+    for idx, ref_seq in enumerate(related):
+        expected = mash_distance(query_sketch, mash_sketch(ref_seq, KMER_SIZE, sketch_size), KMER_SIZE, sketch_size)
+        assert dist[idx] == pytest.approx(expected, abs=1e-12)
+        assert 0 < dist[idx] < 1
+
+
+def test_minhash_backend_does_not_write_mash_sketch_files(tmp_path):
+    rnd = random.Random(3)
+    seq = random_sequence(rnd, 20000)
+
+    genome_files = {'GCF_000000001.1': write_genome(tmp_path / 'GCF_000000001.1_genomic.fna', seq),
+                    'GCF_000000002.1': write_genome(tmp_path / 'GCF_000000002.1_genomic.fna', seq)}
+
+    mash = create_mash(1, backend='numpy')
+
+    sketch_file = str(tmp_path / 'genomes.msh')
+    mash.sketch(list(genome_files), genome_files, str(tmp_path / 'genomes.lst'), sketch_file)
+    assert not os.path.exists(sketch_file)
+    assert os.path.exists(str(tmp_path / 'genomes.minhash.npz'))
+
+    dist_file = str(tmp_path / 'genomes.dst')
+    mash.dist_pairwise(0.05, sketch_file, dist_file)
+    mash_ani = mash.read_ani(dist_file)
+
+    gid1, gid2 = mash_ani.gids
+    assert mash_ani[gid1][gid2] == 100.0